@@ -0,0 +1,84 @@
+#! /usr/bin/env python3
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import functools
+import json
+import os
+import sys
+import loader
+
+def read_manifest(filename):
+    # Read a manifest of jobs, one per line, as PROGRAM LAYOUT [CYCLES].
+    # Paths are relative to the manifest, and # starts a comment.
+    jobs = []
+    folder = os.path.dirname(filename)
+    with open(filename, 'r') as file:
+        for line in file:
+            line = line.split('#')[0].split()
+            if not line:
+                continue
+            program = os.path.join(folder, line[0])
+            layout = os.path.join(folder, line[1])
+            expected = int(line[2]) if len(line) > 2 else None
+            jobs.append((program, layout, expected))
+    return jobs
+
+def run_job(job, max_cycles=None):
+    # Run a job, stopping it after max_cycles cycles if it hasn't finished.
+    program, layout, expected = job
+    summary = {
+        'program': program,
+        'layout': layout,
+        'expected': expected,
+        'cycles': None,
+        'passed': False,
+        'ok': False,
+        'error': None,
+    }
+    try:
+        result = loader.load_puzzle(layout, program, max_cycles=max_cycles).run_headless()
+    except (Exception, SystemExit) as e:
+        # The emulator exits on malformed layouts and programs, and a few
+        # malformed programs make it raise an exception instead. Either way
+        # only this job fails.
+        if isinstance(e, SystemExit):
+            summary['error'] = str(e) or type(e).__name__
+        else:
+            summary['error'] = f"{type(e).__name__}: {e}"
+        return summary
+    summary['cycles'] = result.cycles
+    summary['passed'] = result.passed
+    if max_cycles is not None and result.cycles > max_cycles:
+        summary['error'] = f"Stopped after {max_cycles} cycle(s)"
+    summary['ok'] = result.passed and expected in (None, result.cycles)
+    return summary
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run many TIS-100 programs at once.')
+    parser.add_argument('manifest', type=str,
+        help="A file listing the jobs to run, one per line, as PROGRAM LAYOUT [CYCLES]. Paths are relative to the manifest. A job passes if the outputs match the test data in the layout and, if CYCLES is given, the program took exactly that many cycles.")
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+        help="The number of worker processes. Defaults to the number of CPUs.")
+    parser.add_argument('--max_cycles', type=int,
+        help="Stop each job after this many cycles, and fail it if it hasn't finished, so a program that never finishes can't hold up the rest.")
+    parser.add_argument('--json', action='store_true',
+        help="Print the results as a JSON list instead of one line per job.")
+
+    args = parser.parse_args()
+
+    jobs = read_manifest(args.manifest)
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        results = list(executor.map(functools.partial(run_job, max_cycles=args.max_cycles), jobs))
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for summary in results:
+            status = "PASS" if summary['ok'] else "FAIL"
+            name = f"{summary['program']} ({summary['layout']})"
+            if summary['error']:
+                print(f"{status}: {name}: {summary['error']}")
+            else:
+                print(f"{status}: {name} in {summary['cycles']} cycle(s)")
+    sys.exit(0 if all(summary['ok'] for summary in results) else 1)
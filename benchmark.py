@@ -0,0 +1,158 @@
+#! /usr/bin/env python3
+
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+import batch
+import loader
+
+def run_benchmark(program, layout, repeat, **options):
+    # Time a program's run, excluding loading, over several repeats. Peak
+    # memory is measured on a separate run, since tracing allocations slows
+    # the emulator down. Any options are passed on to NodeCluster.
+    c = loader.load_puzzle(layout, program, **options)
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = c.run_headless()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    c.run_headless()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    best = min(times)
+    processes = 1
+    if c.shards > 1:
+        import shard
+        processes = max(shard.workers(c, c.shards), 1)
+    return {
+        'program': program,
+        'layout': layout,
+        'cycles': result.cycles,
+        'passed': result.passed,
+        'best': best,
+        'mean': sum(times) / len(times),
+        'cycles_per_second': result.cycles / best if best else 0,
+        'peak_memory': peak,
+        'processes': processes,
+    }
+
+def write_grid(size, directory, length=100):
+    # Write a size x size grid whose nodes each pass the values from above
+    # them down, with an input above and an output below each column, and
+    # return the names of its program and layout files.
+    rng = random.Random(size)
+    lines = [f"{size} {size}"] + ["C" * size] * size
+    for x in range(size):
+        values = " ".join(str(rng.randint(-999, 999)) for _ in range(length))
+        lines.append(f"I{x} {values}")
+        lines.append(f"O{x} {values}")
+    layout = os.path.join(directory, f"grid{size}.txt")
+    with open(layout, 'w') as file:
+        file.write("\n".join(lines) + "\n")
+    program = os.path.join(directory, f"grid{size}_program.txt")
+    with open(program, 'w') as file:
+        file.write("".join(f"@{i}\nMOV UP DOWN\n\n" for i in range(size * size)))
+    return program, layout
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the speed of the TIS-100 emulator.')
+    parser.add_argument('manifest', type=str, nargs='?', default='test/manifest.txt',
+        help="A manifest of programs to run, in the format used by batch.py. Defaults to test/manifest.txt.")
+    parser.add_argument('-k', '--filter', type=str, action='append', default=[],
+        help="Only run programs whose path contains this text. This argument can be used multiple times.")
+    parser.add_argument('-n', '--repeat', type=int, default=3,
+        help="How many times to run each program. The fastest run is reported. Defaults to 3.")
+    parser.add_argument('--compiled', action='store_true',
+        help="Run programs as generated Python code instead of interpreting them.")
+    parser.add_argument('--fast_forward', action='store_true',
+        help="Skip over cycles where no values can move, as tis100.py does by default. Without it every cycle is run, so the time is spent in Node.exe and NodeCluster.run_once, and long busy loops aren't skipped.")
+    parser.add_argument('--shards', type=int, action='append', default=[],
+        help="Also run each program with its grid split between this many processes, and report the speed-up over running it in one. This argument can be used multiple times.")
+    parser.add_argument('--grid', type=int,
+        help="Instead of the manifest, run a generated grid this many nodes wide and high, whose nodes each pass values down. Use with --shards to measure splitting large grids.")
+    parser.add_argument('--json', type=str,
+        help="Also write the results to this file as JSON.")
+    parser.add_argument('--compare', type=str,
+        help="A JSON file from an earlier run to compare the speed against.")
+
+    args = parser.parse_args()
+
+    if args.grid:
+        # Removed when the benchmark exits.
+        directory = tempfile.TemporaryDirectory()
+        jobs = [write_grid(args.grid, directory.name) + (None,)]
+    else:
+        jobs = batch.read_manifest(args.manifest)
+    if args.filter:
+        jobs = [job for job in jobs if any(text in job[0] for text in args.filter)]
+    baseline = {}
+    if args.compare:
+        with open(args.compare, 'r') as file:
+            earlier = json.load(file)
+        # Times are only comparable if the emulator ran the same way.
+        for setting, value in (('compiled', args.compiled), ('fast_forward', args.fast_forward)):
+            before = earlier.get(setting, False)
+            if before != value:
+                print(f"\033[31m`{args.compare}' was run with {setting} {'on' if before else 'off'}, "
+                      f"so it can't be compared with a run with it {'on' if value else 'off'}.\033[0m")
+                sys.exit()
+        for job in earlier['jobs']:
+            baseline[(job['program'], job['layout'])] = job
+
+    results = []
+    start = time.perf_counter()
+    for program, layout, _ in jobs:
+        summary = run_benchmark(program, layout, args.repeat, compiled=args.compiled,
+            fast_forward=args.fast_forward)
+        results.append(summary)
+        line = f"{program} ({layout}): {summary['cycles']} cycle(s), "
+        line += f"{summary['best'] * 1000:.1f} ms, "
+        line += f"{summary['cycles_per_second']:,.0f} cycles/s, "
+        line += f"{summary['peak_memory'] / 1024:,.0f} KiB"
+        old = baseline.get((program, layout))
+        if old and old['best']:
+            line += f", {old['best'] / summary['best']:.2f}x"
+        if not summary['passed']:
+            line += " (FAILED)"
+        print(line)
+        summary['shards'] = {}
+        for shards in args.shards:
+            split = run_benchmark(program, layout, args.repeat, compiled=args.compiled,
+                fast_forward=args.fast_forward, shards=shards)
+            summary['shards'][shards] = split
+            line = f"    {shards} shards: {split['processes']} process(es), "
+            line += f"{split['best'] * 1000:.1f} ms, "
+            line += f"{summary['best'] / split['best'] if split['best'] else 0:.2f}x"
+            if split['cycles'] != summary['cycles'] or split['passed'] != summary['passed']:
+                line += " (DIFFERENT RESULT)"
+            print(line)
+    wall = time.perf_counter() - start
+
+    cycles = sum(summary['cycles'] for summary in results)
+    best = sum(summary['best'] for summary in results)
+    total = {
+        'cycles': cycles,
+        'best': best,
+        'cycles_per_second': cycles / best if best else 0,
+        'wall': wall,
+        'peak_memory': max((summary['peak_memory'] for summary in results), default=0),
+    }
+    print(f"Total: {cycles} cycle(s) in {best:.3f} s, {total['cycles_per_second']:,.0f} cycles/s, {wall:.1f} s wall time.")
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump({
+                'python': platform.python_version(),
+                'repeat': args.repeat,
+                'compiled': args.compiled,
+                'fast_forward': args.fast_forward,
+                'jobs': results,
+                'total': total,
+            }, file, indent=2)
@@ -0,0 +1,117 @@
+import marshal
+import os
+import sys
+import zlib
+
+# Parsed layouts and programs are kept on disk between runs, keyed by the
+# text they were parsed from. Set enabled to False to always parse.
+enabled = True
+DIRECTORY = os.environ.get('TIS100_CACHE') or os.path.join(os.path.expanduser('~'), '.cache', 'tis100')
+# The most bytes the cache takes up. Past this, the entries used least
+# recently are removed.
+MAX_SIZE = 16 * 1024 * 1024
+# Part of every key, so entries written by an older version of the emulator,
+# or another version of Python, are never read. Change this whenever the
+# form of anything stored changes.
+VERSION = f"2-{sys.implementation.cache_tag}"
+
+# Values are stored with marshal, and files are named by a checksum of their
+# text, with the text itself stored alongside the value to rule out
+# collisions. Unlike pickle and hashlib, neither needs anything imported, so
+# using the cache costs a short run nothing at startup.
+
+def path(kind, text):
+    data = f"{VERSION}\n{kind}\n{text}".encode()
+    checksum = zlib.crc32(data) << 32 | zlib.adler32(data)
+    return os.path.join(DIRECTORY, f"{kind}-{checksum:016x}.entry")
+
+def load(kind, text):
+    # The value stored for text, or None if there isn't one. Values can only
+    # be made of the types marshal supports.
+    if not enabled:
+        return None
+    filename = path(kind, text)
+    try:
+        with open(filename, 'rb') as file:
+            key, value = marshal.load(file)
+        if key != text:
+            return None
+        # The modification time is when an entry was last used.
+        os.utime(filename)
+        return value
+    except Exception:
+        # Missing, unreadable and damaged entries are all parsed again.
+        return None
+
+def save(kind, text, value):
+    if not enabled:
+        return
+    filename = path(kind, text)
+    # Write to a temporary file first, so other processes never read a half
+    # written entry.
+    temporary = f"{filename}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(DIRECTORY, exist_ok=True)
+        with open(temporary, 'wb') as file:
+            marshal.dump((text, value), file)
+            size = file.tell()
+        os.replace(temporary, filename)
+        if grow(size) > MAX_SIZE:
+            evict()
+    except (OSError, ValueError):
+        # Running without a cache is only slower.
+        try:
+            os.remove(temporary)
+        except OSError:
+            pass
+
+def write_size(total):
+    filename = os.path.join(DIRECTORY, 'size')
+    temporary = f"{filename}.{os.getpid()}.tmp"
+    with open(temporary, 'w') as file:
+        file.write(str(total))
+    os.replace(temporary, filename)
+
+def grow(size):
+    # Add size bytes to the size of the cache kept in its size file, and
+    # return the new size. Measuring the cache means looking at every entry,
+    # so it is only done by evict, once this says the cache is too big. The
+    # size is only roughly right, as processes saving at the same time can
+    # miss each other's entries, and entries saved again are counted twice,
+    # but evict puts it right each time.
+    try:
+        with open(os.path.join(DIRECTORY, 'size'), 'r') as file:
+            total = int(file.read())
+    except (OSError, ValueError):
+        # Without a size, the cache has to be measured.
+        total = MAX_SIZE
+    total += size
+    write_size(total)
+    return total
+
+def evict():
+    # Remove the least recently used entries until the cache is down to
+    # three quarters of MAX_SIZE, so this isn't needed again for a while, and
+    # record the size left.
+    entries = []
+    total = 0
+    with os.scandir(DIRECTORY) as scan:
+        for entry in scan:
+            if not entry.name.endswith('.entry'):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+    entries.sort()
+    for _, size, filename in entries:
+        if total <= MAX_SIZE * 3 // 4:
+            break
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+        total -= size
+    write_size(total)
@@ -1,37 +1,165 @@
+import cache
 import node
-import curses
-from datetime import datetime
+import io
+import math
 import sys
-import textwrap
 import time
 
+# The most cycles skip_ahead will skip in one go.
+MAX_SKIP = 1000000
+# After failing to skip more than this many cycles, skip_ahead isn't tried
+# again for as many cycles, doubling each time it fails again up to
+# MAX_SKIP_INTERVAL, so busy programs don't pay for checking.
+SKIP_INTERVAL = 16
+MAX_SKIP_INTERVAL = 4096
+
+def parse_program(text):
+    # The code of each node in the text of a program file, as a dictionary of
+    # ID: code.
+    code = {}
+    for line in io.StringIO(text):
+        try:
+            if line[0] == '@':
+                current_node = int(line[1:])
+                code[current_node] = ""
+            elif line != "":
+                code[current_node] += line
+        except UnboundLocalError:
+            print("\033[31mMalformed program file.")
+            print("Program must have at least one node, labeled @n, where n is the node ID.\033[0m")
+            sys.exit()
+    return code
+
+def format_program(code):
+    # The text of a program file with the code of each node in a dictionary of
+    # ID: code, as written by NodeCluster.save.
+    text = ""
+    for i in sorted(code):
+        text += f"@{i}\n"
+        if code[i] == "":
+            text += "\n\n"
+        else:
+            text += code[i]
+            text += "\n" if code[i][-1] == "\n" else "\n\n"
+    return text
+
+class Result:
+    """ The outcome of running a program on a cluster until it finished.
+    """
+    def __init__(self, cycles, passed, outputs, image=None, nodes=None, profile=None):
+        self.cycles = cycles
+        self.passed = passed
+        # Output values, as a dictionary of (x, y): [values]
+        self.outputs = outputs
+        # The output image, as rows of pixel values, if there was one.
+        self.image = image
+        # Statistics for each programmable node, as returned by node_stats.
+        self.nodes = nodes if nodes is not None else []
+        # The Profiler report, if the cluster was profiled.
+        self.profile = profile
+
+    def __repr__(self):
+        return f"Result(cycles={self.cycles}, passed={self.passed})"
+
+
+class Score:
+    """ How a program did across several tests, scored the way the game
+    scores a solution: the cycles taken by its slowest test, the number of
+    nodes with code, and the total number of instructions.
+    """
+    def __init__(self, results):
+        # The Result of each test, in order.
+        self.results = results
+        self.passed = all(result.passed for result in results)
+        self.cycles = max(result.cycles for result in results)
+        stats = results[0].nodes
+        self.nodes = len([n for n in stats if n['instructions'] > 0])
+        self.instructions = sum(n['instructions'] for n in stats)
+
+    def __repr__(self):
+        return f"Score(cycles={self.cycles}, nodes={self.nodes}, instructions={self.instructions}, passed={self.passed})"
+
+
 class NodeCluster:
     """ Class for the cluster of notes in the TIS-100, to allow the individual
     nodes to communicate with each other.
     """
-    def __init__(self, width, height, inputs={}, outputs=[], image_port=None, image_dim=(30, 18), test_image=[], filename=None, test_outputs={}, speed=50, memory=[], dead=[], debug=False, gui=False):
+    def __init__(self, width, height, inputs=None, outputs=None, image_port=None, image_dim=(30, 18), test_image=None, filename=None, test_outputs=None, speed=50, memory=None, dead=None, debug=False, gui=False, fail_fast=False, profile=False, fast_forward=True, compiled=False, trace=None, max_outputs=None, sinks=None, shards=1, max_cycles=None):
         self.screen = None
+        self.renderer = None
         self.width = width
         self.height = height
         # Inputs and outputs will be dictionaries of (x, y): [values]
-        self.inputs = inputs
-        self.outputs = outputs
+        self.inputs = inputs if inputs is not None else {}
+        self.outputs = outputs if outputs is not None else []
         self.output_lists = {}
         for x, y in self.outputs:
             self.output_lists[(x, y)] = []
-        self.test_outputs = test_outputs
+        # The number of values each output has produced, which is more than
+        # the length of its list once max_outputs values have been kept.
+        self.output_counts = {}
+        self.max_outputs = max_outputs
+        # Called as sink(port, value, cycle) for each value output.
+        self.sinks = list(sinks) if sinks else []
+        self.test_outputs = test_outputs if test_outputs is not None else {}
+        self.fail_fast = fail_fast
+        # Counts what each node does, if profiling is turned on. Modules only
+        # needed by an option are imported when it is used, so short headless
+        # runs start quickly.
+        self.profiler = None
+        if profile:
+            import profiler
+            self.profiler = profiler.Profiler(self)
+        # Records everything the cluster does to this file, if tracing.
+        self.recorder = None
+        if trace:
+            import recorder
+            self.recorder = recorder.Recorder(self, trace)
+        # Skip over cycles where no values can move. This is only done
+        # without the GUI, and when not profiling or tracing, which need
+        # every cycle.
+        self.fast_forward = fast_forward and not gui and not profile and not trace
+        # The cycle from which to try skipping ahead again, and how long to
+        # wait after the next time skipping doesn't pay.
+        self.skip_at = 0
+        self.skip_interval = SKIP_INTERVAL
+        # Run nodes' programs as generated Python code instead of
+        # interpreting them.
+        self.compiled = compiled
+        # A compiled function running one cycle, set up by link().
+        self.run_cycle = None
+        # Split the rows of the grid between this many processes when running
+        # without the GUI. Profiling and tracing need every node in one
+        # process, so they always run in one.
+        self.shards = shards if not gui and not profile and not trace else 1
+        # Give up on a run without the GUI once it has taken more than this
+        # many cycles, counting it as failed.
+        self.max_cycles = max_cycles
+        # Incremental test state, set up by reset_tests().
+        self.test_failed = False
+        self.outputs_pending = 0
+        self.image_pending = 0
+        self.image_tested = False
         self.speed = speed
-        self.memory = memory
-        self.dead = dead
+        self.memory = memory if memory is not None else []
+        self.dead = dead if dead is not None else []
         self.debug = debug
         self.gui = gui
         self.cycle = 0
         self.nodes = []
+        # Programmable nodes by their ID, kept up to date by link().
+        self.nodes_by_id = {}
+        # Nodes visited by run_once, built by link().
+        self.active = []
+        # Whether any node advanced during the last call to run_once.
+        self.progress = False
         self.go = True
         self.frozen = False
+        # Whether the outputs matched the test outputs.
+        self.passed = False
         self.image_port = image_port
         self.image_dim = image_dim
-        self.test_image = test_image
+        self.test_image = test_image if test_image is not None else []
         self.image_pos = [None, None]
         self.image = None
         if self.image_port:
@@ -40,11 +168,11 @@ class NodeCluster:
             row = []
             for x in range(width+2):
                 code = ""
-                if (x, y) in self.inputs:
-                    code = self.create_input(x, y)
                 if (x, y) in self.outputs:
                     code = self.create_output(x, y)
-                if (x, y) in self.memory:
+                if (x, y) in self.inputs:
+                    row.append(self.create_input(x, y))
+                elif (x, y) in self.memory:
                     row.append(node.Node(self, x, y, code=code, memory=True))
                 elif (x, y) in self.dead:
                     row.append(node.Node(self, x, y, code=code, dead=True))
@@ -53,16 +181,22 @@ class NodeCluster:
                 if (x, y) in self.outputs:
                     row[x].acc = None
             self.nodes.append(row)
+        self.number_nodes()
         if filename:
             self.load(filename)
 
     def __repr__(self):
+        import textwrap
         rep = ""
         offset = 1
         if self.debug:
             offset = 0
             for x, y in self.inputs.keys():
-                input_list = [str(x) for x in self.inputs[(x, y)]]
+                # Streamed inputs can't be shown without consuming them.
+                if isinstance(self.inputs[(x, y)], (list, tuple)):
+                    input_list = [str(x) for x in self.inputs[(x, y)]]
+                else:
+                    input_list = ["..."]
                 rep += f"({x}, {y}): {' '.join(input_list)}\n"
         lines = len(self.nodes[1][1].__repr__().split('\n'))
         for y in range(offset, self.height+2-offset):
@@ -83,48 +217,67 @@ class NodeCluster:
         return rep
 
     def load(self, filename):
-        code = {}
         with open(filename, 'r') as file:
-            lines = file.readlines()
-            for line in lines:
-                try:
-                    if line[0] == '@':
-                        current_node = int(line[1:])
-                        code[current_node] = ""
-                    elif line != "":
-                        code[current_node] += line
-                except UnboundLocalError:
-                    print("\033[31mMalformed program file.")
-                    print("Program must have at least one node, labeled @n, where n is the node ID.\033[0m")
-                    sys.exit()
+            self.load_program(file.read())
+
+    def load_program(self, text):
+        # Load the nodes' programs from the text of a program file.
+        # Each node's decoded program, by ID, if the text has been loaded
+        # before.
+        decoded = cache.load('program', text) or {}
+        code = parse_program(text)
         i = 0
+        programs = {}
         for y in range(1, self.height+1):
             for x in range(1, self.width+1):
                 if (x, y) in self.dead or (x, y) in self.memory:
                     continue
-                self.nodes[y][x] = node.Node(self, x, y, code=code.get(i, ""))
+                n = node.Node(self, x, y, code=code.get(i, ""), id=i, decoded=decoded.get(i))
+                self.nodes[y][x] = n
+                programs[i] = n.decoded_program()
                 i += 1
+        if programs.keys() - decoded.keys():
+            cache.save('program', text, {**decoded, **programs})
+        self.link()
+
+    def link(self):
+        # Resolve each node's neighbours and build the list of nodes that
+        # actually do something, in grid order. Empty border nodes, dead nodes
+        # and compute nodes without code are never visited by run_once. Needs
+        # to be redone whenever nodes in the grid are replaced.
+        # Each entry is (node, (x, y) if it is an output node, else None,
+        # whether the node's progress counts towards detecting completion).
+        # Only nodes in the rows of the cluster itself count, so inputs and
+        # outputs above and below it don't keep a finished program running.
+        self.number_nodes()
+        if self.compiled:
+            import compiler
+        self.active = []
+        for row in self.nodes:
+            for n in row:
+                # Only nodes that run ever read from their ports.
+                if n.is_active():
+                    n.link()
+                    if self.compiled and n.program:
+                        compiler.compile_node(n)
+                    output = (n.x, n.y) if (n.x, n.y) in self.outputs else None
+                    tracked = 1 <= n.y <= self.height
+                    self.active.append((n, output, tracked))
+        # With compiled programs, a whole cycle is compiled too, unless the
+        # GUI, profiler or recorder have to see each node run.
+        self.run_cycle = None
+        if self.compiled and not self.gui and not self.profiler and not self.recorder:
+            self.run_cycle = compiler.compile_cycle(self)
+        if self.profiler:
+            self.profiler.attach()
+        if self.recorder:
+            self.recorder.attach()
 
     def save(self, filename):
         with open(filename, 'w') as file:
-            i = 0
-            for y in range(1, self.height+1):
-                for x in range(1, self.width+1):
-                    if (x, y) in self.dead or (x, y) in self.memory:
-                        continue
-                    file.write(f"@{i}\n")
-                    if self.nodes[y][x].code == "":
-                        file.write("\n\n")
-                    else:
-                        file.write(self.nodes[y][x].code)
-                        if self.nodes[y][x].code[-1] == "\n":
-                            file.write("\n")
-                        else:
-                            file.write("\n\n")
-                    i += 1
+            file.write(format_program({i: n.code for i, n in self.nodes_by_id.items()}))
 
     def create_input(self, x, y):
-        code = ""
         if y == 0:
             direction = 'DOWN'
         elif y == (self.height + 1):
@@ -133,10 +286,7 @@ class NodeCluster:
             direction = 'RIGHT'
         elif x == (self.width + 1):
             direction = 'LEFT'
-        for value in self.inputs[(x, y)]:
-            code += f"MOV {value} {direction}\n"
-        code += "JRO 0"
-        return code
+        return node.InputNode(self, x, y, values=self.inputs[(x, y)], direction=direction)
 
     def create_output(self, x, y):
         if y == 0:
@@ -150,32 +300,6 @@ class NodeCluster:
         code = f"MOV {direction} ACC"
         return code
 
-    def write_color(self, y, x, color):
-        width = len(self.nodes[1][1].__repr__().split('\n')[0])
-        width *= self.width
-        curses.init_pair(1, -1, 0)
-        curses.init_pair(2, -1, 4)  # Using blue instead of light gray
-        curses.init_pair(3, -1, 7)
-        curses.init_pair(4, 0, 1)
-        try:
-            if color == 0:
-                self.screen.addstr(y, width+x, " ")
-                return
-            if color == 1:
-                self.screen.addstr(y, width+x, " ", curses.color_pair(1))
-                return
-            if color == 2:
-                self.screen.addstr(y, width+x, " ", curses.color_pair(2))
-                return
-            if color == 3:
-                self.screen.addstr(y, width+x, " ", curses.color_pair(3))
-                return
-            if color == 4:
-                self.screen.addstr(y, width+x, " ", curses.color_pair(4))
-                return
-        except:
-            return
-
     def draw_image(self, value):
         if value < 0:
             self.image_pos = [None, None]
@@ -190,12 +314,21 @@ class NodeCluster:
             return
         if self.image_pos[1] >= self.image_dim[1]:
             return
-        self.image[self.image_pos[1]][self.image_pos[0]] = value
-        self.image_pos[0] = self.image_pos[0] + 1
+        x, y = self.image_pos
+        old = self.image[y][x]
+        self.image[y][x] = value
+        if self.image_tested:
+            expected = self.test_image[y][x]
+            self.image_pending += (old == expected) - (value == expected)
+        self.image_pos[0] = x + 1
 
     def run(self):
+        self.link()
+        self.reset_tests()
         try:
             if (self.gui):
+                import curses
+                import gui
                 self.screen = curses.initscr()
                 curses.start_color()
                 curses.use_default_colors()
@@ -204,68 +337,64 @@ class NodeCluster:
                 curses.cbreak()
                 self.screen.keypad(1)
                 curses.curs_set(0);
-            last = datetime.now()
-            last_refresh = datetime.now()
+                self.renderer = gui.Renderer(self, self.screen)
+            elif self.shards > 1:
+                try:
+                    if self.run_sharded():
+                        if self.passed:
+                            print("Test passed.")
+                        elif self.fail_fast and self.test_failed:
+                            print("Test failed.")
+                        self.print_outputs()
+                        return
+                except KeyboardInterrupt:
+                    self.print_outputs()
+                    return
+            # Cycles are run at speed per second, while frames are drawn at
+            # most FRAME_RATE times a second.
+            next_cycle = last_frame = time.perf_counter()
             while(True):
                 try:
                     if self.frozen:
+                        if self.gui:
+                            self.renderer.draw()
                         time.sleep(1)
                         continue
-                    # Monitor the node cycles, so we can stop if nothing changes.
-                    old_cycles = []
-                    for row in self.nodes[1:-1]:
-                        for n in row:
-                            old_cycles.append(n.cycle)
-                    if self.gui:
-                        self.screen.clear()
-                        self.screen.addstr(0, 0, f"Cycle: {self.cycle}")
-                        tis = self.__repr__().split('\n')
-                        for i, line in enumerate(tis):
-                            try:
-                                self.screen.addstr(i+1, 0, line)
-                            except:
-                                pass
-                        if (self.image):
-                            for i, row in enumerate(self.image):
-                                for j, value in enumerate(row):
-                                    self.write_color(i, j, value)
-                        delta_refresh= datetime.now() - last_refresh
-                        delta_refresh = delta_refresh.seconds * 1e6 + delta_refresh.microseconds
-                        if delta_refresh > (1e6/60):  # Limit refresh rate to 60 Hz to reduce screen flicker
-                            last_refresh = datetime.now()
-                            self.screen.refresh()
                     self.run_once()
-                    cycles = []
-                    for row in self.nodes[1:-1]:
-                        for n in row:
-                            cycles.append(n.cycle)
-                    if old_cycles == cycles and self.cycle > 1:
+                    # Stop if no node in the cluster made progress.
+                    if not self.progress and self.cycle > 1:
                         if self.go and not self.frozen:
                             self.cycle -= 1
                         self.go = False
                         self.frozen = True
                         if not self.gui:
-                            output_return = ""
-                            for x, y in self.outputs:
-                                output_list = [str(x) for x in self.output_lists[(x, y)]]
-                                output_return += f"{' '.join(output_list)}" + "\n"
-                            output_return += f"Completed in {self.cycle} cycle(s)."
-                            print(output_return)
+                            if self.passed:
+                                print("Test passed.")
+                            elif self.fail_fast and self.test_failed:
+                                print("Test failed.")
+                            self.print_outputs()
                             return
                     if self.speed == 0 and self.gui:
+                        self.renderer.draw()
                         self.screen.getch()
                     elif self.gui:  # If we're not in a GUI, don't bother slowing anything down
-                        delta, last = (datetime.now() - last), datetime.now()
-                        delta = delta.seconds + delta.microseconds/1e6
-                        time.sleep(max((1 / self.speed) - delta, 1 / self.speed))
+                        now = time.perf_counter()
+                        if now - last_frame >= 1 / gui.FRAME_RATE:
+                            self.renderer.draw()
+                            last_frame = now
+                        if math.isinf(self.speed):
+                            # Run cycles back to back, drawing between them
+                            # only when a frame is due.
+                            continue
+                        next_cycle += 1 / self.speed
+                        if next_cycle > now:
+                            time.sleep(next_cycle - now)
+                        elif now - next_cycle > 1 / gui.FRAME_RATE:
+                            # Don't rush to catch up after falling behind.
+                            next_cycle = now
                 except KeyboardInterrupt:
                     if not self.gui:
-                        output_return = ""
-                        for x, y in self.outputs:
-                            output_list = [str(x) for x in self.output_lists[(x, y)]]
-                            output_return += f"{' '.join(output_list)}" + "\n"
-                        output_return += f"Completed in {self.cycle} cycle(s)."
-                        print(output_return)
+                        self.print_outputs()
                         return
                     break
         finally:
@@ -276,82 +405,342 @@ class NodeCluster:
                 curses.nocbreak()
                 curses.endwin()
                 curses.curs_set(1);
-            self.cycle = 0
-            self.go = True
-            for (x, y) in self.outputs:
-                self.output_lists[(x, y)] = []
-            for row in self.nodes:
-                for n in row:
-                    n.__init__(self, n.x, n.y, code=n.code, memory=n.memory, dead=n.dead)
-                    if (n.x, n.y) in self.outputs:
-                        n.acc = None
-            self.image_pos = [None, None]
-            if self.image_port:
-                self.image = [[0] * self.image_dim[0] for _ in range(self.image_dim[1])]
+            if self.recorder:
+                self.recorder.close()
+            self.reset()
+
+    def run_headless(self):
+        # Run the program until it finishes, without the GUI or printing
+        # anything, and return its Result. The cluster is reset afterwards, so
+        # it can be run again.
+        self.link()
+        self.reset_tests()
+        try:
+            if not (self.shards > 1 and self.run_sharded()):
+                while True:
+                    self.run_once()
+                    # Stop if no node in the cluster made progress, or the
+                    # program has run for too long.
+                    if self.max_cycles is not None and self.cycle > self.max_cycles:
+                        break
+                    if not self.progress and self.cycle > 1:
+                        if self.go and not self.frozen:
+                            self.cycle -= 1
+                        break
+            profile = self.profiler.report() if self.profiler else None
+            return Result(self.cycle, self.passed, dict(self.output_lists), self.image, self.node_stats(), profile)
+        finally:
+            if self.recorder:
+                self.recorder.close()
+            self.reset()
+
+    def run_sharded(self):
+        # Run the program until it finishes with the rows of the grid split
+        # between worker processes, if there are enough rows to split.
+        # Returns whether it ran.
+        import shard
+        count = shard.workers(self, self.shards)
+        if count < 2:
+            return False
+        shard.run(self, count)
+        return True
+
+    def print_outputs(self):
+        # Print the output values and the cycle count at the end of a run
+        # without the GUI.
+        output_return = ""
+        for x, y in self.outputs:
+            output_list = [str(x) for x in self.output_lists[(x, y)]]
+            if self.output_counts.get((x, y), 0) > len(output_list):
+                output_list.append("...")
+            output_return += f"{' '.join(output_list)}" + "\n"
+        output_return += f"Completed in {self.cycle} cycle(s)."
+        print(output_return)
+
+    def number_nodes(self):
+        # Give each programmable node the ID used for it in program files,
+        # counting across then down and skipping memory and dead nodes.
+        self.nodes_by_id = {}
+        for y in range(1, self.height+1):
+            for x in range(1, self.width+1):
+                n = self.nodes[y][x]
+                if (x, y) in self.dead or (x, y) in self.memory:
+                    n.id = None
+                    continue
+                n.id = len(self.nodes_by_id)
+                self.nodes_by_id[n.id] = n
+
+    def node_ids(self):
+        # The IDs of programmable nodes used in program files, as a dictionary
+        # of (x, y): ID.
+        return {(n.x, n.y): i for i, n in self.nodes_by_id.items()}
+
+    def node_stats(self):
+        # Statistics for each programmable node, in the order of their IDs:
+        # how many instructions it has, how many cycles it spent doing
+        # something, and the percentage of cycles it was idle.
+        stats = []
+        for (x, y), i in self.node_ids().items():
+            n = self.nodes[y][x]
+            try:
+                idle = 100 - round((n.cycle * 100) / self.cycle)
+            except ZeroDivisionError:
+                idle = 0
+            stats.append({
+                'id': i,
+                'x': x,
+                'y': y,
+                'instructions': len(n.instructions),
+                'cycles': n.cycle,
+                'idle': idle,
+            })
+        return stats
+
+    def reset(self):
+        # Return the cluster to its state before the program started running.
+        # Nodes keep their parsed programs, so this is cheap enough to do
+        # between every run.
+        self.cycle = 0
+        self.skip_at = 0
+        self.skip_interval = SKIP_INTERVAL
+        self.go = True
+        self.frozen = False
+        self.passed = False
+        for (x, y) in self.outputs:
+            self.output_lists[(x, y)] = []
+        self.output_counts = {}
+        for row in self.nodes:
+            for n in row:
+                n.reset()
+                if (n.x, n.y) in self.outputs:
+                    n.acc = None
+        self.image_pos = [None, None]
+        if self.image_port:
+            self.image = [[0] * self.image_dim[0] for _ in range(self.image_dim[1])]
+
+    def snapshot(self):
+        # Capture the state of the whole machine, to be put back later by
+        # restore. The programs loaded onto the nodes are not included.
+        return {
+            'cycle': self.cycle,
+            'go': self.go,
+            'frozen': self.frozen,
+            'passed': self.passed,
+            'output_lists': {port: list(values) for port, values in self.output_lists.items()},
+            'output_counts': dict(self.output_counts),
+            'image': [list(row) for row in self.image] if self.image else None,
+            'image_pos': list(self.image_pos),
+            'nodes': [[n.snapshot() for n in row] for row in self.nodes],
+        }
+
+    def restore(self, state):
+        self.cycle = state['cycle']
+        self.skip_at = 0
+        self.skip_interval = SKIP_INTERVAL
+        self.go = state['go']
+        self.frozen = state['frozen']
+        self.passed = state['passed']
+        self.output_lists = {port: list(values) for port, values in state['output_lists'].items()}
+        self.output_counts = dict(state['output_counts'])
+        if state['image'] is not None:
+            self.image = [list(row) for row in state['image']]
+        self.image_pos = list(state['image_pos'])
+        for row, states in zip(self.nodes, state['nodes']):
+            for n, node_state in zip(row, states):
+                n.restore(node_state)
+        self.reset_tests()
+
+    def reset_tests(self):
+        # Set up incremental checking of the outputs against the test outputs,
+        # so check_tests never has to compare whole lists. Output values are
+        # compared as they arrive, and image pixels as they are drawn.
+        self.test_failed = False
+        # Tested outputs whose list doesn't equal the test list yet.
+        self.outputs_pending = 0
+        for port, expected in self.test_outputs.items():
+            output_list = self.output_lists.get(port)
+            # Values past max_outputs aren't kept, so only the kept ones can
+            # be checked again.
+            if (output_list is None or self.output_counts.get(port, 0) != len(expected) or
+                    output_list != expected[:len(output_list)]):
+                self.outputs_pending += 1
+            # Outputs so far must be the start of the test outputs.
+            if output_list is not None and output_list != expected[:len(output_list)]:
+                self.test_failed = True
+        # Pixels of the image that don't match the test image yet.
+        self.image_pending = 0
+        self.image_tested = False
+        if self.image_port:
+            if (len(self.test_image) != self.image_dim[1] or
+                    any(len(row) != self.image_dim[0] for row in self.test_image)):
+                # The image can never match a test image of the wrong size.
+                self.image_pending = 1
+            else:
+                self.image_tested = True
+                for row, test_row in zip(self.image, self.test_image):
+                    for value, expected in zip(row, test_row):
+                        if value != expected:
+                            self.image_pending += 1
 
     def check_tests(self):
         # Check if the outputs are the same as the test outputs
-        if sum([len(x) for x in self.test_outputs]) == 0 and len(self.test_image) == 0:
+        if not self.test_outputs and len(self.test_image) == 0:
             return False
-        for n in self.test_outputs:
-            if self.test_outputs[n] != self.output_lists.get(n, None):
+        return not self.test_failed and self.outputs_pending == 0 and self.image_pending == 0
+
+    def add_output(self, port, value):
+        i = self.output_counts.get(port, 0)
+        self.output_counts[port] = i + 1
+        if self.max_outputs is None or i < self.max_outputs:
+            self.output_lists[port].append(value)
+        for sink in self.sinks:
+            sink(port, value, self.cycle)
+        expected = self.test_outputs.get(port)
+        if expected is not None:
+            if i >= len(expected) or expected[i] != value:
+                self.test_failed = True
+            elif i == len(expected) - 1:
+                self.outputs_pending -= 1
+        if port == self.image_port:
+            self.draw_image(value)
+
+    def skip_ahead(self):
+        # Skip over cycles where no value can pass between nodes: every node
+        # is either stalled on a port that no neighbour is servicing, or
+        # running instructions that don't touch a port. The running nodes are
+        # advanced on their own until the first of them reaches a port, which
+        # takes the same number of cycles as running the whole cluster would.
+        # Returns whether any cycles were skipped.
+        running = []
+        waiting = []
+        progress = False
+        self.skip_at = self.cycle + self.skip_interval
+        self.skip_interval = min(2 * self.skip_interval, MAX_SKIP_INTERVAL)
+        for n, _, tracked in self.active:
+            state = n.quiet_state()
+            if state is None:
                 return False
-        if self.test_image != self.image and self.image_port:
+            if state == 'RUN':
+                running.append(n)
+                progress = progress or tracked
+            else:
+                waiting.append(n)
+        if not progress:
+            # Nothing would change, so leave it to run_once to finish.
             return False
+        most = MAX_SKIP
+        if self.max_cycles is not None:
+            # Skip no further than the cycle run_headless stops at.
+            most = min(most, self.max_cycles - self.cycle + 1)
+        # Nodes are run in stretches that double in length, each node only
+        # as far as the nodes before it got, so no node runs much further
+        # than the skip ends up being. Only in the last stretch, where one of
+        # them reached a port, can the nodes before it have run too far, and
+        # those are put back and run again.
+        cycles = 0
+        stretch = SKIP_INTERVAL
+        while cycles < most:
+            limit = min(stretch, most - cycles)
+            states = [n.snapshot() for n in running]
+            runs = []
+            least = limit
+            for n in running:
+                run = n.run_local(least)
+                runs.append(run)
+                least = min(least, run)
+                if least == 0:
+                    break
+            if least < limit:
+                for n, state, run in zip(running, states, runs):
+                    if run > least:
+                        n.restore(state)
+                        n.run_local(least)
+                cycles += least
+                break
+            cycles += limit
+            stretch *= 2
+        if cycles == 0:
+            return False
+        # Leave stalled nodes as they would be after trying for a cycle.
+        for n in waiting:
+            n.exe()
+        for n, _, _ in self.active:
+            n.ready_to_write = n.write and (n.output is not None)
+        self.cycle += cycles
+        if cycles > SKIP_INTERVAL:
+            # Skipping paid, so try again straight away.
+            self.skip_at = 0
+            self.skip_interval = SKIP_INTERVAL
+        self.progress = True
         return True
 
     def run_once(self):
+        self.progress = False
         # Check if test_outputs is equal to output_lists and stop
         if self.check_tests():
             if self.gui:
+                self.renderer.draw()
                 self.screen.addstr(0, 36, "PASS")
                 self.screen.refresh()
-            else:
-                print("Test passed.")
+            self.passed = True
+            self.go = False
+            self.frozen = True
+            return
+        # Stop on the first wrong output if asked to, rather than running
+        # until the cluster deadlocks.
+        if self.fail_fast and self.test_failed:
+            if self.gui:
+                self.renderer.draw()
+                self.screen.addstr(0, 36, "FAIL")
+                self.screen.refresh()
             self.go = False
             self.frozen = True
             return
         if not self.go and self.speed > 0 and self.gui:
+            self.renderer.draw()
             char = self.screen.getch()
             if char == ord('r'):
                 self.go = True
+        if (self.fast_forward and self.cycle >= self.skip_at and self.go and
+                not self.frozen and self.skip_ahead()):
+            return
         if not self.frozen:
             self.cycle += 1
+        if self.run_cycle:
+            self.progress = self.run_cycle()
+            return
+        if self.profiler:
+            self.profiler.start_cycle()
         # Execute instructions
-        for row in self.nodes:
-            for n in row:
-                if self.speed > 0 and len(n.instructions) > 0 and (n.step % len(n.instructions)) in n.breakpoints and self.gui:
-                    self.go = False
-                    char = self.screen.getch()
-                    if char == ord('r') and not self.frozen:
-                        self.go = True
-                n.exe()
-                # If this is an output node, check the ACC, add it to the
-                # output list, then clear it.
-                if (n.x, n.y) in self.outputs and (n.acc is not None):
-                    self.output_lists[(n.x, n.y)].append(n.acc)
-                    if (n.x, n.y) == self.image_port:
-                        self.draw_image(n.acc)
-                    n.acc = None
-        # Check any register values
-        dirs = {
-            'UP': (0, -1),
-            'DOWN': (0, 1),
-            'LEFT': (-1, 0),
-            'RIGHT': (1, 0)
-        }
-        rdirs = {
-            'UP': 'DOWN',
-            'DOWN': 'UP',
-            'LEFT': 'RIGHT',
-            'RIGHT': 'LEFT'
-        }
+        progress = False
+        for n, output, tracked in self.active:
+            if self.gui and self.speed > 0 and n.breakpoints and (n.step % len(n.instructions)) in n.breakpoints:
+                self.go = False
+                self.renderer.draw()
+                char = self.screen.getch()
+                if char == ord('r') and not self.frozen:
+                    self.go = True
+            cycle = n.cycle
+            n.exe()
+            if tracked and n.cycle != cycle:
+                progress = True
+            # If this is an output node, check the ACC, add it to the
+            # output list, then clear it.
+            if output and (n.acc is not None):
+                self.add_output(output, n.acc)
+                n.acc = None
         # Set nodes' ready_to_write value if they have a write port and output
         # set.
-        for row in self.nodes:
-            for n in row:
-                # Node just wrote somewhere, step and cycle increase by 1.
-                if n.ready_to_write and not(n.write and (n.output is not None)):
-                    n.step += 1
-                    n.cycle += 1
-                n.ready_to_write = n.write and (n.output is not None)
+        for n, _, tracked in self.active:
+            # Node just wrote somewhere, step and cycle increase by 1.
+            if n.ready_to_write and not(n.write and (n.output is not None)):
+                n.step += 1
+                n.cycle += 1
+                if tracked:
+                    progress = True
+            n.ready_to_write = n.write and (n.output is not None)
+        self.progress = progress
+        if self.profiler:
+            self.profiler.end_cycle()
+        if self.recorder:
+            self.recorder.end_cycle()
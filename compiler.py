@@ -0,0 +1,208 @@
+import collections
+import hashlib
+import cache as disk_cache
+import node
+
+# The most functions kept in memory. Long-lived processes, such as the
+# workers of daemon.py, compile many programs that are only run once.
+MAX_CACHED = 256
+# Functions that build a node's compiled instructions, by program hash, and
+# that build a cluster's cycle function, by source hash, least recently used
+# first.
+cache = collections.OrderedDict()
+
+def cached(key):
+    make = cache.get(key)
+    if make is not None:
+        cache.move_to_end(key)
+    return make
+
+def store(key, make):
+    cache[key] = make
+    if len(cache) > MAX_CACHED:
+        cache.popitem(last=False)
+
+def program_hash(program):
+    return hashlib.sha1(repr(program).encode()).hexdigest()
+
+def compile_node(n):
+    # Replace a node's instructions with compiled ones. Each program is
+    # turned into Python source once, and the result is shared by every node
+    # running the same program.
+    key = program_hash(n.program)
+    make = cached(key)
+    if make is None:
+        # The compiled code is also kept on disk between runs, keyed by the
+        # source it was compiled from, so a change to the code generator is
+        # never hidden by code it generated before.
+        source = program_source(n.program)
+        code = disk_cache.load('compiled', source)
+        if code is None:
+            code = compile(source, f"<program {key[:8]}>", 'exec')
+            disk_cache.save('compiled', source, code)
+        namespace = {}
+        exec(code, namespace)
+        make = namespace['make']
+        store(key, make)
+    n.instructions = make(n)
+
+def program_source(program):
+    # Python source for a function that takes a node and returns a function
+    # for each of its instructions, with the operands baked in. Each one does
+    # exactly what the Node method for its opcode does.
+    lines = ["def make(n):"]
+    names = []
+    for i, op in enumerate(program):
+        name = f"i{i}"
+        names.append(name)
+        body = instruction_source(op, i, len(program))
+        if body is None:
+            # Errors are left to the interpreter, so they are raised at the
+            # same point.
+            lines.append(f"    {name} = n.compile_instruction(n.program[{i}])")
+            continue
+        lines.append(f"    def {name}():")
+        lines.extend(f"        {line}" for line in body)
+    lines.append(f"    return [{', '.join(names)}]")
+    return '\n'.join(lines) + '\n'
+
+def clamp_source(target, value):
+    return f"{target} = {node.MAX_N} if {value} > {node.MAX_N} else {node.MIN_N} if {value} < {node.MIN_N} else {value}"
+
+def value_source(operand):
+    # Lines that set value the way get_value does, returning early if a port
+    # has nothing to read. Returns None for an invalid operand.
+    kind, arg = operand
+    if kind == node.IMMEDIATE:
+        return ["n.mode = 'RUN'", f"value = {arg}"]
+    if kind == node.ACC:
+        return ["n.mode = 'RUN'", "value = n.acc"]
+    if kind == node.NIL:
+        return ["n.mode = 'RUN'", "value = 0"]
+    if kind == node.LAST:
+        # On TIS-100, an unset LAST returns 0.
+        return ["n.mode = 'READ'",
+                "if n.last is None:",
+                "    value = 0",
+                "else:",
+                "    value = n.read_port(n.last)",
+                "    if value is None:",
+                "        return"]
+    if kind == node.PORT:
+        return ["n.mode = 'READ'",
+                f"value = n.read_port({arg!r})",
+                "if value is None:",
+                "    return"]
+    return None
+
+def instruction_source(op, i, size):
+    # The body of the function for one instruction, or None if it has to be
+    # interpreted.
+    name = op[0]
+    advance = ["n.step += 1", "n.cycle += 1"]
+    if name == 'NOP':
+        return ["n.mode = 'RUN'"] + advance
+    if name == 'SWP':
+        return ["n.acc, n.bak = n.bak, n.acc", "n.mode = 'RUN'"] + advance
+    if name == 'SAV':
+        return ["n.bak = n.acc", "n.mode = 'RUN'"] + advance
+    if name == 'NEG':
+        return ["n.mode = 'RUN'", "n.acc = -n.acc"] + advance
+    if name == 'HCF':
+        return ["n.cluster.go = False"]
+    if name in ('ADD', 'SUB'):
+        value = value_source(op[1])
+        if value is None:
+            return None
+        sign = '+' if name == 'ADD' else '-'
+        return value + [f"acc = n.acc {sign} value", clamp_source("n.acc", "acc")] + advance
+    if name == 'MOV':
+        value = value_source(op[1])
+        kind, dest = op[2]
+        if value is None or kind in (node.IMMEDIATE, node.INVALID):
+            return None
+        body = ["if n.ready_to_write:", "    return"] + value
+        if kind == node.ACC:
+            return body + ["n.mode = 'RUN'", "n.acc = value"] + advance
+        if kind == node.NIL:
+            return body + ["n.mode = 'RUN'"] + advance
+        if kind == node.LAST:
+            # Sending to an unset LAST hangs.
+            body += ["if n.last is None:",
+                     "    n.mode = 'WRTE'",
+                     "    return",
+                     "n.write = n.last"]
+        else:
+            body.append(f"n.write = {dest!r}")
+        return body + ["n.mode = 'WRTE'", "n.output = value", "n.cycle += 1"]
+    if name == 'JMP':
+        if op[2] is None:
+            return None
+        return ["n.mode = 'RUN'", f"n.step = {op[2]}", "n.cycle += 1"]
+    if name in ('JEZ', 'JNZ', 'JGZ', 'JLZ'):
+        if op[2] is None:
+            return None
+        test = {'JEZ': '==', 'JNZ': '!=', 'JGZ': '>', 'JLZ': '<'}[name]
+        return ["n.mode = 'RUN'",
+                "n.cycle += 1",
+                f"if n.acc {test} 0:",
+                f"    n.step = {op[2]}",
+                "else:",
+                "    n.step += 1"]
+    if name == 'JRO':
+        value = value_source(op[1])
+        if value is None:
+            return None
+        # The instruction only runs when step is at it, so the offset is
+        # from a known step.
+        return (["n.mode = 'RUN'"] + value +
+                [f"n.step = max(min({i} + value, {size - 1}), 0)", "n.cycle += 1"])
+    return None
+
+def compile_cycle(c):
+    # A function that runs one cycle of a linked cluster, as the loops in
+    # NodeCluster.run_once do, and returns whether it made progress. Every
+    # active node gets its own lines, with its instructions looked up once,
+    # so the cycle runs as one function call instead of several per node.
+    source = cycle_source(c.active)
+    key = hashlib.sha1(source.encode()).hexdigest()
+    make = cached(key)
+    if make is None:
+        namespace = {}
+        exec(compile(source, "<cycle>", 'exec'), namespace)
+        make = namespace['make']
+        store(key, make)
+    return make(c, [n for n, _, _ in c.active])
+
+def cycle_source(active):
+    # Python source for a function that takes a cluster and its active
+    # nodes, and returns a function running one cycle of them. Progress is
+    # whether any tracked node's cycle count changed over the whole cycle.
+    lines = ["def make(c, nodes):", "    add_output = c.add_output"]
+    run = ["    def cycle():"]
+    tracked = [i for i, (_, _, counts) in enumerate(active) if counts]
+    run.extend(f"        c{i} = n{i}.cycle" for i in tracked)
+    for i, (n, output, _) in enumerate(active):
+        lines.append(f"    n{i} = nodes[{i}]")
+        if n.memory or isinstance(n, node.InputNode):
+            lines.append(f"    run{i} = n{i}.exe")
+            run.append(f"        run{i}()")
+        elif len(n.instructions) == 1:
+            lines.append(f"    run{i} = n{i}.instructions[0]")
+            run.append(f"        run{i}()")
+        else:
+            lines.append(f"    run{i} = n{i}.instructions")
+            run.append(f"        run{i}[n{i}.step % {len(n.instructions)}]()")
+        if output:
+            run.extend([f"        if n{i}.acc is not None:",
+                        f"            add_output({output!r}, n{i}.acc)",
+                        f"            n{i}.acc = None"])
+    for i in range(len(active)):
+        run.extend([f"        write = n{i}.write and (n{i}.output is not None)",
+                    f"        if n{i}.ready_to_write and not write:",
+                    f"            n{i}.step += 1",
+                    f"            n{i}.cycle += 1",
+                    f"        n{i}.ready_to_write = write"])
+    progress = ' or '.join(f"n{i}.cycle != c{i}" for i in tracked) or 'False'
+    run.append(f"        return {progress}")
+    return '\n'.join(lines + run + ["    return cycle"]) + '\n'
@@ -0,0 +1,279 @@
+#! /usr/bin/env python3
+
+import argparse
+import asyncio
+import collections
+import io
+import json
+import multiprocessing
+import os
+import re
+import stat
+import sys
+import cache
+import loader
+
+# The most sets of layouts each worker keeps a cluster built for.
+WARM = 32
+# The longest request line, in bytes.
+MAX_LINE = 1 << 24
+# Options a job can pass on to NodeCluster, and a check of each one's value.
+OPTIONS = {
+    'compiled': lambda value: value is None or isinstance(value, bool),
+    'fail_fast': lambda value: value is None or isinstance(value, bool),
+    'max_cycles': lambda value: value is None or (type(value) is int and value >= 0),
+}
+
+# The emulator reports errors by printing them in colour.
+COLOUR_RE = re.compile(r'\033\[[0-9;]*m')
+
+def score(job, warm):
+    # Run a program against each of its layouts, both given as text, on a
+    # cluster kept from earlier jobs with the same layouts and options.
+    layouts, program, options = job
+    summary = {
+        'passed': False,
+        'cycles': None,
+        'nodes': None,
+        'instructions': None,
+        'results': [],
+        'error': None,
+    }
+    key = (tuple(layouts), tuple(sorted(options.items())))
+    # Anything the emulator prints is taken as the error, and kept off the
+    # daemon's own output.
+    printed = io.StringIO()
+    stdout, sys.stdout = sys.stdout, printed
+    try:
+        if key in warm:
+            warm.move_to_end(key)
+        else:
+            parsed = [loader.parse_layout(text.splitlines()) for text in layouts]
+            warm[key] = (loader.create_cluster(parsed[0], **options), parsed)
+            if len(warm) > WARM:
+                warm.popitem(last=False)
+        c, parsed = warm[key]
+        c.load_program(program)
+        result = loader.run_tests(c, parsed)
+    except (Exception, SystemExit) as e:
+        # The emulator exits on malformed layouts and programs, and a few
+        # malformed programs make it raise an exception instead. Either way
+        # the worker carries on with the next job, on a fresh cluster.
+        warm.pop(key, None)
+        message = COLOUR_RE.sub('', printed.getvalue()).strip()
+        if not message and not isinstance(e, SystemExit):
+            message = f"{type(e).__name__}: {e}"
+        summary['error'] = message or str(e) or type(e).__name__
+        return summary
+    finally:
+        sys.stdout = stdout
+    summary['passed'] = result.passed
+    summary['cycles'] = result.cycles
+    summary['nodes'] = result.nodes
+    summary['instructions'] = result.instructions
+    summary['results'] = [{'passed': r.passed, 'cycles': r.cycles} for r in result.results]
+    return summary
+
+def serve(connection):
+    # A worker process: score each job it is sent until the pipe is closed.
+    # Submitted programs are mostly only ever scored once, so they aren't
+    # worth caching.
+    cache.enabled = False
+    warm = collections.OrderedDict()
+    try:
+        while True:
+            connection.send(score(connection.recv(), warm))
+    except (EOFError, KeyboardInterrupt):
+        pass
+
+class Worker:
+    """ A worker process and the pipe jobs are sent to it through. Workers
+    are forked where possible, so they start with the emulator imported.
+    """
+    def __init__(self, context):
+        self.connection, child = context.Pipe()
+        self.process = context.Process(target=serve, args=(child,), daemon=True)
+        self.process.start()
+        child.close()
+
+    async def run(self, job, timeout):
+        # Send the worker a job and wait up to timeout seconds for its
+        # summary, without blocking the event loop.
+        loop = asyncio.get_running_loop()
+        ready = loop.create_future()
+        fd = self.connection.fileno()
+        loop.add_reader(fd, lambda: ready.done() or ready.set_result(None))
+        try:
+            self.connection.send(job)
+            await asyncio.wait_for(ready, timeout)
+        finally:
+            loop.remove_reader(fd)
+        return self.connection.recv()
+
+    def stop(self):
+        self.connection.close()
+        if self.process.is_alive():
+            self.process.terminate()
+        self.process.join()
+
+class Pool:
+    """ Warm workers, each running one job at a time. Jobs past the number of
+    workers wait their turn, up to a limit, after which they are turned away
+    at once instead of waiting.
+    """
+    def __init__(self, size, queue, timeout):
+        methods = multiprocessing.get_all_start_methods()
+        self.context = multiprocessing.get_context('fork' if 'fork' in methods else None)
+        self.idle = asyncio.Queue()
+        for _ in range(size):
+            self.idle.put_nowait(Worker(self.context))
+        # The most jobs waiting for a worker.
+        self.queue = queue
+        self.waiting = 0
+        # The longest a job may run for, in seconds.
+        self.timeout = timeout
+
+    async def run(self, request):
+        # Score a request, given as a dictionary read from a line of JSON, and
+        # return the reply.
+        reply = {'id': request.get('id'), 'status': 'done'}
+        try:
+            layouts = request['layout']
+            if isinstance(layouts, str):
+                layouts = [layouts]
+            program = request['program']
+            timeout = min(float(request.get('timeout', self.timeout)), self.timeout)
+            if not layouts or not all(isinstance(text, str) for text in layouts + [program]):
+                raise TypeError
+        except (KeyError, TypeError, ValueError):
+            return {**reply, 'status': 'error', 'error': "A job needs a layout, or a list of layouts, and a program, as text."}
+        options = {key: request[key] for key in OPTIONS if key in request}
+        if not all(check(options.get(key)) for key, check in OPTIONS.items()):
+            return {**reply, 'status': 'error', 'error': "compiled and fail_fast must be true or false, and max_cycles a number of cycles or null."}
+        if self.idle.empty() and self.waiting >= self.queue:
+            return {**reply, 'status': 'busy'}
+        self.waiting += 1
+        try:
+            worker = await self.idle.get()
+        finally:
+            self.waiting -= 1
+        try:
+            summary = await worker.run((layouts, program, options), timeout)
+            if summary['error']:
+                reply['status'] = 'error'
+            return {**reply, **summary}
+        except asyncio.TimeoutError:
+            worker = self.replace(worker)
+            return {**reply, 'status': 'timeout'}
+        except (EOFError, OSError):
+            worker = self.replace(worker)
+            return {**reply, 'status': 'error', 'error': "The worker running the job stopped."}
+        except asyncio.CancelledError:
+            worker = self.replace(worker)
+            raise
+        finally:
+            self.idle.put_nowait(worker)
+
+    def replace(self, worker):
+        # A worker still busy with a job it was given can't be given another,
+        # so it is stopped and a new one is started in its place.
+        worker.stop()
+        return Worker(self.context)
+
+    def close(self):
+        while not self.idle.empty():
+            self.idle.get_nowait().stop()
+
+async def handle(pool, reader, write):
+    # Read requests, one line of JSON each, and start scoring each as soon as
+    # it arrives. Replies are written as their jobs finish, so they can be in
+    # a different order to the requests, and carry the id they were sent with.
+    tasks = set()
+
+    async def reply(line):
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError
+        except ValueError:
+            result = {'id': None, 'status': 'error', 'error': "Malformed request. Each line must be a JSON object."}
+        else:
+            result = await pool.run(request)
+        await write(json.dumps(result) + '\n')
+
+    try:
+        while line := await reader.readline():
+            if line.strip():
+                task = asyncio.create_task(reply(line))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.wait(tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+async def serve_stdio(pool):
+    # Take requests on standard input and reply on standard output, until
+    # standard input is closed and every job has finished.
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader(limit=MAX_LINE)
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+
+    async def write(text):
+        sys.stdout.write(text)
+        sys.stdout.flush()
+
+    await handle(pool, reader, write)
+
+async def serve_socket(pool, path):
+    # Take requests from any number of connections to a Unix socket, each
+    # getting the replies to its own requests.
+    async def connected(reader, writer):
+        async def write(text):
+            writer.write(text.encode())
+            await writer.drain()
+        try:
+            await handle(pool, reader, write)
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    # A socket left behind by a daemon that didn't shut down is replaced.
+    if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+        os.unlink(path)
+    server = await asyncio.start_unix_server(connected, path, limit=MAX_LINE)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        os.unlink(path)
+
+async def main(args):
+    pool = Pool(args.jobs, args.queue, args.timeout)
+    try:
+        if args.socket:
+            await serve_socket(pool, args.socket)
+        else:
+            await serve_stdio(pool)
+    finally:
+        pool.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Score TIS-100 programs sent as lines of JSON, with worker processes kept running between jobs.')
+    parser.add_argument('--socket', type=str,
+        help="Listen on a Unix socket at this path, instead of reading jobs from standard input and replying on standard output.")
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+        help="The number of worker processes, and so the most jobs run at once. Defaults to the number of CPUs.")
+    parser.add_argument('-q', '--queue', type=int, default=256,
+        help="The most jobs waiting for a worker. Jobs sent past this are replied to as busy straight away. Defaults to 256.")
+    parser.add_argument('-t', '--timeout', type=float, default=10,
+        help="The most seconds a job may run for. Jobs can ask for less. Defaults to 10.")
+
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(main(args))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,127 @@
+import curses
+import textwrap
+
+# The most frames drawn per second. At higher speeds, only some cycles are
+# drawn, so drawing never holds the emulator back.
+FRAME_RATE = 60
+
+class Renderer:
+    """ Draws a cluster on a curses screen. Each node's box is remembered
+    along with the registers it shows, and each frame only redraws the
+    boxes, output lines and image pixels that changed since the last one.
+    """
+    def __init__(self, cluster, screen):
+        self.cluster = cluster
+        self.screen = screen
+        # Colours for the image, registered once.
+        curses.init_pair(1, -1, 0)
+        curses.init_pair(2, -1, 4)  # Using blue instead of light gray
+        curses.init_pair(3, -1, 7)
+        curses.init_pair(4, 0, 1)
+        self.colors = [curses.A_NORMAL] + [curses.color_pair(i) for i in range(1, 5)]
+        # In debug mode, the border with inputs and outputs is shown too.
+        self.offset = 0 if cluster.debug else 1
+        box = cluster.nodes[1][1].__repr__().split('\n')
+        self.box_height = len(box)
+        self.box_width = len(box[0])
+        # The row the grid starts at, below the cycle count and any inputs.
+        self.top = 1 + (len(cluster.inputs) if cluster.debug else 0)
+        self.clear()
+
+    def clear(self):
+        # Forget what is on the screen, so the next frame redraws everything.
+        self.screen.clear()
+        self.boxes = {}
+        self.output_lengths = None
+        self.lines = []
+        self.pixels = {}
+
+    def put(self, row, col, text, attr=curses.A_NORMAL):
+        try:
+            self.screen.addstr(row, col, text, attr)
+        except curses.error:
+            # Text that doesn't fit on the screen is cut off.
+            pass
+
+    def box_key(self, n):
+        # Everything a node's box shows, to tell when it needs redrawing.
+        if n.memory:
+            return (n, tuple(n.get_stack(i) for i in range(8)))
+        if n.dead:
+            return (n, )
+        step = n.step % len(n.instructions) if n.instructions else 0
+        try:
+            idle = 100 - round((n.cycle * 100) / self.cluster.cycle)
+        except ZeroDivisionError:
+            idle = 0
+        return (n, n.acc, n.bak, n.last, n.mode, n.read, n.write, n.output, step, idle)
+
+    def draw(self):
+        c = self.cluster
+        self.put(0, 0, f"Cycle: {c.cycle}")
+        rows = range(self.offset, c.height + 2 - self.offset)
+        columns = range(self.offset, c.width + 2 - self.offset)
+        if c.debug and not self.boxes:
+            for i, ((x, y), values) in enumerate(c.inputs.items()):
+                # Streamed inputs can't be shown without consuming them.
+                if isinstance(values, (list, tuple)):
+                    values = ' '.join(str(value) for value in values)
+                else:
+                    values = "..."
+                self.put(i + 1, 0, f"({x}, {y}): {values}")
+        for y in rows:
+            for x in columns:
+                n = c.nodes[y][x]
+                key = self.box_key(n)
+                if self.boxes.get((x, y)) == key:
+                    continue
+                self.boxes[(x, y)] = key
+                row = self.top + (y - self.offset) * self.box_height
+                col = (x - self.offset) * self.box_width
+                for i, line in enumerate(n.__repr__().split('\n')):
+                    self.put(row + i, col, line)
+        self.draw_outputs(self.top + len(rows) * self.box_height)
+        if c.image:
+            self.draw_image(c.width * self.box_width)
+        self.screen.refresh()
+
+    def draw_outputs(self, top):
+        # The output values below the grid, wrapped to the screen.
+        c = self.cluster
+        lengths = [c.output_counts.get(port, 0) for port in c.outputs]
+        if lengths == self.output_lengths:
+            return
+        self.output_lengths = lengths
+        height, width = self.screen.getmaxyx()
+        # Values past the bottom of the screen are never seen, so long
+        # outputs aren't joined in full every frame.
+        shown = max(height - top, 0) * width // 2 + 1
+        lines = []
+        for x, y in c.outputs:
+            values = c.output_lists[(x, y)][:shown]
+            output_list = ' '.join(str(value) for value in values)
+            if c.output_counts.get((x, y), 0) > len(values):
+                output_list += " ..."
+            if c.debug:
+                test_list = ' '.join(str(value) for value in c.test_outputs[(x, y)])
+                lines.append(f"({x}, {y}): {test_list}")
+                output_list = f"({x}, {y}): {output_list}"
+            lines.extend(textwrap.wrap(output_list, width) or [""])
+        for i, line in enumerate(lines):
+            if i < len(self.lines) and self.lines[i] == line:
+                continue
+            try:
+                self.screen.move(top + i, 0)
+                self.screen.clrtoeol()
+            except curses.error:
+                pass
+            self.put(top + i, 0, line)
+        self.lines = lines
+
+    def draw_image(self, left):
+        for y, row in enumerate(self.cluster.image):
+            for x, value in enumerate(row):
+                if self.pixels.get((x, y)) == value:
+                    continue
+                self.pixels[(x, y)] = value
+                self.put(y, left + x, " ", self.colors[value] if 0 <= value < len(self.colors) else curses.A_NORMAL)
@@ -0,0 +1,282 @@
+import re
+import sys
+import time
+import cache
+import cluster
+
+# Lines after the grid in a layout file, for inputs, outputs and rows of the
+# test image.
+INPUT_RE = re.compile(r'^I(\d+)(?:\s+([A-Za-z]+))?(?:\s+(-?\d+(?:\s+-?\d+)*))?$')
+OUTPUT_RE = re.compile(r'^O(\d+)(?:\s+([A-Za-z]+))?(?:\s+(-?\d+(?:\s+-?\d+)*))?$')
+IMAGE_RE = re.compile(r'^(\d+)$')
+
+class Layout:
+    """ The shape of a node cluster and what is connected to it. Node indices
+    are numbered from 0 starting in the upper left and going across then down,
+    as with the command line options.
+    """
+    def __init__(self, width=4, height=3, input=None, output=None, output_image=None, memory=None, dead=None, data=None, test=None, test_image=None):
+        self.width = width
+        self.height = height
+        # Node indices with an input, output, or image output connected.
+        self.input = input if input is not None else []
+        self.output = output if output is not None else []
+        self.output_image = output_image
+        # Node indices that are stack memory or dead nodes.
+        self.memory = memory if memory is not None else []
+        self.dead = dead if dead is not None else []
+        # Input data and test data for each input and output, in order. Each
+        # entry is either a string of values or an iterable of integers.
+        self.data = data
+        self.test = test
+        # Rows of pixel values to compare the output image against.
+        self.test_image = test_image if test_image is not None else []
+
+def read_data(file, line):
+    # Lazily yield the integers on one line of a data file. The file is read
+    # in small chunks, so a long input stream never sits in memory. The file
+    # is left open, for the caller to close.
+    number = re.compile(r'-?\d+')
+    current = 0
+    pending = ""
+    while current <= line:
+        chunk = file.read(4096)
+        if not chunk:
+            if current == line:
+                for value in number.findall(pending):
+                    yield int(value)
+            break
+        lines = (pending + chunk).split('\n')
+        pending = lines.pop()
+        for text in lines:
+            if current == line:
+                for value in number.findall(text):
+                    yield int(value)
+            current += 1
+        if current == line:
+            # Hold back a number that may continue in the next chunk.
+            split = re.search(r'-?\d*$', pending).start()
+            for value in number.findall(pending[:split]):
+                yield int(value)
+            pending = pending[split:]
+        else:
+            pending = ""
+
+def parse_layout(lines):
+    # Parse the lines of a layout file into a Layout. Layouts that have been
+    # parsed before are loaded from the cache instead.
+    text = '\n'.join(lines)
+    cached = cache.load('layout', text)
+    if cached is not None:
+        return Layout(**cached)
+    layout = Layout()
+    try:
+        size = re.findall(r'\d+', lines[0])
+        layout.width = int(size[0])
+        layout.height = int(size[1])
+    except IndexError:
+        print("\033[31mInvalid size definition in layout file.")
+        print("The first line of the layout file must define the node cluster size.")
+        print("Size is defined with integer values as WIDTH HEIGHT.\033[0m")
+        sys.exit()
+    i = 0
+    for line in lines[1:layout.height+1]:
+        line = line.upper()
+        if not all(ch in "CMD" for ch in line):
+            print("\033[31mMalformed layout string.")
+            print("Layout must be come immediately after the size.")
+            print(f"Layout must be exactly {layout.width} characters wide and {layout.height} characters tall.")
+            print("Layouts consist of only the letters C, M, or D.\033[0m")
+            sys.exit()
+        if len(line) != layout.width:
+            print("\033[31mMalformed layout string.")
+            print("Layout must be come immediately after the size.")
+            print(f"Layout must be exactly {layout.width} characters wide and {layout.height} characters tall.")
+            print("Layouts consist of only the letters C, M, or D.\033[0m")
+            sys.exit()
+        for c in line.ljust(layout.width, 'C'):
+            if c.upper() == 'M':
+                layout.memory.append(i)
+            if c.upper() == 'D':
+                layout.dead.append(i)
+            i += 1
+    data_dict = {}
+    test_dict = {}
+    for line in lines[layout.height+1:]:
+        match = INPUT_RE.match(line)
+        if match:
+            layout.input.append(int(match.group(1)))
+            if match.group(3):
+                data_dict[int(match.group(1))] = match.group(3)
+        match = OUTPUT_RE.match(line)
+        if match:
+            if match.group(2) and match.group(2) == "IMAGE":
+                layout.output_image = (layout.height - 1) * layout.width + int(match.group(1))
+
+            else:
+                layout.output.append((layout.height - 1) * layout.width + int(match.group(1)))
+            if match.group(3):
+                test_dict[int(match.group(1))] = match.group(3)
+        match = IMAGE_RE.match(line)
+        if match:
+            layout.test_image.append([int(x) for x in match.group(1)])
+
+
+    if data_dict.keys():
+        layout.data = []
+        for i in sorted(data_dict.keys()):
+            layout.data.append(data_dict[i])
+    if test_dict.keys():
+        layout.test = []
+        for i in sorted(test_dict.keys()):
+            layout.test.append(test_dict[i])
+    cache.save('layout', text, vars(layout))
+    return layout
+
+def read_layout(filename):
+    # Read a layout file into a Layout.
+    with open(filename, 'r') as file:
+        return parse_layout(file.read().splitlines())
+
+def input_position(layout, node):
+    # Inputs are placed above, to the left, below, and to the right of a node,
+    # in that order of precedence.
+    x = node % layout.width + 1
+    y = node // layout.width + 1
+    if y == 1:
+        y = 0
+    elif x == 1:
+        x = 0
+    elif y == layout.height:
+        y = layout.height + 1
+    elif x == layout.width:
+        x = layout.width + 1
+    else:
+        print("Invalid input node.")
+    return x, y
+
+def output_position(layout, node):
+    # Outputs are placed below, to the right, above, and to the left of a
+    # node, in that order of precedence.
+    x = node % layout.width + 1
+    y = node // layout.width + 1
+    if y == layout.height:
+        y = layout.height + 1
+    elif x == layout.width:
+        x = layout.width + 1
+    elif y == 1:
+        y = 0
+    elif x == 1:
+        x = 0
+    else:
+        print("Invalid output node.")
+    return x, y
+
+def create_cluster(layout, **options):
+    # Build a cluster with the inputs, outputs, memory and dead nodes in a
+    # layout. Any options are passed on to NodeCluster.
+    c = cluster.NodeCluster(layout.width, layout.height, **options)
+
+    for node in sorted(layout.output):
+        x, y = output_position(layout, node)
+        c.outputs.append((x, y))
+        c.nodes[y][x].code = c.create_output(x, y)
+        c.nodes[y][x].parse_code()
+        c.nodes[y][x].acc = None
+        c.output_lists[(x, y)] = []
+
+    if layout.output_image is not None:
+        x, y = output_position(layout, layout.output_image)
+        c.outputs.append((x, y))
+        c.nodes[y][x].code = c.create_output(x, y)
+        c.nodes[y][x].parse_code()
+        c.nodes[y][x].acc = None
+        c.output_lists[(x, y)] = []
+        c.image_port = (x, y)
+        c.image = [[0] * c.image_dim[0] for _ in range(c.image_dim[1])]
+
+    for node in layout.memory:
+        x = node % layout.width + 1
+        y = node // layout.width + 1
+        c.memory.append((x, y))
+        c.nodes[y][x].memory = True
+
+    for node in layout.dead:
+        x = node % layout.width + 1
+        y = node // layout.width + 1
+        c.dead.append((x, y))
+        c.nodes[y][x].dead = True
+
+    set_data(c, layout)
+    return c
+
+def set_data(c, layout):
+    # Give a cluster the input data, test data and test image of a layout.
+    # Whatever program is loaded stays loaded, so the same program can be run
+    # against several sets of data without parsing it again.
+    data = layout.data
+    test = layout.test
+    for i, node in enumerate(sorted(layout.input)):
+        x, y = input_position(layout, node)
+        try:
+            if isinstance(data[i], str):
+                c.inputs[(x, y)] = [int(x) for x in re.findall(r'-?\d+', data[i])]
+            else:
+                c.inputs[(x, y)] = data[i]
+        except:
+            print(f"Cound not load data for input {node}.")
+            time.sleep(1)
+            c.inputs[(x, y)] = []
+        c.nodes[y][x] = c.create_input(x, y)
+
+    c.test_outputs = {}
+    for i, node in enumerate(sorted(layout.output)):
+        x, y = output_position(layout, node)
+        try:
+            c.test_outputs[(x, y)] = [int(x) for x in re.findall(r'-?\d+', test[i])]
+        except:
+            pass
+
+    c.test_image = layout.test_image
+    c.reset()
+
+def load_puzzle(layout_filename, program_filename, **options):
+    # Build a cluster from a layout file and load a program file onto it.
+    c = create_cluster(read_layout(layout_filename), **options)
+    c.load(program_filename)
+    return c
+
+def same_shape(c, layout):
+    # Whether a layout has the same size, inputs, outputs, memory and dead
+    # nodes as the one a cluster was built from.
+    if (layout.width, layout.height) != (c.width, c.height):
+        return False
+    outputs = [output_position(layout, node) for node in sorted(layout.output)]
+    if layout.output_image is not None:
+        outputs.append(output_position(layout, layout.output_image))
+    def positions(nodes):
+        return sorted((node % layout.width + 1, node // layout.width + 1) for node in nodes)
+    return (sorted(input_position(layout, node) for node in layout.input) == sorted(c.inputs)
+            and outputs == c.outputs
+            and positions(layout.memory) == sorted(c.memory)
+            and positions(layout.dead) == sorted(c.dead))
+
+def run_tests(c, layouts):
+    # Run the program loaded on a cluster against the data of each layout in
+    # turn, and return its Score. The layouts must only differ in their data,
+    # like the layout1.txt to layout3.txt of each puzzle in test/.
+    results = []
+    for layout in layouts:
+        if not same_shape(c, layout):
+            print("\033[31mAll layouts must have the same size, inputs, outputs, memory and dead nodes.\033[0m")
+            sys.exit()
+        set_data(c, layout)
+        results.append(c.run_headless())
+    return cluster.Score(results)
+
+def run_layouts(layout_filenames, program_filename, **options):
+    # Run a program against several layout files, parsing it only once.
+    layouts = [read_layout(filename) for filename in layout_filenames]
+    c = create_cluster(layouts[0], **options)
+    c.load(program_filename)
+    return run_tests(c, layouts)
@@ -1,3 +1,7 @@
+import array
+import collections.abc
+import functools
+import itertools
 import re
 import sys
 import time
@@ -6,40 +10,78 @@ MAX_N = 999
 MIN_N = -999
 MAX_STACK = 15
 
+# Operand kinds for compiled instructions. Operands are decoded once by
+# parse_code into (kind, argument) pairs so exe() never touches source text.
+IMMEDIATE = 0
+ACC = 1
+NIL = 2
+LAST = 3
+PORT = 4
+INVALID = 5
+
+# Offsets to each neighbour, and the port the neighbour uses to talk back.
+DIRS = {
+    'UP': (0, -1),
+    'DOWN': (0, 1),
+    'LEFT': (-1, 0),
+    'RIGHT': (1, 0)
+}
+RDIRS = {
+    'UP': 'DOWN',
+    'DOWN': 'UP',
+    'LEFT': 'RIGHT',
+    'RIGHT': 'LEFT'
+}
+# When reading from ANY, this is the precedence for ports.
+ANY_ORDER = ('LEFT', 'RIGHT', 'UP', 'DOWN')
+
+# Operand kinds that never touch a port.
+LOCAL_KINDS = (IMMEDIATE, ACC, NIL)
+JUMPS = ('JMP', 'JEZ', 'JNZ', 'JGZ', 'JLZ')
+# How many instructions run_local remembers while looking for a loop.
+MAX_TRACE = 4096
+
 class Node:
-    def __init__(self, cluster, x, y, code="", memory=False, dead=False):
+    # Nodes are kept without a __dict__, since a cluster has many of them and
+    # their registers are read on every cycle.
+    __slots__ = ('x', 'y', 'id', 'cluster', 'code', 'program', 'lines', 'local',
+        'instructions', 'ports', 'breakpoints', 'dead', 'memory', 'acc', 'bak',
+        'last', 'step', 'cycle', 'mode', 'output', 'write', 'read',
+        'ready_to_write', 'stack', 'depth', 'read_hook')
+
+    def __init__(self, cluster, x, y, code="", memory=False, dead=False, id=None, decoded=None):
         self.x = x
         self.y = y
+        # The number of the node in program files, given by the cluster.
+        # Nodes that can't be programmed have none.
+        self.id = id
         self.cluster = cluster
-        self.acc = 0
-        self.bak = 0
-        self.last = None
         self.code = code
+        self.program = []
+        # The source text of each instruction, for reporting.
+        self.lines = []
+        # Whether each instruction runs without touching a port.
+        self.local = []
         self.instructions = []
+        # Neighbouring ports, resolved by link() once the cluster is built.
+        self.ports = {}
         # Breakpoints
         self.breakpoints = []
-        self.parse_code()
-        self.step = 0
-        self.cycle = 0
-        self.mode = 'IDLE'
-        # Output register. Outgoing values are stored here.
-        self.output = None
-        # The register this node is writing to.
-        self.write = None
-        # The register this node is reading from.
-        self.read = None
-        # Whether or not this node is ready to write. Nodes take two cycles to
-        # be ready to write to another node. First, output and write direction
-        # are set. Then at the end of the cycle, the node is marked ready to
-        # write by the cluster. This prevents values from jumping a vast
-        # distance in the cluster.
-        self.ready_to_write = False
+        # Called as read_hook(node, port, neighbour) whenever a value is read.
+        self.read_hook = None
+        # The code can be given already decoded, as from decoded_program().
+        if decoded is None:
+            self.parse_code()
+        else:
+            self.set_program(*decoded)
 
         self.dead = dead
 
-        # For stack memory nodes.
+        # For stack memory nodes. The stack is only allocated once the node is
+        # reset as a memory node.
         self.memory = memory
-        self.stack = []
+        self.stack = None
+        self.reset()
 
     def __repr__(self):
         # Alternative names for nodes or modes for printing.
@@ -83,85 +125,270 @@ class Node:
         return rep
 
     def get_stack(self, i):
-        if i >= len(self.stack):
+        if i >= self.depth:
             return None
         else:
-            return self.stack[-i - 1]
+            return self.stack[self.depth - i - 1]
 
-    def get_value(self, src):
-        try:
-            value = max(min(int(src), MAX_N), MIN_N)
-            self.mode = 'RUN'
-            return value
-        except ValueError:
-            if src == 'ACC':
-                self.mode = 'RUN'
-                return self.acc
-            if src == 'NIL':
-                self.mode = 'RUN'
-                return 0
-            # Otherwise, we're reading from a port.
-            self.mode = 'READ'
-            # On TIS-100, an unset LAST returns 0.
-            if src == 'LAST':
-                if self.last is None:
+    def reset(self):
+        # Return the node to its state before the program started running. The
+        # parsed program and links to neighbours are kept.
+        self.acc = 0
+        self.bak = 0
+        self.last = None
+        self.step = 0
+        self.cycle = 0
+        self.mode = 'IDLE'
+        # Output register. Outgoing values are stored here.
+        self.output = None
+        # The register this node is writing to.
+        self.write = None
+        # The register this node is reading from.
+        self.read = None
+        # Whether or not this node is ready to write. Nodes take two cycles to
+        # be ready to write to another node. First, output and write direction
+        # are set. Then at the end of the cycle, the node is marked ready to
+        # write by the cluster. This prevents values from jumping a vast
+        # distance in the cluster.
+        self.ready_to_write = False
+        # Values on the stack of a stack memory node, in a fixed array of
+        # MAX_STACK values, of which the first depth are in use.
+        self.depth = 0
+        if self.memory and self.stack is None:
+            self.stack = array.array('h', bytes(2 * MAX_STACK))
+
+    def snapshot(self):
+        # Capture the node's registers, to be put back later by restore.
+        return (self.acc, self.bak, self.last, self.step, self.cycle, self.mode,
+                self.output, self.write, self.read, self.ready_to_write,
+                tuple(self.stack[:self.depth]) if self.stack else ())
+
+    def restore(self, state):
+        (self.acc, self.bak, self.last, self.step, self.cycle, self.mode,
+            self.output, self.write, self.read, self.ready_to_write,
+            stack) = state
+        self.depth = len(stack)
+        if stack:
+            if self.stack is None:
+                self.stack = array.array('h', bytes(2 * MAX_STACK))
+            self.stack[:self.depth] = array.array('h', stack)
+
+    def is_active(self):
+        # Whether executing this node can ever do anything.
+        return bool(self.instructions) or self.memory
+
+    def value_waiting(self, src):
+        # Whether a neighbour is offering a value that reading src would take.
+        for port, out_node, rport in self.ports[src]:
+            if out_node.ready_to_write and (out_node.write == rport or out_node.write == 'ANY'):
+                return True
+        return False
+
+    def quiet_state(self):
+        # Whether the cluster can skip this node ahead without running every
+        # cycle. Returns 'RUN' if its next instruction doesn't touch a port,
+        # 'WAIT' if it is stalled on a port that no neighbour is servicing, or
+        # None if it may pass a value this cycle.
+        if self.memory:
+            if self.depth < MAX_STACK and self.value_waiting('ANY'):
+                return None
+            # A stack with values must already be offering the top one.
+            if self.depth and not self.ready_to_write:
+                return None
+            return 'WAIT'
+        if self.ready_to_write:
+            # Waiting for a neighbour to take a value.
+            return 'WAIT'
+        if not self.instructions:
+            return None
+        i = self.step % len(self.instructions)
+        if self.local[i]:
+            return 'RUN'
+        op = self.program[i]
+        if op[0] not in ('MOV', 'ADD', 'SUB', 'JRO'):
+            return None
+        kind, port = op[1]
+        if kind == LAST and self.last is not None:
+            port = self.last
+        elif kind == PORT:
+            pass
+        elif kind in LOCAL_KINDS and op[2][0] == LAST and self.last is None:
+            # A MOV to an unset LAST hangs forever.
+            return 'WAIT'
+        else:
+            return None
+        if self.value_waiting(port):
+            return None
+        return 'WAIT'
+
+    def run_local(self, limit):
+        # Run instructions that don't touch a port for up to limit cycles,
+        # stopping before the first one that does, and return the number of
+        # cycles run. Loops that change ACC by the same amount each time
+        # around are skipped over in one step, for as long as they would
+        # keep taking the same path.
+        instructions = self.instructions
+        local = self.local
+        start = self.cycle
+        # The first visit to each instruction with each value of BAK since
+        # the last skip, as (position in trace, ACC), and the instruction and
+        # ACC before each one run. The step keeps counting past the end of
+        # the program, so visits are keyed by instruction, for loops that wrap
+        # around to be found. Only the first visit is kept, so loops that swap
+        # BAK and only get back to the same state every few times around are
+        # found too.
+        seen = {}
+        trace = []
+        while self.cycle - start < limit:
+            i = self.step % len(instructions)
+            if not local[i]:
+                break
+            key = (i, self.bak)
+            visit = seen.get(key)
+            if visit is not None:
+                first, acc = visit
+                period = len(trace) - first
+                remaining = (limit - (self.cycle - start)) // period
+                repeats = self.loop_repeats(trace[first:], acc, remaining)
+                if repeats:
+                    self.acc += (self.acc - acc) * repeats
+                    self.cycle += period * repeats
+                    seen = {}
+                    trace = []
+                    continue
+            if len(trace) >= MAX_TRACE:
+                seen = {}
+                trace = []
+                visit = None
+            if visit is None:
+                seen[key] = (len(trace), self.acc)
+            trace.append((i, self.acc))
+            instructions[i]()
+        return self.cycle - start
+
+    def loop_repeats(self, trace, acc, most):
+        # How many more times, up to most, the loop in trace can be repeated
+        # exactly. trace starts with ACC at acc and ends back at the same
+        # step with BAK unchanged and ACC at self.acc.
+        delta = self.acc - acc
+        if delta == 0:
+            # The node is back in exactly the same state.
+            return most
+        values = [value for _, value in trace] + [self.acc]
+        for j, (i, value) in enumerate(trace):
+            op = self.program[i]
+            if op[0] in ('ADD', 'SUB'):
+                kind, arg = op[1]
+                if kind == NIL:
+                    arg = 0
+                elif kind != IMMEDIATE:
+                    return 0
+                if op[0] == 'SUB':
+                    arg = -arg
+                if values[j+1] != value + arg:
+                    # ACC was clamped.
                     return 0
+            elif op[0] in ('JEZ', 'JNZ', 'JGZ', 'JLZ'):
+                # The jump must keep going the same way.
+                if value == 0 and op[0] in ('JEZ', 'JNZ'):
+                    return 0
+                if value > 0:
+                    most = min(most, self.fits(value, delta, 1, MAX_N))
+                elif value < 0:
+                    most = min(most, self.fits(value, delta, MIN_N, -1))
+                elif op[0] == 'JGZ':
+                    most = min(most, self.fits(value, delta, MIN_N, 0))
                 else:
-                    src = self.last
-            # Set self.read for printing
-            self.read = src
-            # When reading from ANY, this is the precedence for ports.
-            if src == 'ANY':
-                src = ('LEFT', 'RIGHT', 'UP', 'DOWN')
-            elif src not in ('LEFT', 'RIGHT', 'UP', 'DOWN'):
-                print(f"\033[31mNode {self.get_id()},", end=" ")
-                print(f"step {self.step}: \"{src}\" is not a valid source port.\033[0m")
-                time.sleep(3)
-                sys.exit()
+                    most = min(most, self.fits(value, delta, 0, MAX_N))
+            elif op[0] == 'MOV':
+                if op[2][0] == ACC and op[1][0] != ACC:
+                    return 0
+            elif op[0] == 'JRO':
+                if op[1][0] == ACC:
+                    return 0
+            elif op[0] not in ('NOP', 'JMP'):
+                return 0
+        # ACC must never reach the point where it would be clamped.
+        for value in values[1:]:
+            most = min(most, self.fits(value, delta, MIN_N, MAX_N))
+        return most
+
+    def fits(self, value, delta, low, high):
+        # How many times delta can be added to value while staying between
+        # low and high.
+        if delta > 0:
+            return (high - value) // delta
+        return (value - low) // -delta
+
+    def link(self):
+        # Resolve the neighbour on each port once the cluster grid is final, so
+        # reads don't have to recompute coordinates every cycle. Each entry is
+        # (port, neighbour, the neighbour's port facing us).
+        nodes = self.cluster.nodes
+        self.ports = {}
+        # Hooks are put back by whatever attaches to the cluster afterwards.
+        self.read_hook = None
+        for port, (dx, dy) in DIRS.items():
+            x = self.x + dx
+            y = self.y + dy
+            if 0 <= y < len(nodes) and 0 <= x < len(nodes[y]):
+                self.ports[port] = ((port, nodes[y][x], RDIRS[port]), )
             else:
-                src = (src, )
-            dirs = {
-                'UP': (0, -1),
-                'DOWN': (0, 1),
-                'LEFT': (-1, 0),
-                'RIGHT': (1, 0)
-            }
-            rdirs = {
-                'UP': 'DOWN',
-                'DOWN': 'UP',
-                'LEFT': 'RIGHT',
-                'RIGHT': 'LEFT'
-            }
-            for port in src:
-                value = None
-                x, y = dirs[port]
-                x += self.x
-                y += self.y
-                out_node = self.cluster.nodes[y][x]
-                if (out_node.ready_to_write and
-                        (out_node.write == rdirs[port] or
-                        out_node.write == 'ANY')):
-                    value = out_node.output
-                    self.read = None
-                    # If our port was ANY, set LAST:
-                    if len(src) > 1:
-                        self.last = port
-                    # If out port was ANY, set LAST
-                    if out_node.write == 'ANY':
-                        out_node.last = rdirs[port]
-                    # Set these to None, but don't touch ready_to_write; only
-                    # the cluster controls that.
-                    out_node.write = None
-                    out_node.output = None
-                    # If this is a memory node, pop off the stack.
-                    if out_node.memory:
-                        out_node.stack.pop()
-                    if value is not None:
-                        return value
-            return value
+                self.ports[port] = ()
+        self.ports['ANY'] = tuple(p for port in ANY_ORDER for p in self.ports[port])
+
+    def get_value(self, src):
+        kind, arg = src
+        if kind == IMMEDIATE:
+            self.mode = 'RUN'
+            return arg
+        if kind == ACC:
+            self.mode = 'RUN'
+            return self.acc
+        if kind == NIL:
+            self.mode = 'RUN'
+            return 0
+        # Otherwise, we're reading from a port.
+        self.mode = 'READ'
+        if kind == LAST:
+            # On TIS-100, an unset LAST returns 0.
+            if self.last is None:
+                return 0
+            arg = self.last
+        elif kind == INVALID:
             print(f"\033[31mNode {self.get_id()},", end=" ")
-            print(f"step {self.step}: Invalid argument \"{value}\"\033[0m")
+            print(f"step {self.step}: \"{arg}\" is not a valid source port.\033[0m")
+            time.sleep(3)
             sys.exit()
+        return self.read_port(arg)
+
+    def read_port(self, src):
+        # Set self.read for printing
+        self.read = src
+        for port, out_node, rport in self.ports[src]:
+            if (out_node.ready_to_write and
+                    (out_node.write == rport or
+                    out_node.write == 'ANY')):
+                value = out_node.output
+                self.read = None
+                # If our port was ANY, set LAST:
+                if src == 'ANY':
+                    self.last = port
+                # If out port was ANY, set LAST
+                if out_node.write == 'ANY':
+                    out_node.last = rport
+                # Set these to None, but don't touch ready_to_write; only
+                # the cluster controls that.
+                out_node.write = None
+                out_node.output = None
+                # If this is a memory node, pop off the stack.
+                if out_node.memory:
+                    out_node.depth -= 1
+                if self.read_hook:
+                    self.read_hook(self, port, out_node)
+                if value is not None:
+                    return value
+        return None
 
     # TIS-100 OPCODES
     # Operations will return True if they are able to execute and False if they
@@ -174,13 +401,7 @@ class Node:
         self.cycle += 1
 
     def get_id(self):
-        id = -1
-        for x in range(1, self.y + 1):
-            for y in range(1, self.x + 1):
-                node = self.cluster.nodes[y][x]
-                if not (node.memory or node.dead):
-                    id += 1
-        return id
+        return self.id
 
 
     def mov(self, src, dest):
@@ -192,37 +413,36 @@ class Node:
         if src is None:
             # Was not able to retrieve a value.
             return
-        if dest == 'ACC':
+        kind, dest = dest
+        if kind == ACC:
             self.mode = 'RUN'
             self.acc = src
             self.step += 1
             self.cycle += 1
             return
-        if dest == 'NIL':
+        if kind == NIL:
             # Send the value nowhere. Always succeed.
             self.mode = 'RUN'
             self.step += 1
             self.cycle += 1
             return
         # Attempting to send to LAST when it is not set will cause a hang.
-        if dest == 'LAST':
+        if kind == LAST:
             if self.last is None:
                 self.mode = 'WRTE'
                 return
             else:
                 dest = self.last
-        # For all other moves, set our write and output.
-        if dest in ['UP', 'DOWN', 'LEFT', 'RIGHT', 'ANY']:
-            self.mode = 'WRTE'
-            self.write = dest
-            self.output = src
-            self.cycle += 1
-            return
-        else:
+        elif kind != PORT:
             print(f"\033[31mNode {self.get_id()},", end=" ")
             print(f"step {self.step}: \"{dest}\" is not a valid destination port.\033[0m")
             time.sleep(3)
             sys.exit()
+        # For all other moves, set our write and output.
+        self.mode = 'WRTE'
+        self.write = dest
+        self.output = src
+        self.cycle += 1
 
 
     def swp(self):
@@ -262,65 +482,65 @@ class Node:
         self.step += 1
         self.cycle += 1
 
-    def jmp(self, label, labels):
+    def jmp(self, label, target):
         # Set step to the label value.
         self.mode = 'RUN'
-        if label not in labels:
+        if target is None:
             print(f"\033[31mNode {self.get_id()}, step {self.step}: Undefined label: \"{label}\"\033[0m")
             time.sleep(3)
             sys.exit()
-        self.step = labels[label]
+        self.step = target
         self.cycle += 1
 
-    def jez(self, label, labels):
+    def jez(self, label, target):
         # Conditional JMP if ACC = 0
         self.mode = 'RUN'
         self.cycle += 1
         if self.acc == 0:
-            if label not in labels:
+            if target is None:
                 print(f"\033[31mNode {self.get_id()}, step {self.step}: Undefined label: \"{label}\"\033[0m")
                 time.sleep(3)
                 sys.exit()
-            self.step = labels[label]
+            self.step = target
         else:
             self.step += 1
 
-    def jnz(self, label, labels):
+    def jnz(self, label, target):
         # Conditional JMP if ACC != 0
         self.mode = 'RUN'
         self.cycle += 1
         if self.acc != 0:
-            if label not in labels:
+            if target is None:
                 print(f"\033[31mNode {self.get_id()}, step {self.step}: Undefined label: \"{label}\"\033[0m")
                 time.sleep(3)
                 sys.exit()
-            self.step = labels[label]
+            self.step = target
         else:
             self.step += 1
 
-    def jgz(self, label, labels):
+    def jgz(self, label, target):
         # Conditional JMP if ACC > 0
         self.mode = 'RUN'
         self.cycle += 1
         if self.acc > 0:
-            if label not in labels:
+            if target is None:
                 print(f"\033[31mNode {self.get_id()}, step {self.step}: Undefined label: \"{label}\"\033[0m")
                 time.sleep(3)
                 sys.exit()
-            self.step = labels[label]
+            self.step = target
         else:
             self.step += 1
 
-    def jlz(self, label, labels):
+    def jlz(self, label, target):
         # Conditional JMP if ACC < 0
         self.mode = 'RUN'
         self.cycle += 1
         if self.acc < 0:
-            if label not in labels:
+            if target is None:
                 print(f"\033[31mNode {self.get_id()}, step {self.step}: Undefined label: \"{label}\"\033[0m")
                 time.sleep(3)
                 sys.exit()
-            self.step = labels[label]
+            self.step = target
         else:
             self.step += 1
 
@@ -339,22 +559,20 @@ class Node:
     def exe(self):
         if self.memory:
             # For stack memory, always be trying to get a value.
-            if len(self.stack) < MAX_STACK:
-                value = self.get_value('ANY')
+            if self.depth < MAX_STACK:
+                self.mode = 'READ'
+                value = self.read_port('ANY')
                 # Stack memory nodes can get multiple values in a cycle.
-                while value is not None and len(self.stack) < MAX_STACK:
-                    self.stack.append(value)
-                    value = self.get_value('ANY')
-            if self.stack:
+                while value is not None and self.depth < MAX_STACK:
+                    self.stack[self.depth] = value
+                    self.depth += 1
+                    value = self.read_port('ANY')
+            if self.depth:
                 self.write = 'ANY'
-                self.output = self.get_stack(0)
-        if len(self.instructions) == 0:
-            return
-        instruction = self.instructions[self.step % len(self.instructions)]
-        if type(instruction) is tuple:
-            instruction[0](*instruction[1:])
-        else:
-            instruction()
+                self.output = self.stack[self.depth - 1]
+        instructions = self.instructions
+        if instructions:
+            instructions[self.step % len(instructions)]()
 
     def strip_comments(self, code):
         code = [line.split('#')[0] for line in code]
@@ -373,13 +591,39 @@ class Node:
                 new_code.append(line)
         return (labels, new_code)
 
+    def parse_operand(self, operand):
+        # Decode a source or destination operand into (kind, argument).
+        # Immediates are clamped here so reading them costs nothing at runtime.
+        try:
+            return (IMMEDIATE, max(min(int(operand), MAX_N), MIN_N))
+        except ValueError:
+            pass
+        if operand == 'ACC':
+            return (ACC, None)
+        if operand == 'NIL':
+            return (NIL, None)
+        if operand == 'LAST':
+            return (LAST, None)
+        if operand in DIRS or operand == 'ANY':
+            return (PORT, operand)
+        # Invalid operands only raise an error if they are ever executed.
+        return (INVALID, operand)
+
     def parse_code(self):
+        if not self.code:
+            # Most nodes in a cluster have no code.
+            self.set_program([], [], [])
+            return
         code = self.code
         code = code.upper().split('\n')
         code = self.strip_comments(code)
         code = [line.strip() for line in code]
         labels, code = self.find_labels(code)
-        instructions = []
+        self.breakpoints = []
+        # The decoded program, as (opcode, operands...) tuples. Label targets
+        # are resolved to steps, or None if the label is undefined.
+        program = []
+        lines = []
         for line in code:
             line = re.split(r'[,\s]+', line)
             if line[0][0] == '!':
@@ -388,36 +632,137 @@ class Node:
                     line = line[1:]
                 else:
                     line[0] = line[0][1:]
-                self.breakpoints.append(len(instructions))
-            if line[0] == 'NOP':
-                instructions.append(self.nop)
+                self.breakpoints.append(len(program))
+            if line[0] in ('NOP', 'SWP', 'SAV', 'NEG', 'HCF'):
+                program.append((line[0], ))
             elif line[0] == 'MOV':
-                instructions.append((self.mov, line[1], line[2]))
-            elif line[0] == 'SWP':
-                instructions.append(self.swp)
-            elif line[0] == 'SAV':
-                instructions.append(self.sav)
-            elif line[0] == 'NEG':
-                instructions.append(self.neg)
-            elif line[0] == 'ADD':
-                instructions.append((self.add, line[1]))
-            elif line[0] == 'SUB':
-                instructions.append((self.sub, line[1]))
-            elif line[0] == 'JMP':
-                instructions.append((self.jmp, line[1], labels))
-            elif line[0] == 'JEZ':
-                instructions.append((self.jez, line[1], labels))
-            elif line[0] == 'JNZ':
-                instructions.append((self.jnz, line[1], labels))
-            elif line[0] == 'JGZ':
-                instructions.append((self.jgz, line[1], labels))
-            elif line[0] == 'JLZ':
-                instructions.append((self.jlz, line[1], labels))
-            elif line[0] == 'JRO':
-                instructions.append((self.jro, line[1]))
-            elif line[0] == 'HCF':
-                instructions.append(self.hcf)
+                program.append((line[0], self.parse_operand(line[1]), self.parse_operand(line[2])))
+            elif line[0] in ('ADD', 'SUB', 'JRO'):
+                program.append((line[0], self.parse_operand(line[1])))
+            elif line[0] in ('JMP', 'JEZ', 'JNZ', 'JGZ', 'JLZ'):
+                program.append((line[0], line[1], labels.get(line[1])))
             else:
                 print(f"\033[31mNode {self.get_id()}: Unknown command: {line[0]} in {' '.join(line)}\033[0m")
                 sys.exit()
-        self.instructions = instructions
+            lines.append(' '.join(line))
+        # A label after the last instruction wraps around to the first one.
+        for i, op in enumerate(program):
+            if op[0] in JUMPS and op[2] is not None:
+                program[i] = (op[0], op[1], op[2] % len(program))
+        self.set_program(program, lines, self.breakpoints)
+
+    def decoded_program(self):
+        # What parse_code made of the code, to be given to set_program
+        # without parsing it again.
+        return (self.program, self.lines, self.breakpoints)
+
+    def set_program(self, program, lines, breakpoints):
+        self.program = program
+        self.lines = lines
+        self.breakpoints = breakpoints
+        self.local = [self.is_local(op) for op in program]
+        self.instructions = [self.compile_instruction(op) for op in program]
+
+    def is_local(self, op):
+        # Whether an instruction always runs in a single cycle without
+        # touching a port. Undefined labels and invalid operands are left to
+        # raise their errors when they run.
+        if op[0] in ('NOP', 'SWP', 'SAV', 'NEG'):
+            return True
+        if op[0] in JUMPS:
+            return op[2] is not None
+        if op[0] in ('ADD', 'SUB', 'JRO'):
+            return op[1][0] in LOCAL_KINDS
+        if op[0] == 'MOV':
+            return op[1][0] in LOCAL_KINDS and op[2][0] in (ACC, NIL)
+        return False
+
+    def compile_instruction(self, op):
+        # Bind an instruction to its opcode method, so exe() is a single call.
+        method = getattr(self, op[0].lower())
+        if len(op) == 1:
+            return method
+        return functools.partial(method, *op[1:])
+
+
+class InputNode(Node):
+    """ An input port on the edge of the cluster. Values are pulled from an
+    iterable one at a time as they are sent, so an input stream can be any
+    length, or generated on the fly, without being held in memory. Values
+    taken from a one-shot iterator after a snapshot of the input are kept,
+    so they can be sent again after a restore.
+    """
+    __slots__ = ('values', 'direction', 'source', 'sent', 'stream', 'taken', 'taken_from')
+
+    def __init__(self, cluster, x, y, values=(), direction='DOWN'):
+        self.values = values
+        self.direction = direction
+        super().__init__(cluster, x, y)
+
+    def reset(self):
+        # Lists and other collections are replayed from the start. One-shot
+        # iterators such as file streams can't be, and stay exhausted.
+        super().reset()
+        self.source = iter(self.values)
+        # How many values have been taken from the source.
+        self.sent = 0
+        # Once a snapshot has been taken of a one-shot iterator, the
+        # iterator, the values taken from it since, and how many values had
+        # been sent before them, so restore can send them again.
+        self.stream = None
+        self.taken = None
+        self.taken_from = 0
+
+    def snapshot(self):
+        if self.stream is None and not isinstance(self.values, collections.abc.Sequence):
+            self.stream = self.source
+            self.taken = []
+            self.taken_from = self.sent
+            self.source = self.record()
+        return (super().snapshot(), self.sent)
+
+    def record(self):
+        # The values left in the stream, kept as they are taken.
+        for value in self.stream:
+            self.taken.append(value)
+            yield value
+
+    def restore(self, state):
+        state, self.sent = state
+        super().restore(state)
+        if isinstance(self.values, collections.abc.Sequence):
+            self.source = itertools.islice(self.values, self.sent, None)
+        elif self.stream is not None:
+            # Every snapshot was taken once values were being kept.
+            again = self.taken[self.sent - self.taken_from:]
+            self.source = itertools.chain(again, self.record())
+
+    def is_active(self):
+        return True
+
+    def quiet_state(self):
+        if self.ready_to_write:
+            return 'WAIT'
+        # Once the source has run out, an input only counts cycles.
+        if self.mode == 'RUN':
+            return 'RUN'
+        return None
+
+    def run_local(self, limit):
+        self.cycle += limit
+        return limit
+
+    def exe(self):
+        # Behaves like a MOV <value> <direction> for each value in turn,
+        # followed by a JRO 0 once the input runs out.
+        if self.ready_to_write:
+            return
+        self.cycle += 1
+        value = next(self.source, None)
+        if value is None:
+            self.mode = 'RUN'
+            return
+        self.sent += 1
+        self.mode = 'WRTE'
+        self.write = self.direction
+        self.output = max(min(int(value), MAX_N), MIN_N)
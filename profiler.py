@@ -0,0 +1,140 @@
+import csv
+import json
+import node
+
+PORTS = ('UP', 'DOWN', 'LEFT', 'RIGHT')
+
+class Profiler:
+    """ Counts what each node in a cluster does. For each node and each of its
+    instructions, it records how many times the instruction ran and how many
+    cycles were spent running or stalled on a read or a write, along with the
+    number of values sent and received on each port.
+
+    The cluster only calls into the profiler once at the start and once at the
+    end of each cycle, so a cluster without one runs at full speed.
+    """
+    def __init__(self, cluster):
+        self.cluster = cluster
+        self.counts = {}
+        self.before = []
+        # The number of cycles counted.
+        self.cycles = 0
+
+    def attach(self):
+        # Start counting from scratch for the nodes currently in the cluster.
+        # Nodes report each value they read through their read_hook.
+        self.counts = {}
+        self.cycles = 0
+        for n, _, _ in self.cluster.active:
+            self.counts[n] = {
+                'run': 0,
+                'read': 0,
+                'write': 0,
+                'sent': dict.fromkeys(PORTS, 0),
+                'received': dict.fromkeys(PORTS, 0),
+                # Executions, and cycles running, reading and writing.
+                'instructions': [[0, 0, 0, 0] for _ in n.instructions],
+            }
+            n.read_hook = self.count_read
+
+    def count_read(self, n, port, out_node):
+        self.counts[n]['received'][port] += 1
+        if out_node in self.counts:
+            self.counts[out_node]['sent'][node.RDIRS[port]] += 1
+
+    def start_cycle(self):
+        self.before = [(n, n.step, n.cycle, n.ready_to_write) for n, _, _ in self.cluster.active]
+
+    def end_cycle(self):
+        self.cycles += 1
+        for n, step, cycle, ready_to_write in self.before:
+            if n.memory:
+                continue
+            counts = self.counts[n]
+            instruction = None
+            if n.instructions:
+                instruction = counts['instructions'][step % len(n.instructions)]
+            advanced = n.cycle - cycle
+            if advanced:
+                counts['run'] += 1
+                # Starting a write takes a cycle, but the instruction only
+                # finishes once the value has been taken.
+                issued = not ready_to_write and bool(n.ready_to_write)
+                if instruction:
+                    instruction[0] += advanced - issued
+                    instruction[1] += 1
+            elif n.mode == 'READ':
+                counts['read'] += 1
+                if instruction:
+                    instruction[2] += 1
+            elif n.mode == 'WRTE':
+                counts['write'] += 1
+                if instruction:
+                    instruction[3] += 1
+
+    def kind(self, n):
+        if isinstance(n, node.InputNode):
+            return 'input'
+        if (n.x, n.y) in self.cluster.outputs:
+            return 'output'
+        if n.memory:
+            return 'memory'
+        return 'compute'
+
+    def report(self):
+        # The counts as a list with an entry per node, in grid order. Compute
+        # nodes have the ID used in program files.
+        report = []
+        for n, counts in self.counts.items():
+            instructions = []
+            for i, (executions, run, read, write) in enumerate(counts['instructions']):
+                instructions.append({
+                    'index': i,
+                    'instruction': n.lines[i],
+                    'executions': executions,
+                    'run': run,
+                    'read': read,
+                    'write': write,
+                })
+            report.append({
+                'id': n.id,
+                'x': n.x,
+                'y': n.y,
+                'kind': self.kind(n),
+                'run': counts['run'],
+                'read': counts['read'],
+                'write': counts['write'],
+                'sent': dict(counts['sent']),
+                'received': dict(counts['received']),
+                'instructions': instructions,
+            })
+        return report
+
+    def write_json(self, file):
+        json.dump({'cycles': self.cycles, 'nodes': self.report()}, file, indent=2)
+
+    def write_csv(self, file):
+        # One row per node with its totals, followed by a row per instruction.
+        writer = csv.writer(file)
+        ports = [f"sent_{port.lower()}" for port in PORTS]
+        ports += [f"received_{port.lower()}" for port in PORTS]
+        writer.writerow(['id', 'x', 'y', 'kind', 'index', 'instruction',
+            'executions', 'run', 'read', 'write'] + ports)
+        for entry in self.report():
+            where = [entry['id'], entry['x'], entry['y'], entry['kind']]
+            transfers = [entry['sent'][port] for port in PORTS]
+            transfers += [entry['received'][port] for port in PORTS]
+            writer.writerow(where + ['', '', '', entry['run'], entry['read'], entry['write']] + transfers)
+            for instruction in entry['instructions']:
+                writer.writerow(where + [instruction['index'], instruction['instruction'],
+                    instruction['executions'], instruction['run'],
+                    instruction['read'], instruction['write']] + [''] * len(transfers))
+
+    def dump(self, filename):
+        # Write the counts to a file, as CSV if it ends in .csv and JSON
+        # otherwise.
+        with open(filename, 'w', newline='') as file:
+            if filename.lower().endswith('.csv'):
+                self.write_csv(file)
+            else:
+                self.write_json(file)
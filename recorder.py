@@ -0,0 +1,370 @@
+import bisect
+import json
+import zlib
+import node
+
+# A trace file starts with MAGIC and a JSON header naming the nodes and
+# outputs. It is followed by chunks, each starting with a keyframe holding the
+# full state of every node and then the changes made by each cycle after it,
+# and ends with the cycle the run finished on. Chunks are compressed
+# separately, so any cycle can be found by decompressing a single chunk.
+MAGIC = b'TIS100TRACE1\n'
+CHUNK = b'C'
+END = b'E'
+
+# The number of cycles between keyframes.
+KEYFRAME_INTERVAL = 1000
+
+# The registers of a node, in the order Node.snapshot returns them.
+FIELDS = ('acc', 'bak', 'last', 'step', 'cycle', 'mode', 'output', 'write',
+    'read', 'ready_to_write', 'stack')
+
+# Strings stored as a single byte.
+STRINGS = ('UP', 'DOWN', 'LEFT', 'RIGHT', 'ANY', 'LAST', 'IDLE', 'RUN', 'READ', 'WRTE')
+
+# Tags for values.
+NONE, FALSE, TRUE, STRING, INT, STACK, DELTA, TEXT = range(8)
+
+def write_varint(out, value):
+    while value >= 0x80:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+
+def write_signed(out, value):
+    write_varint(out, value * 2 if value >= 0 else -value * 2 - 1)
+
+def write_value(out, value, old=None):
+    # Ints that were already ints are stored as the difference from before,
+    # so counters that go up by one take the same bytes every cycle.
+    if value is None:
+        out.append(NONE)
+    elif value is False or value is True:
+        out.append(TRUE if value else FALSE)
+    elif isinstance(value, int):
+        if isinstance(old, int) and not isinstance(old, bool):
+            out.append(DELTA)
+            write_signed(out, value - old)
+        else:
+            out.append(INT)
+            write_signed(out, value)
+    elif isinstance(value, str):
+        if value in STRINGS:
+            out.append(STRING)
+            out.append(STRINGS.index(value))
+        else:
+            text = value.encode()
+            out.append(TEXT)
+            write_varint(out, len(text))
+            out += text
+    else:
+        out.append(STACK)
+        write_varint(out, len(value))
+        for item in value:
+            write_signed(out, item)
+
+class Reader:
+    """ Reads the values written by the functions above from bytes. """
+    def __init__(self, data, pos=0):
+        self.data = data
+        self.pos = pos
+
+    def at_end(self):
+        return self.pos >= len(self.data)
+
+    def bytes(self, size):
+        value = self.data[self.pos:self.pos + size]
+        self.pos += size
+        return value
+
+    def varint(self):
+        value = 0
+        shift = 0
+        while True:
+            byte = self.data[self.pos]
+            self.pos += 1
+            value |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                return value
+            shift += 7
+
+    def signed(self):
+        value = self.varint()
+        return -(value >> 1) - 1 if value & 1 else value >> 1
+
+    def value(self, old=None):
+        tag = self.data[self.pos]
+        self.pos += 1
+        if tag == NONE:
+            return None
+        if tag == FALSE:
+            return False
+        if tag == TRUE:
+            return True
+        if tag == STRING:
+            self.pos += 1
+            return STRINGS[self.data[self.pos - 1]]
+        if tag == INT:
+            return self.signed()
+        if tag == DELTA:
+            return old + self.signed()
+        if tag == TEXT:
+            return self.bytes(self.varint()).decode()
+        return tuple(self.signed() for _ in range(self.varint()))
+
+class Recorder:
+    """ Records everything a cluster does to a trace file, to be looked at
+    later with a Replayer. For each cycle, it stores the registers of each node
+    that changed, the values passed between nodes and the values output.
+
+    Cycles that change the same things in the same way, such as every node
+    waiting, take a couple of bytes together. The cluster calls into the
+    recorder once at the end of each cycle.
+    """
+    def __init__(self, cluster, filename, interval=KEYFRAME_INTERVAL):
+        self.cluster = cluster
+        self.filename = filename
+        self.interval = interval
+        self.file = None
+
+    def attach(self):
+        # Start a new trace of the nodes currently in the cluster, replacing
+        # any earlier one. Nodes report each value they read through their
+        # read_hook, which is shared with a profiler if there is one, and
+        # output values come in as one of the cluster's sinks.
+        self.close()
+        self.nodes = [n for n, _, _ in self.cluster.active]
+        self.index = {n: i for i, n in enumerate(self.nodes)}
+        self.ports = {port: i for i, port in enumerate(self.cluster.outputs)}
+        self.transfers = []
+        self.outputs = []
+        for n in self.nodes:
+            n.read_hook = self.hook(n.read_hook)
+        self.cluster.sinks.append(self.output)
+        header = json.dumps({
+            'nodes': [[n.x, n.y, n.id] for n in self.nodes],
+            'outputs': [list(port) for port in self.cluster.outputs],
+            'interval': self.interval,
+        }).encode()
+        self.file = open(self.filename, 'wb')
+        self.file.write(MAGIC)
+        out = bytearray()
+        write_varint(out, len(header))
+        self.file.write(out + header)
+        self.start_chunk()
+
+    def hook(self, previous):
+        def read_hook(n, port, out_node):
+            self.transfers.append((n, out_node))
+            if previous:
+                previous(n, port, out_node)
+        return read_hook
+
+    def output(self, port, value, cycle):
+        self.outputs.append((self.ports[port], value))
+
+    def start_chunk(self):
+        # Begin a chunk with a keyframe of the current state.
+        self.start = self.cluster.cycle
+        self.states = [node.Node.snapshot(n) for n in self.nodes]
+        self.chunk = bytearray()
+        for state in self.states:
+            for value in state:
+                write_value(self.chunk, value)
+        self.record = None
+        self.repeats = 0
+
+    def end_chunk(self):
+        self.flush_record()
+        data = zlib.compress(bytes(self.chunk), 9)
+        out = bytearray(CHUNK)
+        write_varint(out, self.start)
+        write_varint(out, len(data))
+        self.file.write(out + data)
+
+    def flush_record(self):
+        if self.record is not None:
+            write_varint(self.chunk, self.repeats)
+            self.chunk += self.record
+        self.record = None
+        self.repeats = 0
+
+    def end_cycle(self):
+        record = bytearray()
+        states = self.states
+        snapshot = node.Node.snapshot
+        for i, n in enumerate(self.nodes):
+            state = snapshot(n)
+            old = states[i]
+            if state == old:
+                continue
+            states[i] = state
+            mask = 0
+            values = bytearray()
+            for field, value in enumerate(state):
+                before = old[field]
+                # A register never holds both bools and ints, so a change
+                # from False to 0 can't be missed here.
+                if value != before:
+                    mask |= 1 << field
+                    write_value(values, value, before)
+            write_varint(record, i + 1)
+            write_varint(record, mask)
+            record += values
+        record.append(0)
+        write_varint(record, len(self.transfers))
+        for reader, writer in self.transfers:
+            write_varint(record, self.index[reader])
+            write_varint(record, self.index.get(writer, len(self.nodes)))
+        self.transfers = []
+        write_varint(record, len(self.outputs))
+        for port, value in self.outputs:
+            write_varint(record, port)
+            write_signed(record, value)
+        self.outputs = []
+        # Repeat the last cycle's record if this one is the same.
+        if record == self.record:
+            self.repeats += 1
+        else:
+            self.flush_record()
+            self.record = record
+            self.repeats = 1
+        if self.cluster.cycle - self.start >= self.interval:
+            self.end_chunk()
+            self.start_chunk()
+
+    def close(self):
+        # Finish the trace with the cycle the run is reported as taking.
+        if self.file is None:
+            return
+        self.cluster.sinks.remove(self.output)
+        self.end_chunk()
+        out = bytearray(END)
+        write_varint(out, self.cluster.cycle)
+        out.append(TRUE if self.cluster.passed else FALSE)
+        self.file.write(out)
+        self.file.close()
+        self.file = None
+
+class Replayer:
+    """ Reads a trace file written by a Recorder, and gives the state of the
+    cluster at any cycle of the run. Only the chunk holding that cycle is
+    decompressed.
+    """
+    def __init__(self, filename):
+        with open(filename, 'rb') as file:
+            data = file.read()
+        if not data.startswith(MAGIC):
+            raise ValueError(f"{filename} is not a trace file.")
+        reader = Reader(data, len(MAGIC))
+        header = json.loads(reader.bytes(reader.varint()))
+        self.nodes = [tuple(entry) for entry in header['nodes']]
+        self.outputs = [tuple(port) for port in header['outputs']]
+        self.interval = header['interval']
+        # Where each chunk's data is, by the cycle it starts at.
+        self.starts = []
+        self.chunks = []
+        self.cycles = None
+        self.passed = False
+        while not reader.at_end():
+            tag = reader.bytes(1)
+            if tag == END:
+                self.cycles = reader.varint()
+                self.passed = reader.value()
+                break
+            start = reader.varint()
+            size = reader.varint()
+            self.starts.append(start)
+            self.chunks.append((reader.pos, size))
+            reader.pos += size
+        self.data = data
+        if self.cycles is None:
+            # The run didn't finish, so the trace ends with the last chunk.
+            self.cycles = self.last_cycle()
+
+    def chunk(self, i):
+        pos, size = self.chunks[i]
+        return Reader(zlib.decompress(self.data[pos:pos + size]))
+
+    def keyframe(self, reader):
+        states = []
+        for _ in self.nodes:
+            states.append([reader.value() for _ in FIELDS])
+        return states
+
+    def cycles_in(self, i):
+        # Go through the cycles of a chunk, yielding the cycle number, the
+        # node states after it, the transfers and the outputs.
+        reader = self.chunk(i)
+        states = self.keyframe(reader)
+        cycle = self.starts[i]
+        yield cycle, states, [], []
+        while not reader.at_end():
+            repeats = reader.varint()
+            pos = reader.pos
+            for _ in range(repeats):
+                reader.pos = pos
+                cycle += 1
+                while True:
+                    index = reader.varint()
+                    if not index:
+                        break
+                    state = states[index - 1]
+                    mask = reader.varint()
+                    for field in range(len(FIELDS)):
+                        if mask & (1 << field):
+                            state[field] = reader.value(state[field])
+                transfers = []
+                for _ in range(reader.varint()):
+                    transfers.append((reader.varint(), reader.varint()))
+                outputs = []
+                for _ in range(reader.varint()):
+                    outputs.append((reader.varint(), reader.signed()))
+                yield cycle, states, transfers, outputs
+
+    def last_cycle(self):
+        if not self.chunks:
+            return 0
+        for cycle, _, _, _ in self.cycles_in(len(self.chunks) - 1):
+            pass
+        return cycle
+
+    def named(self, states):
+        # Node states as a dictionary by position, with a dictionary of
+        # registers for each.
+        return {(x, y): dict(zip(FIELDS, state), id=id)
+                for (x, y, id), state in zip(self.nodes, states)}
+
+    def state(self, cycle):
+        # The registers of every node once cycle has run, by position.
+        # Cycle 0 is the state before the first cycle.
+        i = max(bisect.bisect_right(self.starts, cycle) - 1, 0)
+        for current, states, _, _ in self.cycles_in(i):
+            if current >= cycle:
+                break
+        return self.named(states)
+
+    def events(self, cycle):
+        # The values passed between nodes during cycle, as (reader, writer)
+        # positions, and the values output as (output, value).
+        i = max(bisect.bisect_right(self.starts, cycle - 1) - 1, 0)
+        for current, _, transfers, outputs in self.cycles_in(i):
+            if current == cycle:
+                names = [(x, y) for x, y, _ in self.nodes] + [None]
+                return ([(names[reader], names[writer]) for reader, writer in transfers],
+                        [(self.outputs[port], value) for port, value in outputs])
+        return [], []
+
+    def output_lists(self, cycle):
+        # The values each output had produced once cycle had run. Outputs
+        # aren't kept in keyframes, so this reads every chunk up to cycle.
+        output_lists = {port: [] for port in self.outputs}
+        for i, start in enumerate(self.starts):
+            if start >= cycle:
+                break
+            for current, _, _, outputs in self.cycles_in(i):
+                if current > cycle:
+                    break
+                for port, value in outputs:
+                    output_lists[self.outputs[port]].append(value)
+        return output_lists
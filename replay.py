@@ -0,0 +1,67 @@
+#! /usr/bin/env python3
+
+import argparse
+import json
+import sys
+import recorder
+
+def describe(replayer, cycle):
+    # The state of the cluster at a cycle as a dictionary that can be
+    # printed or written as JSON.
+    transfers, outputs = replayer.events(cycle)
+    return {
+        'cycle': cycle,
+        'cycles': replayer.cycles,
+        'passed': replayer.passed,
+        'nodes': [dict(registers, x=x, y=y) for (x, y), registers in replayer.state(cycle).items()],
+        'transfers': [{'reader': list(reader), 'writer': list(writer) if writer else None}
+                      for reader, writer in transfers],
+        'outputs': [{'output': list(port), 'value': value} for port, value in outputs],
+        'output_lists': [{'output': list(port), 'values': values}
+                         for port, values in replayer.output_lists(cycle).items()],
+    }
+
+def show(state):
+    status = "passed" if state['passed'] else "failed"
+    print(f"Cycle {state['cycle']} of {state['cycles']} (test {status}).")
+    for entry in state['nodes']:
+        name = f"({entry['x']}, {entry['y']})"
+        if entry['id'] is not None:
+            name += f" node {entry['id']}"
+        registers = ' '.join(f"{field.upper()} {entry[field]}" for field in recorder.FIELDS
+                             if field != 'stack' or entry[field])
+        print(f"{name}: {registers}")
+    for transfer in state['transfers']:
+        print(f"({transfer['reader'][0]}, {transfer['reader'][1]}) read from {tuple(transfer['writer'])}")
+    for output in state['outputs']:
+        print(f"({output['output'][0]}, {output['output'][1]}) output {output['value']}")
+    for output in state['output_lists']:
+        values = ' '.join(str(value) for value in output['values'])
+        print(f"({output['output'][0]}, {output['output'][1]}): {values}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Show the state of a TIS-100 run recorded with --trace.')
+    parser.add_argument('trace', type=str,
+        help="A trace file written by tis100.py --trace.")
+    parser.add_argument('-c', '--cycle', type=int,
+        help="The cycle to show the state after. 0 is the state before the first cycle. Defaults to the last cycle of the run.")
+    parser.add_argument('--json', action='store_true',
+        help="Print the state as JSON.")
+
+    args = parser.parse_args()
+
+    try:
+        replayer = recorder.Replayer(args.trace)
+    except (OSError, ValueError) as e:
+        print(f"\033[31m{e}\033[0m")
+        sys.exit()
+    cycle = replayer.cycles if args.cycle is None else args.cycle
+    if not 0 <= cycle <= replayer.last_cycle():
+        print(f"\033[31mThe trace only has cycles 0 to {replayer.last_cycle()}.\033[0m")
+        sys.exit()
+    state = describe(replayer, cycle)
+    if args.json:
+        json.dump(state, sys.stdout, indent=2)
+        print()
+    else:
+        show(state)
@@ -0,0 +1,271 @@
+#! /usr/bin/env python3
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+import importlib.util
+import json
+import os
+import re
+import sys
+import cache
+import cluster
+import loader
+
+# How many candidates are given to each worker process at once. Candidates
+# are only stopped early against the front as it was when they were handed
+# out, so keeping few in flight keeps that close to the latest front.
+QUEUE = 2
+# Without --max_cycles, candidates are stopped after this many times the
+# cycles the starting program takes, so one that never finishes can't hold
+# up a worker for ever.
+SLOWDOWN = 10
+
+# A line of code, as its label, its instruction and its comment.
+LINE_RE = re.compile(r'^(\s*[^\s:#]+:\s*)?([^#]*?)(\s*#.*)?$')
+
+def split_line(line):
+    label, instruction, comment = LINE_RE.match(line).groups()
+    return label or "", instruction, comment or ""
+
+def instructions(code):
+    # The indices of the lines of a node's code that hold an instruction.
+    lines = code.split('\n')
+    return lines, [i for i, line in enumerate(lines) if split_line(line)[1].strip()]
+
+def swaps(program):
+    # Every program made by swapping two neighbouring instructions of a node.
+    # Labels stay where they are, so jumps go to the same place.
+    for i, code in program.items():
+        lines, found = instructions(code)
+        for a, b in zip(found, found[1:]):
+            changed = list(lines)
+            first, second = split_line(lines[a]), split_line(lines[b])
+            changed[a] = first[0] + second[1] + first[2]
+            changed[b] = second[0] + first[1] + second[2]
+            yield {**program, i: '\n'.join(changed)}
+
+def deletions(program):
+    # Every program made by removing one instruction. Its label, if it has
+    # one, is kept.
+    for i, code in program.items():
+        lines, found = instructions(code)
+        for a in found:
+            changed = list(lines)
+            label, _, comment = split_line(lines[a])
+            rest = (label + comment).rstrip()
+            changed[a:a + 1] = [rest] if rest else []
+            yield {**program, i: '\n'.join(changed)}
+
+GENERATORS = {
+    'swaps': swaps,
+    'deletions': deletions,
+}
+
+def load_generator(name):
+    # A built-in generator by name, or a function in a Python file given as
+    # path.py:function.
+    if name in GENERATORS:
+        return GENERATORS[name]
+    filename, _, function = name.rpartition(':')
+    if not filename or not os.path.isfile(filename):
+        print(f"\033[31mUnknown generator `{name}'. Use one of {', '.join(GENERATORS)}, or path.py:function.\033[0m")
+        sys.exit()
+    spec = importlib.util.spec_from_file_location('generator', filename)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return getattr(module, function)
+
+def dominates(a, b):
+    # Whether a is at least as good as b in cycles, nodes and instructions.
+    return all(x <= y for x, y in zip(a, b))
+
+def bound(front, nodes, instructions):
+    # The cycles a program with this many nodes and instructions has to beat
+    # to be on the front, or None if it is on it whatever its cycles.
+    return min((cycles for cycles, n, i in front if n <= nodes and i <= instructions), default=None)
+
+# The cluster each worker process keeps between candidates, with the layouts
+# it was built for.
+warm = {}
+
+def start_worker():
+    # Candidates are only ever run once, so they aren't worth caching.
+    cache.enabled = False
+
+def evaluate(job):
+    # Run a candidate against each layout in turn. It is stopped as soon as
+    # an output is wrong, or once it has taken as many cycles as a program on
+    # the front that is no bigger, since it can't be on the front then. A
+    # candidate that runs past most cycles, if given, fails.
+    index, text, layout_filenames, front, most, options = job
+    summary = {
+        'index': index,
+        'program': text,
+        'status': 'passed',
+        'cycles': None,
+        'nodes': None,
+        'instructions': None,
+        'error': None,
+    }
+    key = (tuple(layout_filenames), tuple(sorted(options.items())))
+    try:
+        if key not in warm:
+            warm.clear()
+            layouts = [loader.read_layout(filename) for filename in layout_filenames]
+            warm[key] = (loader.create_cluster(layouts[0], fail_fast=True, **options), layouts)
+        c, layouts = warm[key]
+        c.load_program(text)
+        stats = c.node_stats()
+        summary['nodes'] = len([n for n in stats if n['instructions'] > 0])
+        summary['instructions'] = sum(n['instructions'] for n in stats)
+        best = bound(front, summary['nodes'], summary['instructions'])
+        limits = [limit for limit in (most, best - 1 if best is not None else None) if limit is not None]
+        c.max_cycles = min(limits, default=None)
+        cycles = 0
+        for layout in layouts:
+            loader.set_data(c, layout)
+            result = c.run_headless()
+            cycles = max(cycles, result.cycles)
+            if not result.passed:
+                # Only a candidate stopped by the front is slow. One that
+                # took too long for the search fails.
+                stopped = c.max_cycles is not None and result.cycles > c.max_cycles
+                slow = stopped and best is not None and c.max_cycles == best - 1
+                summary['status'] = 'slow' if slow else 'failed'
+                break
+        summary['cycles'] = cycles
+    except (Exception, SystemExit) as e:
+        # The emulator exits on malformed programs, and a few malformed
+        # programs make it raise an exception instead. Either way the next
+        # candidate is run on a fresh cluster.
+        warm.clear()
+        summary['status'] = 'error'
+        if isinstance(e, SystemExit):
+            summary['error'] = str(e) or type(e).__name__
+        else:
+            summary['error'] = f"{type(e).__name__}: {e}"
+    return summary
+
+def search(program, layout_filenames, generator, jobs=None, rounds=1, limit=None, max_cycles=None, **options):
+    # Look for programs that do better than program, given as the text of a
+    # program file, on every layout. generator is called with a program as a
+    # dictionary of ID: code, and yields changed programs in the same form.
+    # Each round runs the candidates made from the programs that joined the
+    # front in the round before, starting with program itself. Returns the
+    # front, as summaries like those of evaluate sorted by cycles, and a
+    # count of the candidates that ended with each status. Candidates that
+    # take more than max_cycles fail, and without it, those that take more
+    # than SLOWDOWN times as long as program. Options are passed on to
+    # NodeCluster.
+    front = []
+    counts = {'passed': 0, 'failed': 0, 'slow': 0, 'error': 0}
+    # Programs are compared as written by format_program, so the same
+    # program is never run twice.
+    seen = {cluster.format_program(cluster.parse_program(program))}
+    evaluated = 0
+
+    def add(summary):
+        counts[summary['status']] += 1
+        if summary['status'] != 'passed':
+            return False
+        score = (summary['cycles'], summary['nodes'], summary['instructions'])
+        if any(dominates(member['score'], score) for member in front):
+            return False
+        front[:] = [member for member in front if not dominates(score, member['score'])]
+        front.append({**summary, 'score': score})
+        return True
+
+    with ProcessPoolExecutor(max_workers=jobs, initializer=start_worker) as executor:
+        base = executor.submit(evaluate, (0, program, layout_filenames, [], max_cycles, options)).result()
+        if base['status'] == 'error':
+            print(f"\033[31m{base['error']}\033[0m")
+            sys.exit()
+        add(base)
+        added = [base]
+        most_cycles = max_cycles if max_cycles is not None else SLOWDOWN * max(base['cycles'], 1)
+        most = QUEUE * (jobs or os.cpu_count() or 1)
+        for _ in range(rounds):
+            candidates = (cluster.format_program(candidate) for summary in added
+                          for candidate in generator(cluster.parse_program(summary['program'])))
+            added = []
+            pending = set()
+            for text in candidates:
+                if limit is not None and evaluated >= limit:
+                    break
+                if text in seen:
+                    continue
+                seen.add(text)
+                evaluated += 1
+                scores = [member['score'] for member in front]
+                pending.add(executor.submit(evaluate, (evaluated, text, layout_filenames, scores, most_cycles, options)))
+                while len(pending) >= most:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    added += [summary for summary in (future.result() for future in done) if add(summary)]
+            for future in pending:
+                summary = future.result()
+                if add(summary):
+                    added.append(summary)
+            # Only programs still on the front are worth building on.
+            indices = {member['index'] for member in front}
+            added = [summary for summary in added if summary['index'] in indices]
+            if not added:
+                break
+    front.sort(key=lambda member: member['score'])
+    return front, counts
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Search for faster or smaller versions of a TIS-100 program.')
+    parser.add_argument('file', type=str,
+        help="The program to start from.")
+    parser.add_argument('-l', '--layout', type=str, action='append', required=True,
+        help="A layout file with test data to run every candidate against, such as each of the three tests of a puzzle. This argument can be used multiple times.")
+    parser.add_argument('-g', '--generator', type=str, default='swaps',
+        help=f"How candidates are made from a program: {', '.join(GENERATORS)}, or path.py:function for a function in a Python file, which is called with a program as a dictionary of node ID: code and yields changed programs in the same form. Defaults to swaps.")
+    parser.add_argument('-r', '--rounds', type=int, default=1,
+        help="How many times to make candidates from the programs that joined the front in the round before. Defaults to 1.")
+    parser.add_argument('-n', '--limit', type=int,
+        help="The most candidates to run.")
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+        help="The number of worker processes. Defaults to the number of CPUs.")
+    parser.add_argument('--max_cycles', type=int,
+        help=f"Fail candidates that take more than this many cycles on a layout. Defaults to {SLOWDOWN} times the cycles the program to start from takes, so candidates that never finish don't hold up the search.")
+    parser.add_argument('--compiled', action='store_true',
+        help="Run candidates as generated Python code instead of interpreting them.")
+    parser.add_argument('-o', '--output', type=str,
+        help="Write each program on the front to this directory.")
+    parser.add_argument('--json', action='store_true',
+        help="Print the front as JSON instead of one line per program.")
+
+    args = parser.parse_args()
+
+    try:
+        with open(args.file, 'r') as file:
+            program = file.read()
+    except FileNotFoundError:
+        print(f"File `{args.file}' not found.")
+        sys.exit()
+    front, counts = search(program, args.layout, load_generator(args.generator), jobs=args.jobs,
+        rounds=args.rounds, limit=args.limit, max_cycles=args.max_cycles, compiled=args.compiled)
+
+    if args.output:
+        os.makedirs(args.output, exist_ok=True)
+        for member in front:
+            cycles, nodes, instructions = member['score']
+            member['file'] = os.path.join(args.output, f"{cycles}-{nodes}-{instructions}.txt")
+            with open(member['file'], 'w') as file:
+                file.write(member['program'])
+
+    if args.json:
+        print(json.dumps({'counts': counts, 'front': [{key: value for key, value in member.items() if key != 'score'}
+            for member in front]}, indent=2))
+    else:
+        total = sum(counts.values())
+        print(f"Ran {total} program(s): {counts['passed']} passed, {counts['failed']} failed, "
+              f"{counts['slow']} stopped early, {counts['error']} error(s).")
+        for member in front:
+            cycles, nodes, instructions = member['score']
+            name = "base" if member['index'] == 0 else f"candidate {member['index']}"
+            line = f"{cycles} cycle(s), {nodes} node(s), {instructions} instruction(s): {name}"
+            if 'file' in member:
+                line += f" ({member['file']})"
+            print(line)
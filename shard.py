@@ -0,0 +1,351 @@
+import collections
+import functools
+import itertools
+import multiprocessing
+import multiprocessing.connection
+import os
+import threading
+import time
+
+# Rows are split into strips of whole rows, since nodes run in row order
+# across the whole grid. Each worker process runs two strips next to each
+# other, and every worker runs one of its strips at each step:
+#
+#     step   worker 0     worker 1
+#     2      strip 0: 1
+#     3      strip 1: 1
+#     4      strip 0: 2   strip 2: 1
+#     5      strip 1: 2   strip 3: 1
+#
+# Strip k runs cycle c at step 2c + k, so it always runs a cycle after the
+# strip above it and before the strip below it, as it would in a single
+# process, and strips that run at the same time are never next to each
+# other. Workers swap the rows where their strips meet through shared memory
+# between steps.
+#
+# A strip needs at least this many rows, so its top row, which the strip
+# above has to see after the end of a cycle, is never also its bottom row,
+# which the strip below has to see before the end of the cycle.
+MIN_ROWS = 2
+# The most cycles workers run ahead of the cycles the main process has
+# checked. They stop once the main process knows which cycle was the last.
+WINDOW = 1024
+# Flags for each strip's cycles are kept in a ring of this many cycles.
+RING = 2 * WINDOW
+
+# Positions in the control array shared by all processes.
+STOP = 0       # The last cycle of the run, once the main process knows it.
+HALT = 1       # Set between two steps once STOP is, so workers stop together.
+PROCESSED = 2  # The last cycle the main process has checked.
+FAILED = 3     # One more than the index of the first worker to stop on an error.
+REACHED = 4    # For each strip, the last cycle it has finished.
+
+# Flags for a strip's cycle.
+PROGRESS = 1
+HCF = 2
+
+# How ports are stored in shared memory. 0 stands for None.
+PORTS = (None, 'UP', 'DOWN', 'LEFT', 'RIGHT', 'ANY')
+CODES = {port: i for i, port in enumerate(PORTS)}
+# Added to output values, so 0 can stand for None.
+OFFSET = 1 << 20
+# The values stored for each node on a boundary: ready_to_write, write,
+# output, last and depth. These are everything a node reads or changes on a
+# neighbour when it takes a value from it.
+FIELDS = 5
+
+def available():
+    # Workers are forked, so they start with the cluster as it is, nodes'
+    # compiled programs and streamed inputs included.
+    return 'fork' in multiprocessing.get_all_start_methods()
+
+def workers(cluster, shards):
+    # How many worker processes a cluster's rows can be split between.
+    if not available():
+        return 0
+    # Processes sharing a core have to take turns at every step, which is
+    # slower than running the whole grid in one.
+    if (os.cpu_count() or 1) < shards:
+        return 0
+    return min(shards, len(cluster.nodes) // (2 * MIN_ROWS))
+
+def split(weights, parts):
+    # Split rows into parts with about the same total weight each and at least
+    # MIN_ROWS rows, as (top, bottom) ranges.
+    total = sum(weights)
+    before = [0] + list(itertools.accumulate(weights))
+    bounds = [0]
+    for i in range(1, parts):
+        row = bounds[-1] + MIN_ROWS
+        last = len(weights) - MIN_ROWS * (parts - i)
+        while row < last and before[row] < total * i / parts:
+            row += 1
+        bounds.append(row)
+    bounds.append(len(weights))
+    return list(zip(bounds, bounds[1:]))
+
+def end_cycle(nodes):
+    # The end of a cycle in NodeCluster.run_once, for a list of (node,
+    # tracked). Returns whether a tracked node made progress.
+    progress = False
+    for n, tracked in nodes:
+        if n.ready_to_write and not(n.write and (n.output is not None)):
+            n.step += 1
+            n.cycle += 1
+            if tracked:
+                progress = True
+        n.ready_to_write = n.write and (n.output is not None)
+    return progress
+
+class Strip:
+    """ A band of whole rows of a cluster, run by one worker. The end of each
+    cycle for its bottom row is put off until the start of the next cycle, as
+    nodes in the strip below can still take values from it until they have
+    run.
+    """
+    def __init__(self, cluster, index, top, bottom):
+        self.cluster = cluster
+        self.index = index
+        self.active = [(n, output, tracked) for n, output, tracked in cluster.active
+                       if top <= n.y < bottom]
+        self.bottom = [(n, tracked) for n, _, tracked in self.active if n.y == bottom - 1]
+        self.rest = [(n, tracked) for n, _, tracked in self.active if n.y < bottom - 1]
+        # The nodes node_stats reports on, and their cycle counts after each
+        # finished cycle the main process may still ask for.
+        self.programmable = [n for row in cluster.nodes[top:bottom] for n in row
+                             if n.id is not None]
+        self.history = collections.deque()
+        self.progress = False
+        self.hcf = False
+        self.outputs = []
+
+    def run(self, cycle):
+        # Finish the previous cycle, then run this one up to where the end of
+        # the cycle for the bottom row would be. Returns the finished cycle's
+        # (progress, hcf, outputs), or None on the first cycle.
+        finished = None
+        if cycle > 1:
+            progress = end_cycle(self.bottom) or self.progress
+            finished = (progress, self.hcf, self.outputs)
+            self.history.append((cycle - 1, tuple(n.cycle for n in self.programmable)))
+        self.cluster.go = True
+        outputs = []
+        progress = False
+        for n, output, tracked in self.active:
+            current = n.cycle
+            n.exe()
+            if tracked and n.cycle != current:
+                progress = True
+            # Values output are passed on to the main process, which adds them
+            # to the cluster in order.
+            if output and (n.acc is not None):
+                outputs.append((output, n.acc))
+                n.acc = None
+        self.hcf = not self.cluster.go
+        self.progress = end_cycle(self.rest) or progress
+        self.outputs = outputs
+        return finished
+
+    def cycles(self, cycle):
+        # Each programmable node's cycle count once cycle had finished.
+        for finished, counts in self.history:
+            if finished == cycle:
+                return {(n.x, n.y): count for n, count in zip(self.programmable, counts)}
+        return {}
+
+class Boundary:
+    """ Where the strips of two workers meet: the bottom row of one and the
+    top row of the next. Both workers keep a copy of both rows. After a
+    worker runs its strip next to the boundary, it copies both rows to shared
+    memory, including anything its nodes took from the other worker's row,
+    and the other worker copies them back before running its own strip.
+    """
+    def __init__(self, cluster, row, start):
+        self.nodes = [n for n, _, _ in cluster.active if row - 1 <= n.y <= row]
+        self.size = FIELDS * len(self.nodes)
+        # Where each direction's copy is in shared memory.
+        self.down = start
+        self.up = start + self.size
+        self.memory = None
+
+    def send(self, start):
+        values = []
+        for n in self.nodes:
+            values += (1 if n.ready_to_write else 0, CODES[n.write],
+                       0 if n.output is None else n.output + OFFSET, CODES[n.last], n.depth)
+        self.memory[start:start + self.size] = values
+
+    def receive(self, start):
+        values = self.memory[start:start + self.size]
+        for n, (ready, write, output, last, depth) in zip(self.nodes, zip(*[iter(values)] * FIELDS)):
+            n.ready_to_write = ready == 1
+            n.write = PORTS[write]
+            n.output = None if output == 0 else output - OFFSET
+            n.last = PORTS[last]
+            n.depth = depth
+
+def pace(control):
+    # Run between steps by one of the workers: hold the workers back while
+    # they are too far ahead of the main process, and stop them all at once.
+    while not control[STOP] and control[REACHED] - control[PROCESSED] >= WINDOW:
+        time.sleep(0.0005)
+    control[HALT] = control[STOP]
+
+def work(index, upper, lower, above, below, control, flags, barrier, connection):
+    # Run a worker's two strips, upper above lower, until the main process
+    # stops them, then send it each programmable node's cycle count at the
+    # last cycle.
+    strips = (upper, lower)
+    step = 0
+    try:
+        while True:
+            barrier.wait()
+            if control[HALT]:
+                break
+            step += 1
+            strip = strips[step % 2]
+            cycle = (step - strip.index) // 2
+            if cycle < 1:
+                continue
+            if strip is upper and above:
+                above.receive(above.down)
+            if strip is lower and below and cycle > 1:
+                below.receive(below.up)
+            finished = strip.run(cycle)
+            if strip is upper and above:
+                above.send(above.up)
+            if strip is lower and below:
+                below.send(below.down)
+            if finished:
+                progress, hcf, outputs = finished
+                # Outputs are sent before the cycle is marked as reached, so
+                # the main process has them by the time it sees it.
+                if outputs:
+                    connection.send((strip.index, cycle - 1, outputs))
+                flags[strip.index * RING + (cycle - 1) % RING] = (PROGRESS if progress else 0) | (HCF if hcf else 0)
+                control[REACHED + strip.index] = cycle - 1
+                while strip.history and strip.history[0][0] < control[PROCESSED]:
+                    strip.history.popleft()
+        last = control[STOP]
+        connection.send({**upper.cycles(last), **lower.cycles(last)})
+    except (KeyboardInterrupt, threading.BrokenBarrierError):
+        pass
+    except BaseException:
+        # Let the other workers stop too, instead of waiting for this one,
+        # and let the main process know which one it was.
+        if not control[FAILED]:
+            control[FAILED] = index + 1
+        barrier.abort()
+        raise
+
+def run(cluster, count):
+    # Run a linked cluster until it finishes, as NodeCluster.run_headless
+    # does, with its rows split between count worker processes. The cluster
+    # ends up with the same cycle count, outputs and test results as running
+    # it in one process, and each node's cycle count for node_stats.
+    # Raises RuntimeError if a worker stops before the run is over, such as
+    # on an emulator error.
+    weights = [0] * len(cluster.nodes)
+    for n, _, _ in cluster.active:
+        weights[n.y] += 1
+    ranges = split(weights, 2 * count)
+    strips = [Strip(cluster, i, top, bottom) for i, (top, bottom) in enumerate(ranges)]
+    boundaries = [None]
+    size = 0
+    for i in range(1, count):
+        boundary = Boundary(cluster, ranges[2 * i][0], size)
+        boundaries.append(boundary)
+        size += 2 * boundary.size
+    boundaries.append(None)
+    context = multiprocessing.get_context('fork')
+    memory = context.RawArray('i', max(size, 1))
+    for boundary in boundaries[1:-1]:
+        boundary.memory = memory
+    control = context.RawArray('q', REACHED + len(strips))
+    flags = context.RawArray('b', len(strips) * RING)
+    barrier = context.Barrier(count, action=functools.partial(pace, control))
+    processes = []
+    connections = []
+    try:
+        for i in range(count):
+            receiver, sender = context.Pipe(duplex=False)
+            process = context.Process(target=work, daemon=True, args=(i, strips[2 * i],
+                strips[2 * i + 1], boundaries[i], boundaries[i + 1], control, flags, barrier, sender))
+            process.start()
+            sender.close()
+            processes.append(process)
+            connections.append(receiver)
+        sentinels = [process.sentinel for process in processes]
+        # Outputs by cycle, then by strip.
+        outputs = {}
+
+        def stopped(i):
+            # The other workers stop once one does, so name the first.
+            if control[FAILED]:
+                i = control[FAILED] - 1
+            processes[i].join()
+            raise RuntimeError(f"Shard worker {i} stopped with exit code {processes[i].exitcode}")
+
+        def receive(wait):
+            # Take in the outputs workers have sent, first waiting up to wait
+            # seconds for any, and stop if a worker has died.
+            for ready in multiprocessing.connection.wait(connections + sentinels, wait):
+                if ready in sentinels:
+                    stopped(sentinels.index(ready))
+            for connection in connections:
+                while connection.poll():
+                    strip, cycle, values = connection.recv()
+                    outputs.setdefault(cycle, {})[strip] = values
+
+        # The same loop as in run_headless and run_once, taking each cycle's
+        # results from the workers instead of running it.
+        reached = 0
+        while True:
+            cluster.progress = False
+            if cluster.check_tests():
+                cluster.passed = True
+                cluster.go = False
+                cluster.frozen = True
+            elif cluster.fail_fast and cluster.test_failed:
+                cluster.go = False
+                cluster.frozen = True
+            else:
+                cycle = cluster.cycle + 1
+                while reached < cycle:
+                    reached = min(control[REACHED + i] for i in range(len(strips)))
+                    receive(0 if reached >= cycle else 0.001)
+                cluster.cycle = cycle
+                for _, values in sorted(outputs.pop(cycle, {}).items()):
+                    for port, value in values:
+                        cluster.add_output(port, value)
+                for i in range(len(strips)):
+                    flag = flags[i * RING + cycle % RING]
+                    if flag & PROGRESS:
+                        cluster.progress = True
+                    if flag & HCF:
+                        cluster.go = False
+                control[PROCESSED] = cycle
+                if cluster.max_cycles is not None and cycle > cluster.max_cycles:
+                    last = cycle
+                    break
+            if not cluster.progress and cluster.cycle > 1:
+                last = cluster.cycle
+                if cluster.go and not cluster.frozen:
+                    cluster.cycle -= 1
+                break
+        control[STOP] = last
+        for i, connection in enumerate(connections):
+            while True:
+                try:
+                    message = connection.recv()
+                except EOFError:
+                    stopped(i)
+                if isinstance(message, dict):
+                    break
+            for (x, y), cycles in message.items():
+                cluster.nodes[y][x].cycle = cycles
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
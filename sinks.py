@@ -0,0 +1,14 @@
+import json
+
+class StreamSink:
+    """ Writes each value a cluster outputs to a file as soon as it is
+    produced, as a line of JSON with the output's position, the value and the
+    cycle it was output on. Pass one to NodeCluster in sinks, so other
+    programs can read the values from a pipe while the emulator runs.
+    """
+    def __init__(self, file):
+        self.file = file
+
+    def __call__(self, port, value, cycle):
+        self.file.write(json.dumps({'output': list(port), 'value': value, 'cycle': cycle}) + "\n")
+        self.file.flush()
@@ -1,5 +1,11 @@
 #!/usr/bin/env bash
 
+# Runs use a cache of their own, so they neither depend on nor change the
+# cache in ~/.cache/tis100.
+TIS100_CACHE="$(mktemp -d)"
+export TIS100_CACHE
+trap 'rm -rf "$TIS100_CACHE"' EXIT
+
 declare -A results
 
 results["01/self-test_diagnostic"]="83 83 83"
@@ -54,3 +60,526 @@ for puzzle in $(printf "%s\n" "${!results[@]}" | sort); do
 		done
 	fi
 done
+
+# A program run against all the layouts of a puzzle is scored on the slowest,
+# and layouts with different inputs, outputs, memory or dead nodes can't be
+# run together.
+result="$(python tis100.py test/05/signal_multiplexer.txt -l test/05/layout1.txt -l test/05/layout2.txt -l test/05/layout3.txt | tail -1)"
+mixed="$(python tis100.py test/02/signal_amplifier.txt -l test/02/layout1.txt -l test/01/layout1.txt)"
+if [ "$result" == "Score: 422 cycle(s), 6 node(s), 25 instruction(s)." ] && echo "$mixed" | grep -q "All layouts must have the same" && ! echo "$mixed" | grep -q "Score"; then
+	echo "PASS: layouts"
+else
+	echo "FAIL: layouts"
+fi
+
+# Input data streamed from a file, with a line for each input, or piped in
+# for a single input, has to give the same run as data in the layout. Values
+# have to be read as they are sent, not all at the start, and the files closed
+# once the run is over.
+data="$(mktemp -d)"
+result=""
+for puzzle in 05/signal_multiplexer:1 02/signal_amplifier:2; do
+	program="test/${puzzle%:*}.txt"
+	layout="$(dirname "$program")/layout${puzzle#*:}.txt"
+	sed -E 's/^(I[0-9]+).*/\1/' "$layout" > "$data/layout.txt"
+	grep '^I' "$layout" | sort | sed -E 's/^I[0-9]+//' > "$data/data.txt"
+	expected="$(python tis100.py "$program" -l "$layout")"
+	if [ "$(python tis100.py "$program" -l "$data/layout.txt" --data "$data/data.txt")" != "$expected" ]; then
+		result+=" $program (file)"
+	fi
+	if python -X dev tis100.py "$program" -l "$data/layout.txt" --data "$data/data.txt" 2>&1 >/dev/null | grep -q ResourceWarning; then
+		result+=" $program (files left open)"
+	fi
+	if (( $(wc -l < "$data/data.txt") == 1 )) && [ "$(cat "$data/data.txt" | python tis100.py "$program" -l "$data/layout.txt")" != "$expected" ]; then
+		result+=" $program (pipe)"
+	fi
+done
+rm -rf "$data"
+result+="$(python -c '
+import io, itertools, loader
+read = []
+def values():
+    for i in itertools.count():
+        read.append(i)
+        yield i % 100
+layout = loader.read_layout("test/02/layout1.txt")
+layout.data = [values()]
+c = loader.create_cluster(layout)
+c.load("test/02/signal_amplifier.txt")
+c.max_cycles = 1000
+c.run_headless()
+if not 200 <= len(read) <= 260:
+    print(" read", len(read), "values in 1000 cycles")
+# Files are closed by whoever opened them, so standard input stays open.
+file = io.StringIO("1 2 3\n")
+if list(loader.read_data(file, 0)) != [1, 2, 3] or file.closed:
+    print(" read_data closed its file")
+')"
+if [ -z "$result" ]; then
+	echo "PASS: streamed input"
+else
+	echo "FAIL: streamed input ($result)"
+fi
+
+# With --max_outputs, only the first values of each output are kept and
+# printed, but every value is still streamed and checked.
+stream="$(mktemp)"
+result="$(python tis100.py test/02/signal_amplifier.txt -l test/02/layout1.txt --max_outputs 5 --stream "$stream" | sed -n 1,2p | xargs)"
+result+=" $(python -c '
+import json, sys, loader
+layout = loader.read_layout("test/02/layout1.txt")
+expected = [int(x) for x in layout.test[0].split()]
+lines = [json.loads(line) for line in open(sys.argv[1])]
+cycles = [line["cycle"] for line in lines]
+print([line["value"] for line in lines] == expected, cycles == sorted(cycles) and cycles[-1] <= 160, end=" ")
+seen = []
+c = loader.create_cluster(layout, max_outputs=5, sinks=[lambda port, value, cycle: seen.append(value)])
+c.load("test/02/signal_amplifier.txt")
+result = loader.run_tests(c, [layout]).results[0]
+print(result.passed, result.outputs[c.outputs[0]] == expected[:5], seen == expected, end=" ")
+# A wrong value past the ones kept must still fail the test.
+layout.test = [" ".join(map(str, expected[:20] + [expected[20] + 1] + expected[21:]))]
+c = loader.create_cluster(layout, max_outputs=5)
+c.load("test/02/signal_amplifier.txt")
+print(loader.run_tests(c, [layout]).passed)
+' "$stream")"
+rm -f "$stream"
+if [ "$result" == "Test passed. 132 68 176 182 106 ... True True True True True False" ]; then
+	echo "PASS: max_outputs"
+else
+	echo "FAIL: max_outputs ($result)"
+fi
+
+# A profile has to account for every cycle of every node, each value sent
+# has to be received, and fast-forwarding mustn't change it.
+profile="$(mktemp -d)"
+python tis100.py test/02/signal_amplifier.txt -l test/02/layout1.txt --profile "$profile/ff.json" > /dev/null
+python tis100.py test/02/signal_amplifier.txt -l test/02/layout1.txt --profile "$profile/slow.json" --no_fast_forward > /dev/null
+python tis100.py test/02/signal_amplifier.txt -l test/02/layout1.txt --profile "$profile/profile.csv" > /dev/null
+result="$(cd "$profile" && python -c '
+import csv, json
+profile = json.load(open("ff.json"))
+nodes = profile["nodes"]
+print(profile["cycles"] == 160,
+    all(n["run"] + n["read"] + n["write"] == 160 for n in nodes),
+    sum(sum(n["sent"].values()) for n in nodes) == sum(sum(n["received"].values()) for n in nodes) == 39 * 5,
+    [i["executions"] for n in nodes if n["id"] == 1 for i in n["instructions"]] == [39, 39, 39],
+    [n["received"]["UP"] for n in nodes if n["kind"] == "output"] == [39],
+    profile == json.load(open("slow.json")),
+    sum(1 + len(n["instructions"]) for n in nodes) == len(list(csv.DictReader(open("profile.csv")))))
+')"
+rm -rf "$profile"
+if [ "$result" == "True True True True True True True" ]; then
+	echo "PASS: profile"
+else
+	echo "FAIL: profile ($result)"
+fi
+
+# Checking outputs as they arrive has to agree with comparing the whole
+# lists at the end, on every program in the manifest. A wrong value has to
+# fail the test wherever it is, and with fail_fast has to stop the run as
+# soon as it is output. A run passes as soon as all the expected values are
+# out, as in the game.
+result="$(python -c '
+import batch, loader
+for program, layout, _ in batch.read_manifest("test/manifest.txt"):
+    c = loader.load_puzzle(layout, program)
+    result = c.run_headless()
+    matches = all(result.outputs[port] == expected for port, expected in c.test_outputs.items())
+    if c.image_port:
+        matches = matches and result.image == c.test_image
+    if result.passed != matches:
+        print(program, layout, "checked wrongly")
+c = loader.load_puzzle("test/02/layout1.txt", "test/02/signal_amplifier.txt")
+port = c.outputs[0]
+expected = list(c.test_outputs[port])
+for index in (0, 20, len(expected) - 1):
+    c.test_outputs[port] = expected[:index] + [expected[index] + 1] + expected[index + 1:]
+    if c.run_headless().passed:
+        print("passed with value", index, "wrong")
+    c.fail_fast = True
+    result = c.run_headless()
+    c.fail_fast = False
+    if result.passed or len(result.outputs[port]) != index + 1:
+        print("fail_fast ran on past value", index)
+c.test_outputs[port] = expected + [0]
+if c.run_headless().passed:
+    print("passed with a value missing")
+c.test_outputs[port] = expected[:-1]
+result = c.run_headless()
+if not result.passed or result.cycles >= 160:
+    print("didn\x27t pass as soon as the expected values were out")
+')"
+if [ -z "$result" ]; then
+	echo "PASS: tests"
+else
+	echo "FAIL: tests ($(echo $result))"
+fi
+
+# Compiled programs have to give the same cycle counts, outputs, test results
+# and node statistics as interpreted ones on every program in the manifest.
+result="$(python -c '
+import batch, loader
+for program, layout, _ in batch.read_manifest("test/manifest.txt"):
+    results = [loader.load_puzzle(layout, program, **options).run_headless() for options in
+        ({}, {"compiled": True}, {"compiled": True, "fast_forward": False})]
+    a, b, c = [(r.cycles, r.passed, r.outputs, r.image, r.nodes) for r in results]
+    if not a == b == c:
+        print(program, layout)
+')"
+if [ -z "$result" ]; then
+	echo "PASS: compiled"
+else
+	echo "FAIL: compiled ($(echo $result))"
+fi
+# Compiling many programs in one process, as the daemon's workers do, has to
+# keep a bounded number of them in memory.
+result="$(python -c '
+import cache, compiler, loader
+cache.enabled = False
+layout = loader.read_layout("test/02/layout1.txt")
+for i in range(compiler.MAX_CACHED + 50):
+    c = loader.create_cluster(layout, compiled=True)
+    c.load_program(f"@1\nMOV UP ACC\nADD {i}\nMOV ACC DOWN\n")
+    c.run_headless()
+print(len(compiler.cache) <= compiler.MAX_CACHED)
+')"
+if [ "$result" == "True" ]; then
+	echo "PASS: compiled/memory"
+else
+	echo "FAIL: compiled/memory ($result)"
+fi
+
+# The NumPy engine has to give the same cycle counts, outputs and test
+# results as the emulator, running each puzzle's tests together. It doesn't
+# draw images, and the busy loop in 01 only takes long.
+if python -c "import numpy" 2>/dev/null; then
+	result="$(python -c '
+import batch, loader, vector
+puzzles = {}
+for program, layout, _ in batch.read_manifest("test/manifest.txt"):
+    if "busy_loop" not in program and loader.read_layout(layout).output_image is None:
+        puzzles.setdefault(program, []).append(layout)
+for program, layouts in puzzles.items():
+    expected = [loader.load_puzzle(layout, program).run_headless() for layout in layouts]
+    clusters = [loader.load_puzzle(layout, program) for layout in layouts]
+    inputs = [{port: list(values) for port, values in c.inputs.items()} for c in clusters]
+    tests = [c.test_outputs for c in clusters]
+    results = vector.VectorCluster(clusters[0], inputs, tests).run()
+    for a, b in zip(expected, results):
+        if (a.cycles, a.passed, a.outputs) != (b.cycles, b.passed, b.outputs):
+            print(program, a.cycles, b.cycles)
+')"
+	if [ -z "$result" ]; then
+		echo "PASS: vector"
+	else
+		echo "FAIL: vector ($(echo $result))"
+	fi
+else
+	echo "SKIP: vector (NumPy isn't installed)"
+fi
+
+# A recorded run has to replay to the same state as running it, at every
+# cycle checked, and end with the same cycle count, result and outputs. The
+# busy loop in 01 has long runs of cycles stored once with a count, and the
+# sequence reverser uses memory nodes.
+trace="$(mktemp)"
+result="$(python -c '
+import sys, loader, node, recorder
+trace = sys.argv[1]
+for program, layout in [("test/02/signal_amplifier.txt", "test/02/layout1.txt"),
+        ("test/01/self-test_diagnostic_busy_loop.txt", "test/01/layout1.txt"),
+        ("test/12/sequence_reverser.txt", "test/12/layout2.txt")]:
+    result = loader.load_puzzle(layout, program, trace=trace).run_headless()
+    replayer = recorder.Replayer(trace)
+    if (replayer.cycles, replayer.passed, replayer.output_lists(replayer.cycles)) != (result.cycles, result.passed, result.outputs):
+        print(program, "finished differently")
+    c = loader.load_puzzle(layout, program, fast_forward=False)
+    c.link()
+    c.reset_tests()
+    step = 1 if result.cycles < 10000 else 997
+    while True:
+        if c.cycle % step == 0 or c.cycle == result.cycles:
+            state = replayer.state(c.cycle)
+            replayed = [tuple(state[(x, y)][field] for field in recorder.FIELDS) for x, y, _ in replayer.nodes]
+            if replayed != [node.Node.snapshot(n) for n, _, _ in c.active]:
+                print(program, "differs at cycle", c.cycle)
+                break
+        if c.cycle == result.cycles:
+            break
+        c.run_once()
+' "$trace")"
+python tis100.py test/02/signal_amplifier.txt -l test/02/layout1.txt --trace "$trace" > /dev/null
+replayed="$(python replay.py "$trace" --json)"
+rm -f "$trace"
+if [ -z "$result" ] && echo "$replayed" | grep -q '"cycles": 160,' && echo "$replayed" | grep -q '"passed": true'; then
+	echo "PASS: trace"
+else
+	echo "FAIL: trace ($(echo $result))"
+fi
+
+# Restoring a snapshot taken part way through a run, after running on past
+# it, has to finish the same way as a run that was never interrupted, for
+# memory nodes and for inputs streamed from a file. Running a cluster again
+# after it has been reset has to give the same result again.
+result="$(python -c '
+import io, loader
+def finish(c):
+    while True:
+        c.run_once()
+        if not c.progress and c.cycle > 1:
+            if c.go and not c.frozen:
+                c.cycle -= 1
+            return c.cycle, c.passed, {port: list(values) for port, values in c.output_lists.items()}, c.snapshot()["nodes"]
+def cluster(layout, streamed):
+    layout = loader.read_layout(layout)
+    if streamed:
+        layout.data = [loader.read_data(io.StringIO("\n".join(layout.data)), i) for i in range(len(layout.data))]
+    c = loader.create_cluster(layout)
+    c.load(program)
+    c.link()
+    c.reset_tests()
+    return c
+for program, layout in [("test/12/sequence_reverser.txt", "test/12/layout2.txt"),
+        ("test/20/sequence_indexer.txt", "test/20/layout1.txt")]:
+    for streamed in (False, True):
+        expected = finish(cluster(layout, streamed))
+        c = cluster(layout, streamed)
+        while c.cycle < expected[0] // 2:
+            c.run_once()
+        state = c.snapshot()
+        if finish(c) != expected:
+            print(program, streamed, "ran on differently")
+        c.restore(state)
+        if finish(c) != expected:
+            print(program, streamed, "restored differently")
+    c = loader.load_puzzle(layout, program)
+    first, second = [c.run_headless() for _ in range(2)]
+    if (first.cycles, first.passed, first.outputs, first.nodes) != (second.cycles, second.passed, second.outputs, second.nodes):
+        print(program, "differs after reset")
+')"
+if [ -z "$result" ]; then
+	echo "PASS: snapshots"
+else
+	echo "FAIL: snapshots ($(echo $result))"
+fi
+
+# Splitting the rows of a grid between processes has to give the same outputs
+# and cycle count as running it in one. Grids are only split with a core for
+# each process, so the number of cores is faked, to split them on any machine.
+expected="$(python tis100.py test/shards/mesh.txt -l test/shards/layout.txt)"
+for shards in 2 3 4; do
+	result="$(python -c '
+import os, runpy, sys
+os.cpu_count = lambda: 4
+sys.argv[0] = "tis100.py"
+runpy.run_path("tis100.py", run_name="__main__")
+' test/shards/mesh.txt -l test/shards/layout.txt --shards $shards)"
+	if [ "$result" == "$expected" ] && echo "$result" | grep -q "Test passed" && echo "$result" | grep -q "Completed in 314"; then
+		echo "PASS: shards/mesh ($shards shards)"
+	else
+		echo "FAIL: shards/mesh ($shards shards)"
+	fi
+done
+# With fewer cores than processes, a grid runs in one process.
+result="$(python -c '
+import os, loader, shard
+c = loader.load_puzzle("test/shards/layout.txt", "test/shards/mesh.txt", shards=3)
+counts = []
+for cores in 4, 3, 2, 1, None:
+    os.cpu_count = lambda: cores
+    counts.append(shard.workers(c, 3))
+print(counts)
+')"
+if [ "$result" == "[3, 3, 0, 0, 0]" ]; then
+	echo "PASS: shards/cores"
+else
+	echo "FAIL: shards/cores ($result)"
+fi
+# A worker stopped by an emulator error has to stop the run with an error
+# naming it, not let it end as if it had finished.
+broken="$(mktemp)"
+sed '$s/MOV UP DOWN/JMP NOWHERE/' test/shards/mesh.txt > "$broken"
+result="$(python -c '
+import os, runpy, sys
+os.cpu_count = lambda: 4
+sys.argv[0] = "tis100.py"
+runpy.run_path("tis100.py", run_name="__main__")
+' "$broken" -l test/shards/layout.txt --shards 2 2>&1)"
+status=$?
+rm -f "$broken"
+if (( status != 0 )) && echo "$result" | grep -q "RuntimeError: Shard worker 1 stopped"; then
+	echo "PASS: shards/errors"
+else
+	echo "FAIL: shards/errors"
+fi
+
+# Skipping ahead has to give the same result as running every cycle, without
+# taking much longer, even with a node looping forever without touching a
+# port while another one outputs a value every few dozen cycles.
+expected="$(python tis100.py test/skip/swap_loop.txt -l test/02/layout1.txt --no_fast_forward)"
+result="$(timeout 5 python tis100.py test/skip/swap_loop.txt -l test/02/layout1.txt)"
+if [ "$result" == "$expected" ] && echo "$result" | grep -q "Test passed" && echo "$result" | grep -q "Completed in 1057"; then
+	echo "PASS: skip/swap_loop"
+else
+	echo "FAIL: skip/swap_loop"
+fi
+# A loop that wraps around past the end of the program, with no jump, has to
+# be skipped over too, so running it takes a fraction of the time it takes to
+# run every cycle.
+result="$(python -c '
+import time, loader
+times = []
+for ff in (True, False):
+    c = loader.load_puzzle("test/02/layout1.txt", "test/skip/wrap_loop.txt", fast_forward=ff)
+    start = time.perf_counter()
+    result = c.run_headless()
+    times.append(time.perf_counter() - start)
+    print(result.cycles, result.passed, end=" ")
+print(times[0] < times[1] / 5)
+')"
+if [ "$result" == "244122 True 244122 True True" ]; then
+	echo "PASS: skip/wrap_loop"
+else
+	echo "FAIL: skip/wrap_loop ($result)"
+fi
+
+# A run given max_cycles has to stop just past it, even when it can skip far
+# ahead, so searches don't spend time on programs that are already too slow.
+result="$(python -c '
+import loader
+for ff in (True, False):
+    c = loader.create_cluster(loader.read_layout("test/02/layout1.txt"), max_cycles=100, fast_forward=ff)
+    c.load_program("@0\nMOV 5 ACC\nL: ADD 1\nSWP\nJMP L\n")
+    result = c.run_headless()
+    print(result.cycles, result.passed)
+')"
+if [ "$result" == "$(printf '101 False\n101 False')" ]; then
+	echo "PASS: max_cycles"
+else
+	echo "FAIL: max_cycles ($(echo $result))"
+fi
+
+# A layout or program parsed once has to be loaded from the cache after that,
+# and the cache has to stay under its size limit however much is saved,
+# without looking at every entry each time something is saved.
+directory="$(mktemp -d)"
+result="$(TIS100_CACHE="$directory" python -c '
+import os, cache, loader
+layout = "\n".join(open("test/02/layout1.txt").read().splitlines())
+program = open("test/02/signal_amplifier.txt").read()
+before = (cache.load("layout", layout), cache.load("program", program))
+loader.load_puzzle("test/02/layout1.txt", "test/02/signal_amplifier.txt")
+after = (cache.load("layout", layout), cache.load("program", program))
+print(before == (None, None) and None not in after and after[0] == vars(loader.read_layout("test/02/layout1.txt")))
+# Compiled code is kept under the source it was made from, so changing the
+# code generator can never load code it made before.
+import compiler
+c = loader.load_puzzle("test/02/layout1.txt", "test/02/signal_amplifier.txt", compiled=True)
+c.run_headless()
+sources = [compiler.program_source(n.program) for n, _, _ in c.active if n.program and not n.memory]
+print(len(sources) > 0 and all(cache.load("compiled", source) is not None for source in sources))
+cache.MAX_SIZE = 50000
+scans = []
+scandir = os.scandir
+os.scandir = lambda path: scans.append(path) or scandir(path)
+for i in range(500):
+    cache.save("program", f"{i}", "x" * 1000)
+os.scandir = scandir
+sizes = [entry.stat().st_size for entry in os.scandir(cache.DIRECTORY) if entry.name.endswith(".entry")]
+print(sum(sizes) <= cache.MAX_SIZE, len(sizes) > 10, len(scans) < 100)
+')"
+rm -rf "$directory"
+if [ "$result" == "$(printf 'True\nTrue\nTrue True True')" ]; then
+	echo "PASS: cache"
+else
+	echo "FAIL: cache ($(echo $result))"
+fi
+
+# A search from a program with two useless instructions has to find the
+# program without them.
+slow="$(mktemp)"
+sed 's/^ADD ACC$/ADD ACC\nNOP\nADD 0/' test/02/signal_amplifier.txt > "$slow"
+result="$(python search.py "$slow" -l test/02/layout1.txt -l test/02/layout2.txt -l test/02/layout3.txt -g deletions -r 2)"
+rm -f "$slow"
+if echo "$result" | grep -q "^160 cycle(s), 4 node(s), 6 instruction(s)"; then
+	echo "PASS: search"
+else
+	echo "FAIL: search"
+fi
+# A candidate the emulator can't run has to count as an error, without
+# stopping the search.
+generator="$(mktemp -d)"
+printf 'import search\ndef bad(program):\n    yield {**program, 0: "ADD"}\n    yield from search.deletions(program)\n' > "$generator/bad.py"
+result="$(python search.py test/02/signal_amplifier.txt -l test/02/layout1.txt -g "$generator/bad.py:bad" 2>&1)"
+rm -rf "$generator"
+if echo "$result" | grep -q "^Ran .* 1 error(s)\.$" && echo "$result" | grep -q "^160 cycle(s), 4 node(s), 6 instruction(s): base" && ! echo "$result" | grep -q Traceback; then
+	echo "PASS: search/errors"
+else
+	echo "FAIL: search/errors"
+fi
+# Deleting an instruction can leave a node looping for ever without its
+# outputs ever being wrong. Those candidates have to fail, not hang the search.
+result="$(timeout 60 python search.py test/skip/swap_loop.txt -l test/02/layout1.txt -g deletions -j 1)"
+if [ $? == 0 ] && echo "$result" | grep -q "^Ran 15 program(s)"; then
+	echo "PASS: search/loops"
+else
+	echo "FAIL: search/loops"
+fi
+
+# A batch has to carry on past a job the emulator can't run and one that never
+# finishes, and still fail them.
+jobs="$(mktemp -d)"
+printf '@0\nADD\n' > "$jobs/bad.txt"
+printf '@0\nL: JMP L\n' > "$jobs/loop.txt"
+cp test/02/layout1.txt test/02/signal_amplifier.txt "$jobs"
+printf 'bad.txt layout1.txt\nloop.txt layout1.txt\nsignal_amplifier.txt layout1.txt 160\n' > "$jobs/manifest.txt"
+result="$(timeout 60 python batch.py "$jobs/manifest.txt" --max_cycles 10000 2>&1)"
+status=$?
+rm -rf "$jobs"
+if (( status == 1 )) && echo "$result" | grep -q "^FAIL: .*bad.txt .*IndexError" && echo "$result" | grep -q "^FAIL: .*loop.txt .*Stopped after 10000" &&
+		echo "$result" | grep -q "^PASS: .*signal_amplifier.txt .* in 160" && ! echo "$result" | grep -q Traceback; then
+	echo "PASS: batch"
+else
+	echo "FAIL: batch"
+fi
+
+# The daemon has to score jobs sent to it, and give up on jobs that run for
+# too long without holding up the others. Jobs the emulator can't run, or
+# with options of the wrong type, have to get an error without stopping the
+# worker.
+result="$(python -c '
+import json
+layouts = [open(f"test/02/layout{i}.txt").read() for i in (1, 2, 3)]
+print(json.dumps({"id": 1, "layout": layouts[0], "program": "@0\nA: JMP A\n", "timeout": 0.5}))
+print(json.dumps({"id": 2, "layout": layouts, "program": open("test/02/signal_amplifier.txt").read()}))
+print(json.dumps({"id": 3, "layout": layouts[0], "program": "@0\n  \nMOV UP DOWN\n"}))
+print(json.dumps({"id": 4, "layout": layouts[0], "program": "@0\nMOV UP DOWN\n", "max_cycles": "x"}))
+' | python daemon.py -j 2 2>&1)"
+if echo "$result" | grep -q '"id": 1, "status": "timeout"' && echo "$result" | grep -q '"id": 2, "status": "done", "passed": true, "cycles": 160, "nodes": 4, "instructions": 6' &&
+		echo "$result" | grep -q '"id": 3, "status": "error"' && echo "$result" | grep -q '"id": 4, "status": "error"' &&
+		! echo "$result" | grep -q Traceback; then
+	echo "PASS: daemon"
+else
+	echo "FAIL: daemon"
+fi
+
+# Headless runs shouldn't import modules that are only needed by the GUI or
+# by options that weren't given, and importing the emulator has to stay
+# within a startup budget, in microseconds. Bytecode is written first, so
+# compiling the source isn't counted.
+budget=${STARTUP_BUDGET:-60000}
+PYTHONDONTWRITEBYTECODE= python -c "import tis100, loader"
+imports="$(PYTHONDONTWRITEBYTECODE= python -X importtime tis100.py test/02/signal_amplifier.txt -l test/02/layout1.txt 2>&1 >/dev/null)"
+unused="$(echo "$imports" | grep -oE '\| +(curses|textwrap|json|pickle|hashlib|tempfile|shutil|csv|gui|profiler|recorder|compiler|sinks|shard|multiprocessing)$' | tr -d '| ' | xargs)"
+if [ -z "$unused" ]; then
+	echo "PASS: headless imports"
+else
+	echo "FAIL: headless imports ($unused)"
+fi
+startup="$(PYTHONDONTWRITEBYTECODE= python -X importtime -c "import tis100" 2>&1 | awk -F'|' '$3 ~ /^ tis100$/ {print $2 + 0}')"
+if (( startup <= budget )); then
+	echo "PASS: startup time (${startup} us of ${budget} us)"
+else
+	echo "FAIL: startup time (${startup} us of ${budget} us)"
+fi
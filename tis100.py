@@ -1,21 +1,40 @@
 #! /usr/bin/env python3
 
 import argparse
-import re
+import contextlib
+import os
 import sys
-import time
-import cluster
+import cache
+import loader
+
+def speed(value):
+    # Cycles per second, where max means no limit.
+    if value == 'max':
+        return float('inf')
+    return int(value)
+
+class HelpFormatter(argparse.HelpFormatter):
+    # argparse makes a formatter for every argument added, which looks up the
+    # terminal width through shutil. Importing shutil takes longer than a
+    # short run, so the width is looked up directly instead.
+    def __init__(self, prog):
+        try:
+            width = os.get_terminal_size().columns
+        except OSError:
+            width = 80
+        super().__init__(prog, width=width - 2)
 
 if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description='TIS-100 Emulator', add_help=False)
-    parser.add_argument('-s', '--speed', type=int,
-        help="The speed of the emulation in Hz. Defaults to 50. This only takes effect when used with --gui. When the program is run without --gui, the program runs as fast as possible.", default=50)
+    parser = argparse.ArgumentParser(description='TIS-100 Emulator', add_help=False,
+        formatter_class=HelpFormatter)
+    parser.add_argument('-s', '--speed', type=speed,
+        help="The speed of the emulation in Hz, or max to run as fast as possible while drawing 60 frames a second. Defaults to 50. This only takes effect when used with --gui. When the program is run without --gui, the program runs as fast as possible.", default=50)
     parser.add_argument('-w', '--width', type=int,
         help="The width of the emulation. Defaults to 4.", default=4)
     parser.add_argument('-h', '--height', type=int,
         help="The height of the emulation. Defaults to 3.", default=3)
-    parser.add_argument('-l', '--layout', type=argparse.FileType('r'),
-        help="A file with layout data. If this option is specified, all other options aside from --speed and --gui are ignored.")
+    parser.add_argument('-l', '--layout', type=argparse.FileType('r'), action='append',
+        help="A file with layout data. If this option is specified, all other options aside from --speed and --gui are ignored. This argument can be used multiple times to run the program against several layouts that differ only in their data, such as the three tests of a puzzle, and report its score.")
     parser.add_argument('-i', '--input', type=int, action='append', default=[],
         help="A node index that has an input connected to it. The node must be on the boundary, and inputs are placed above, to the left, below, and to the right, in that order of precedence. This argument can be used multiple times to define multiple inputs.")
     parser.add_argument('--data', type=argparse.FileType('r'), default=(None if sys.stdin.isatty() else sys.stdin),
@@ -28,6 +47,24 @@ if __name__ == '__main__':
         help="A file with test output data, one output per line, to compare the outputs against.")
     parser.add_argument('--test_image', type=argparse.FileType('r'),
         help="A file with image test data to compare the output image against.")
+    parser.add_argument('--fail_fast', action='store_true',
+        help="Stop as soon as an output differs from the test data, instead of running until the program finishes.")
+    parser.add_argument('--no_fast_forward', action='store_true',
+        help="Run every cycle, instead of skipping over cycles where no values can move between nodes. Cycle counts are the same either way.")
+    parser.add_argument('--compiled', action='store_true',
+        help="Run each node's program as generated Python code instead of interpreting it. Cycle counts are the same either way.")
+    parser.add_argument('--profile', type=str,
+        help="Write a profile of what each node and instruction did to this file, as CSV if the name ends in .csv and JSON otherwise. With several layouts, the last one is profiled.")
+    parser.add_argument('--trace', type=str,
+        help="Record everything the nodes do to this file, to be looked at afterwards with replay.py. With several layouts, the last one is recorded.")
+    parser.add_argument('--stream', type=argparse.FileType('w'),
+        help="Write each output value to this file as soon as it is produced, as a line of JSON with the output's position, the value and the cycle. Use - for standard output.")
+    parser.add_argument('--max_outputs', type=int,
+        help="Keep at most this many values of each output in memory. Later values are still checked against the test data and streamed, but not printed at the end.")
+    parser.add_argument('--shards', type=int, default=1,
+        help="Split the rows of the grid between this many processes, to run large grids on several cores. Cycle counts and outputs are the same either way. Grids need at least four rows, counting the rows of inputs and outputs, and a core, for each process. Has no effect with --gui, --profile or --trace.")
+    parser.add_argument('--no_cache', action='store_true',
+        help="Parse the layout and program again, instead of loading them from the cache of files parsed before.")
     parser.add_argument('-m', '--memory', type=int, action='append', default=[],
         help="A node index that is a stack memory node. This argument can be used multiple times to define multiple memory nodes.")
     parser.add_argument('-d', '--dead', type=int, action='append', default=[],
@@ -41,176 +78,77 @@ if __name__ == '__main__':
 
     args = parser.parse_args()
 
-    data = None
-    test = None
-    test_image = []
-
-    if args.layout:
-        lines = args.layout.read().splitlines()
-        try:
-            size = re.findall(r'\d+', lines[0])
-            args.width = int(size[0])
-            args.height = int(size[1])
-        except IndexError:
-            print("\033[31mInvalid size definition in layout file.")
-            print("The first line of the layout file must define the node cluster size.")
-            print("Size is defined with integer values as WIDTH HEIGHT.\033[0m")
-            sys.exit()
-        args.input = []
-        args.output = []
-        args.output_image = None
-        args.memory = []
-        args.dead = []
-        i = 0
-        for line in lines[1:args.height+1]:
-            line = line.upper()
-            if not all(ch in "CMD" for ch in line):
-                print("\033[31mMalformed layout string.")
-                print("Layout must be come immediately after the size.")
-                print(f"Layout must be exactly {args.width} characters wide and {args.height} characters tall.")
-                print("Layouts consist of only the letters C, M, or D.\033[0m")
-                sys.exit()
-            if len(line) != args.width:
-                print("\033[31mMalformed layout string.")
-                print("Layout must be come immediately after the size.")
-                print(f"Layout must be exactly {args.width} characters wide and {args.height} characters tall.")
-                print("Layouts consist of only the letters C, M, or D.\033[0m")
-                sys.exit()
-            for c in line.ljust(args.width, 'C'):
-                if c.upper() == 'M':
-                    args.memory.append(i)
-                if c.upper() == 'D':
-                    args.dead.append(i)
-                i += 1
-        data_dict = {}
-        test_dict = {}
-        for line in lines[args.height+1:]:
-            input_re = re.compile(r'^I(\d+)(?:\s+([A-Za-z]+))?(?:\s+(-?\d+(?:\s+-?\d+)*))?$')
-            output_re = re.compile(r'^O(\d+)(?:\s+([A-Za-z]+))?(?:\s+(-?\d+(?:\s+-?\d+)*))?$')
-            image_re = re.compile(r'^(\d+)$')
-            match = input_re.match(line)
-            if match:
-                args.input.append(int(match.group(1)))
-                if match.group(3):
-                    data_dict[int(match.group(1))] = match.group(3)
-            match = output_re.match(line)
-            if match:
-                if match.group(2) and match.group(2) == "IMAGE":
-                    args.output_image = (args.height - 1) * args.width + int(match.group(1))
+    # Files opened for the run, closed once it is over. Standard input is
+    # left open.
+    with contextlib.ExitStack() as files:
+        for file in [args.data, args.test_data, args.test_image, args.stream] + (args.layout or []):
+            if file is not None and file is not sys.stdin:
+                files.enter_context(file)
 
-                else:
-                    args.output.append((args.height - 1) * args.width + int(match.group(1)))
-                if match.group(3):
-                    test_dict[int(match.group(1))] = match.group(3)
-            match = image_re.match(line)
-            if match:
-                test_image.append([int(x) for x in match.group(1)])
+        if args.no_cache:
+            cache.enabled = False
 
+        output_sinks = []
+        if args.stream:
+            import sinks
+            output_sinks.append(sinks.StreamSink(args.stream))
 
-        if data_dict.keys():
-            data = []
-            for i in sorted(data_dict.keys()):
-                data.append(data_dict[i])
-        if test_dict.keys():
-            test = []
-            for i in sorted(test_dict.keys()):
-                test.append(test_dict[i])
-
-    if not data and args.data:
-        data = args.data.read().splitlines()
-
-    if not test and args.test_data:
-        test = args.test_data.read().splitlines()
-    if not test_image and args.test_image:
-        try:
-            test_image = args.test_image.read().splitlines()
-            test_image = [[int(x) for x in line] for line in test_image]
-        except:
-            test_image = []
-
-    c = cluster.NodeCluster(args.width, args.height, speed=args.speed, gui=args.gui, test_image=test_image)
+        if args.layout and len(args.layout) > 1:
+            if args.gui:
+                print("\033[31m--gui can only be used with a single layout.\033[0m")
+                sys.exit()
+            layouts = [loader.parse_layout(file.read().splitlines()) for file in args.layout]
+            c = loader.create_cluster(layouts[0], fail_fast=args.fail_fast, profile=bool(args.profile),
+                fast_forward=not args.no_fast_forward, compiled=args.compiled, trace=args.trace,
+                max_outputs=args.max_outputs, sinks=output_sinks, shards=args.shards)
+            try:
+                c.load(args.file)
+            except FileNotFoundError:
+                print(f"File `{args.file}' not found.")
+                sys.exit()
+            score = loader.run_tests(c, layouts)
+            for file, result in zip(args.layout, score.results):
+                status = "passed" if result.passed else "failed"
+                print(f"{file.name}: Test {status}. Completed in {result.cycles} cycle(s).")
+            print(f"Score: {score.cycles} cycle(s), {score.nodes} node(s), {score.instructions} instruction(s).")
+            if args.profile:
+                c.profiler.dump(args.profile)
+            sys.exit()
 
-    for i, node in enumerate(sorted(args.input)):
-        x = node % args.width + 1
-        y = node // args.width + 1
-        if y == 1:
-            y = 0
-        elif x == 1:
-            x = 0
-        elif y == args.height:
-            y = args.height + 1
-        elif x == args.width:
-            x = args.width + 1
+        if args.layout:
+            layout = loader.parse_layout(args.layout[0].read().splitlines())
         else:
-            print("Invalid input node.")
-        try:
-            c.inputs[(x, y)] = [int(x) for x in re.findall(r'-?\d+', data[i])]
-        except:
-            print(f"Cound not load data for input {node}.")
-            time.sleep(1)
-            c.inputs[(x, y)] = []
-        c.nodes[y][x].code = c.create_input(x, y)
-        c.nodes[y][x].parse_code()
+            layout = loader.Layout(args.width, args.height, args.input, args.output,
+                args.output_image, args.memory, args.dead)
+
+        if not layout.data and args.data and layout.input:
+            if args.data is not sys.stdin and args.data.seekable():
+                # Each input streams its own line of the file.
+                layout.data = [loader.read_data(files.enter_context(open(args.data.name)), i)
+                    for i in range(len(layout.input))]
+            elif len(layout.input) == 1:
+                layout.data = [loader.read_data(args.data, 0)]
+            else:
+                layout.data = args.data.read().splitlines()
+
+        if not layout.test and args.test_data:
+            layout.test = args.test_data.read().splitlines()
+        if not layout.test_image and args.test_image:
+            try:
+                test_image = args.test_image.read().splitlines()
+                layout.test_image = [[int(x) for x in line] for line in test_image]
+            except:
+                layout.test_image = []
+
+        c = loader.create_cluster(layout, speed=args.speed, gui=args.gui, fail_fast=args.fail_fast,
+            profile=bool(args.profile), fast_forward=not args.no_fast_forward, compiled=args.compiled,
+            trace=args.trace, max_outputs=args.max_outputs, sinks=output_sinks, shards=args.shards)
 
-    for i, node in enumerate(sorted(args.output)):
-        x = node % args.width + 1
-        y = node // args.width + 1
-        if y == args.height:
-            y = args.height + 1
-        elif x == args.width:
-            x = args.width + 1
-        elif y == 1:
-            y = 0
-        elif x == 1:
-            x = 0
-        else:
-            print("Invalid output node.")
-        c.outputs.append((x, y))
         try:
-            c.test_outputs[(x, y)] = [int(x) for x in re.findall(r'-?\d+', test[i])]
-        except:
-            pass
-        c.nodes[y][x].code = c.create_output(x, y)
-        c.nodes[y][x].parse_code()
-        c.nodes[y][x].acc = None
-        c.output_lists[(x, y)] = []
-
-    if args.output_image is not None:
-        x = args.output_image % args.width + 1
-        y = args.output_image // args.width + 1
-        if y == args.height:
-            y = args.height + 1
-        elif x == args.width:
-            x = args.width + 1
-        elif y == 1:
-            y = 0
-        elif x == 1:
-            x = 0
-        else:
-            print("Invalid output node.")
-        c.outputs.append((x, y))
-        c.nodes[y][x].code = c.create_output(x, y)
-        c.nodes[y][x].parse_code()
-        c.nodes[y][x].acc = None
-        c.output_lists[(x, y)] = []
-        c.image_port = (x, y)
-        c.image = [[0] * c.image_dim[0] for _ in range(c.image_dim[1])]
-
-    for node in args.memory:
-        x = node % args.width + 1
-        y = node // args.width + 1
-        c.memory.append((x, y))
-        c.nodes[y][x].memory = True
-
-    for node in args.dead:
-        x = node % args.width + 1
-        y = node // args.width + 1
-        c.dead.append((x, y))
-        c.nodes[y][x].dead = True
-
-    try:
-        c.load(args.file)
-        c.run()
-    except FileNotFoundError:
-        print(f"File `{filename}' not found.")
-
+            c.load(args.file)
+            c.run()
+        except FileNotFoundError:
+            print(f"File `{args.file}' not found.")
+            sys.exit()
+        if args.profile:
+            c.profiler.dump(args.profile)
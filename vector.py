@@ -0,0 +1,364 @@
+import sys
+import cluster
+import node
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Ports as numbers, in the order they are read from ANY.
+PORTS = node.ANY_ORDER
+ANY = len(PORTS)
+NONE = -1
+RPORTS = [PORTS.index(node.RDIRS[port]) for port in PORTS]
+# ACC of an output node when it has nothing to output.
+EMPTY = node.MAX_N + 1
+
+class Lanes:
+    """ The registers of one node across every instance of a VectorCluster,
+    as arrays with an entry per instance.
+    """
+    def __init__(self, n, size, tracked, output):
+        self.node = n
+        self.input = isinstance(n, node.InputNode)
+        self.program = n.program
+        self.memory = n.memory
+        self.tracked = tracked
+        # The (x, y) of the output, if this is an output node.
+        self.output_port = output
+        # Neighbours on each port, filled in by VectorCluster.
+        self.ports = [None] * len(PORTS)
+        self.acc = np.full(size, EMPTY if output else 0, dtype=np.int64)
+        self.bak = np.zeros(size, dtype=np.int64)
+        self.last = np.full(size, NONE, dtype=np.int64)
+        self.step = np.zeros(size, dtype=np.int64)
+        self.cycle = np.zeros(size, dtype=np.int64)
+        self.write = np.full(size, NONE, dtype=np.int64)
+        self.output = np.zeros(size, dtype=np.int64)
+        self.ready = np.zeros(size, dtype=bool)
+        if self.memory:
+            self.stack = np.zeros((size, node.MAX_STACK), dtype=np.int64)
+            self.depth = np.zeros(size, dtype=np.int64)
+
+
+class VectorCluster:
+    """ Runs one program on many copies of a cluster at once, each with its
+    own input data, by keeping the registers of every node as NumPy arrays
+    with an entry per instance. Each cycle does what NodeCluster.run_once
+    does for every instance still running, one node at a time in the same
+    order, so every instance gets the same cycle count and outputs it would
+    get on its own.
+
+    The cluster passed in supplies the layout and program. inputs is a list
+    with an entry per instance, each a dictionary of (x, y): [values] like
+    NodeCluster.inputs. tests, if given, is a matching list of dictionaries
+    like NodeCluster.test_outputs. Only the first max_outputs values of each
+    output are kept. Image outputs are not supported.
+    """
+    def __init__(self, c, inputs, tests=None, max_outputs=1000):
+        if np is None:
+            print("\033[31mNumPy is needed to run many instances at once.\033[0m")
+            sys.exit()
+        if c.image_port:
+            print("\033[31mImage outputs can't be run as many instances at once.\033[0m")
+            sys.exit()
+        c.link()
+        self.size = size = len(inputs)
+        self.max_outputs = max_outputs
+        # Finished instances are dropped from the arrays as they go, so this
+        # is the instance each entry belongs to, and the Result of each
+        # instance once it is known.
+        self.index = np.arange(size)
+        self.results = [None] * size
+        self.cycle = np.zeros(size, dtype=np.int64)
+        # Instances that haven't finished yet, and whether each has halted.
+        self.running = np.ones(size, dtype=bool)
+        self.go = np.ones(size, dtype=bool)
+        self.passed = np.zeros(size, dtype=bool)
+
+        self.lanes = []
+        by_node = {}
+        for n, output, tracked in c.active:
+            lanes = Lanes(n, size, tracked, output)
+            if lanes.input:
+                lanes.direction = PORTS.index(n.direction)
+                data, lanes.length = self.pack([data[(n.x, n.y)] for data in inputs])
+                lanes.data = np.clip(data, node.MIN_N, node.MAX_N)
+                lanes.sent = np.zeros(size, dtype=np.int64)
+            by_node[n] = lanes
+            self.lanes.append(lanes)
+        # Only neighbours that do something can ever offer a value.
+        for lanes in self.lanes:
+            for i, port in enumerate(PORTS):
+                for _, out_node, _ in lanes.node.ports[port]:
+                    lanes.ports[i] = by_node.get(out_node)
+
+        self.outputs = {}
+        for port in c.outputs:
+            self.outputs[port] = [np.zeros((size, max_outputs), dtype=np.int64),
+                np.zeros(size, dtype=np.int64)]
+        # Test outputs, as padded arrays and their lengths, and how many
+        # tested outputs each instance has yet to finish.
+        self.tests = {}
+        self.tested = np.zeros(size, dtype=bool)
+        self.test_failed = np.zeros(size, dtype=bool)
+        self.outputs_pending = np.zeros(size, dtype=np.int64)
+        if tests is not None:
+            for port in c.outputs:
+                has = np.array([port in test for test in tests], dtype=bool)
+                if not has.any():
+                    continue
+                expected, length = self.pack([test.get(port, []) for test in tests])
+                self.tests[port] = (expected, length, has)
+                self.tested |= has
+                self.outputs_pending += has & (length > 0)
+
+    def pack(self, lists):
+        # A list of sequences as one padded array, and their lengths.
+        lists = [[int(value) for value in values] for values in lists]
+        length = np.array([len(values) for values in lists], dtype=np.int64)
+        array = np.zeros((len(lists), max(1, int(length.max(initial=0)))), dtype=np.int64)
+        for i, values in enumerate(lists):
+            array[i, :len(values)] = values
+        return array, length
+
+    def run(self, max_cycles=None):
+        # Run every instance until it finishes, or until max_cycles, and
+        # return a Result for each.
+        while self.running.any():
+            if max_cycles is not None and self.cycle.max() >= max_cycles:
+                break
+            self.run_once()
+            if self.running.sum() * 2 < self.size:
+                self.compact()
+        self.finish(np.arange(self.size))
+        return self.results
+
+    def finish(self, entries):
+        # Record the Result of the instances at these entries.
+        for i in entries:
+            outputs = {}
+            for port, (values, count) in self.outputs.items():
+                outputs[port] = values[i, :min(count[i], self.max_outputs)].tolist()
+            self.results[self.index[i]] = cluster.Result(int(self.cycle[i]), bool(self.passed[i]), outputs)
+
+    def compact(self):
+        # Drop the instances that have finished, so the rest run faster.
+        self.finish(np.nonzero(~self.running)[0])
+        keep = np.nonzero(self.running)[0]
+        for obj in [self] + self.lanes:
+            for name, value in vars(obj).items():
+                if isinstance(value, np.ndarray) and len(value) == self.size:
+                    setattr(obj, name, value[keep])
+        self.outputs = {port: [values[keep], count[keep]] for port, (values, count) in self.outputs.items()}
+        self.tests = {port: tuple(array[keep] for array in test) for port, test in self.tests.items()}
+        self.size = len(keep)
+
+    def run_once(self):
+        running = self.running
+        # Instances whose outputs match the tests stop without counting
+        # another cycle.
+        done = running & self.tested & ~self.test_failed & (self.outputs_pending == 0)
+        self.passed |= done
+        running &= ~done
+        self.cycle[running] += 1
+        progress = np.zeros(self.size, dtype=bool)
+        for lanes in self.lanes:
+            if lanes.tracked:
+                before = lanes.cycle.copy()
+            self.exe(lanes, running)
+            if lanes.tracked:
+                progress |= lanes.cycle != before
+            if lanes.output_port:
+                self.add_output(lanes, running)
+        # Finish writes that were taken, and mark new ones as ready.
+        for lanes in self.lanes:
+            written = running & lanes.ready & (lanes.write == NONE)
+            lanes.step[written] += 1
+            lanes.cycle[written] += 1
+            if lanes.tracked:
+                progress |= written
+            lanes.ready = np.where(running, lanes.write != NONE, lanes.ready)
+        # Instances where no node made progress are finished.
+        done = running & ~progress & (self.cycle > 1)
+        self.cycle[done & self.go] -= 1
+        running &= ~done
+
+    def add_output(self, lanes, running):
+        got = running & (lanes.acc != EMPTY)
+        if not got.any():
+            return
+        instances = np.nonzero(got)[0]
+        value = lanes.acc[instances]
+        lanes.acc[instances] = EMPTY
+        values, count = self.outputs[lanes.output_port]
+        i = count[instances]
+        kept = i < self.max_outputs
+        values[instances[kept], i[kept]] = value[kept]
+        count[instances] += 1
+        test = self.tests.get(lanes.output_port)
+        if test is not None:
+            expected, length, has = test
+            instances, i, value = instances[has[instances]], i[has[instances]], value[has[instances]]
+            wrong = (i >= length[instances]) | (expected[instances, np.minimum(i, expected.shape[1] - 1)] != value)
+            self.test_failed[instances[wrong]] = True
+            finished = ~wrong & (i == length[instances] - 1)
+            self.outputs_pending[instances[finished]] -= 1
+
+    def exe(self, lanes, running):
+        if lanes.input:
+            self.exe_input(lanes, running)
+            return
+        if lanes.memory:
+            self.exe_memory(lanes, running)
+        if not lanes.program:
+            return
+        current = lanes.step % len(lanes.program)
+        for i, op in enumerate(lanes.program):
+            mask = running & (current == i)
+            if mask.any():
+                self.instruction(lanes, op, i, mask)
+
+    def exe_input(self, lanes, running):
+        # Like InputNode.exe: send the next value once the last one is taken.
+        mask = running & ~lanes.ready
+        lanes.cycle[mask] += 1
+        mask &= lanes.sent < lanes.length
+        instances = np.nonzero(mask)[0]
+        lanes.output[instances] = lanes.data[instances, lanes.sent[instances]]
+        lanes.write[instances] = lanes.direction
+        lanes.sent[instances] += 1
+
+    def exe_memory(self, lanes, running):
+        # Like Node.exe for a memory node: take values from any neighbour
+        # until the stack is full, then offer the top of the stack. As there,
+        # a value read just as the stack fills up is dropped.
+        mask = running & (lanes.depth < node.MAX_STACK)
+        while mask.any():
+            value, got = self.read(lanes, ANY, mask)
+            mask = got & (lanes.depth < node.MAX_STACK)
+            instances = np.nonzero(mask)[0]
+            lanes.stack[instances, lanes.depth[instances]] = value[instances]
+            lanes.depth[instances] += 1
+        mask = running & (lanes.depth > 0)
+        instances = np.nonzero(mask)[0]
+        lanes.write[instances] = ANY
+        lanes.output[instances] = lanes.stack[instances, lanes.depth[instances] - 1]
+
+    def read(self, lanes, port, mask):
+        # Like Node.read_port, for the instances in mask. Returns the values
+        # and which instances got one.
+        value = np.zeros(self.size, dtype=np.int64)
+        got = np.zeros(self.size, dtype=bool)
+        for i in (range(len(PORTS)) if port == ANY else (port, )):
+            out = lanes.ports[i]
+            if out is None:
+                continue
+            rport = RPORTS[i]
+            ok = mask & ~got & out.ready & ((out.write == rport) | (out.write == ANY))
+            if not ok.any():
+                continue
+            value[ok] = out.output[ok]
+            got |= ok
+            if port == ANY:
+                lanes.last[ok] = i
+            out.last[ok & (out.write == ANY)] = rport
+            out.write[ok] = NONE
+            if out.memory:
+                out.depth[ok] -= 1
+        return value, got
+
+    def get_value(self, lanes, src, mask):
+        # Like Node.get_value. Returns the values and which instances got one.
+        kind, arg = src
+        if kind == node.IMMEDIATE:
+            return np.full(self.size, arg, dtype=np.int64), mask
+        if kind == node.ACC:
+            return lanes.acc.copy(), mask
+        if kind == node.NIL:
+            return np.zeros(self.size, dtype=np.int64), mask
+        if kind == node.PORT:
+            return self.read(lanes, ANY if arg == 'ANY' else PORTS.index(arg), mask)
+        if kind == node.LAST:
+            # On TIS-100, an unset LAST returns 0.
+            value = np.zeros(self.size, dtype=np.int64)
+            got = mask & (lanes.last == NONE)
+            for i in range(len(PORTS)):
+                port_value, port_got = self.read(lanes, i, mask & (lanes.last == i))
+                value[port_got] = port_value[port_got]
+                got |= port_got
+            return value, got
+        if mask.any():
+            self.error(lanes, f"\"{arg}\" is not a valid source port.", mask)
+        return np.zeros(self.size, dtype=np.int64), mask
+
+    def instruction(self, lanes, op, i, mask):
+        # Run one instruction for the instances in mask, the way the Node
+        # method for its opcode does.
+        name = op[0]
+        if name in ('NOP', 'SWP', 'SAV', 'NEG'):
+            if name == 'SWP':
+                lanes.acc[mask], lanes.bak[mask] = lanes.bak[mask], lanes.acc[mask]
+            elif name == 'SAV':
+                lanes.bak[mask] = lanes.acc[mask]
+            elif name == 'NEG':
+                lanes.acc[mask] = -lanes.acc[mask]
+            lanes.step[mask] += 1
+            lanes.cycle[mask] += 1
+        elif name == 'MOV':
+            mask = mask & ~lanes.ready
+            value, got = self.get_value(lanes, op[1], mask)
+            kind, dest = op[2]
+            if kind == node.ACC:
+                lanes.acc[got] = value[got]
+                lanes.step[got] += 1
+                lanes.cycle[got] += 1
+            elif kind == node.NIL:
+                lanes.step[got] += 1
+                lanes.cycle[got] += 1
+            elif kind in (node.LAST, node.PORT):
+                if kind == node.LAST:
+                    # Sending to an unset LAST hangs.
+                    got = got & (lanes.last != NONE)
+                    lanes.write[got] = lanes.last[got]
+                else:
+                    lanes.write[got] = ANY if dest == 'ANY' else PORTS.index(dest)
+                lanes.output[got] = value[got]
+                lanes.cycle[got] += 1
+            elif got.any():
+                self.error(lanes, f"\"{dest}\" is not a valid destination port.", got)
+        elif name in ('ADD', 'SUB'):
+            value, got = self.get_value(lanes, op[1], mask)
+            if name == 'SUB':
+                value = -value
+            lanes.acc[got] = np.clip(lanes.acc[got] + value[got], node.MIN_N, node.MAX_N)
+            lanes.step[got] += 1
+            lanes.cycle[got] += 1
+        elif name == 'JMP':
+            if op[2] is None:
+                self.error(lanes, f"Undefined label: \"{op[1]}\"", mask)
+            lanes.step[mask] = op[2]
+            lanes.cycle[mask] += 1
+        elif name in ('JEZ', 'JNZ', 'JGZ', 'JLZ'):
+            acc = lanes.acc
+            jump = mask & {'JEZ': acc == 0, 'JNZ': acc != 0, 'JGZ': acc > 0, 'JLZ': acc < 0}[name]
+            if jump.any():
+                if op[2] is None:
+                    self.error(lanes, f"Undefined label: \"{op[1]}\"", jump)
+                lanes.step[jump] = op[2]
+            lanes.cycle[mask] += 1
+            lanes.step[mask & ~jump] += 1
+        elif name == 'JRO':
+            value, got = self.get_value(lanes, op[1], mask)
+            lanes.step[got] = np.clip(i + value[got], 0, len(lanes.program) - 1)
+            lanes.cycle[got] += 1
+        elif name == 'HCF':
+            self.go[mask] = False
+
+    def error(self, lanes, message, mask):
+        n = lanes.node
+        instance = int(np.nonzero(mask)[0][0])
+        step = int(lanes.step[instance])
+        print(f"\033[31mNode {n.get_id()}, step {step}, instance {instance}: {message}\033[0m")
+        sys.exit()